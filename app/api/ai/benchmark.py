@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for the weekly meal planner (reference.py)
+- Synthetic ingredient catalogs of any size (100 – 50k rows) shaped like the
+  production table: role mix, meal types per role, cuisine lists, allergens,
+  per-role macros and prices, plus a pairing table.
+- Times load_csv, filter_pool, candidate generation (scalar and batched),
+  scoring, combo search and build_week_with_presets for every preset (and
+  with the exact solver for `--modes exact`).
+- Reports latency percentiles, throughput and peak traced memory per stage as
+  one JSON document, so runs can be compared over time.
+
+Run:
+  python app/api/ai/benchmark.py --sizes 100,1000,10000 --repeats 5 --out runs/bench.json
+
+  `--sizes 50000 --presets fast,balanced --week-repeats 1` for a quick large-catalog run.
+"""
+import argparse, json, os, platform, sys, tempfile, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from pathlib import Path
+import numpy as np, pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import reference as ref
+
+# ------------- synthetic catalog -------------
+# role: (share of rows, mean protein/carbs/fat per serving, mean price,
+#        P(breakfast only), P(every slot)); the rest are lunch + dinner.
+# Shares and means follow the production export (scripts/*ingredients.csv).
+ROLE_MIX = {
+    "topping":           (0.18, (2.3, 2.8, 6.2),   16000, 0.30, 0.10),
+    "dressing_sauce":    (0.17, (1.1, 3.3, 4.7),   17500, 0.15, 0.00),
+    "base_protein":      (0.15, (21.9, 3.5, 8.3),  56000, 0.00, 0.00),
+    "base_carb":         (0.15, (4.2, 24.0, 4.2),  18000, 0.25, 0.00),
+    "vegetable":         (0.14, (1.2, 3.0, 2.4),   12000, 0.00, 0.00),
+    "secondary_protein": (0.07, (13.7, 12.5, 5.7), 37500, 0.15, 0.20),
+    "garnish":           (0.07, (0.3, 2.5, 0.3),   7000,  0.00, 0.00),
+    "leafy_green":       (0.05, (0.4, 0.8, 0.1),   10000, 0.00, 0.00),
+    "fat_source":        (0.02, (0.6, 2.6, 10.4),  17500, 0.00, 1.00),
+}
+CUISINE_LISTS = [  # (cuisine list, weight)
+    (["universal"], 20), (["western"], 13), (["asian", "japanese"], 8), (["american", "western"], 5),
+    (["mediterranean", "middle_eastern"], 5), (["italian", "mediterranean"], 4), (["asian", "indonesian"], 3),
+    (["greek", "mediterranean"], 3), (["middle_eastern"], 3), (["asian", "italian", "mediterranean"], 2),
+    (["mexican"], 2), (["indian"], 2), (["korean"], 1), (["asian", "indian"], 1), (["eastern_european"], 1),
+    (["middle_eastern", "north_african"], 1), (["african", "portuguese"], 1), (["mediterranean", "western"], 1),
+]
+ALLERGENS = ["dairy", "soy", "nuts", "fish", "gluten", "sesame", "shellfish"]
+ALLERGEN_RATE = 0.34  # share of rows carrying one allergen
+SERVINGS = [5, 10, 20, 30, 40, 60, 80, 100]
+
+def synthetic_catalog(n: int, seed: int = 0) -> pd.DataFrame:
+    """n ingredient rows in the CSV export schema (list columns as Python lists)."""
+    rng = np.random.default_rng(seed)
+    roles = list(ROLE_MIX)
+    share = np.asarray([ROLE_MIX[r][0] for r in roles]); share = share / share.sum()
+    role_ix = rng.choice(len(roles), size=n, p=share)
+    cw = np.asarray([w for _, w in CUISINE_LISTS], dtype=float)
+    cuis_ix = rng.choice(len(CUISINE_LISTS), size=n, p=cw / cw.sum())
+    has_allergen = rng.random(n) < ALLERGEN_RATE
+    allergen_ix = rng.integers(0, len(ALLERGENS), size=n)
+    spread = rng.lognormal(0.0, 0.45, size=(n, 3))
+    u = rng.random(n)
+    rows = []
+    for i in range(n):
+        role = roles[role_ix[i]]; _, (p, c, f), price, only_bf, every = ROLE_MIX[role]
+        meal_types = ["breakfast"] if u[i] < only_bf else (["breakfast", "dinner", "lunch"] if u[i] < only_bf + every
+                                                          else ["dinner", "lunch"])
+        P, C, F = (round(float(m * s), 1) for m, s in zip((p, c, f), spread[i]))
+        g = int(rng.choice(SERVINGS))
+        rows.append({"id": f"syn-{i:06d}", "name": f"Synthetic {role.replace('_', ' ')} {i} ({g}g)",
+                     "role": role, "category": role.split("_")[-1], "serving_size_g": g,
+                     "protein": P, "carbs": C, "fat": F, "sugar": 0.0, "fiber": 0.0,
+                     "kcal": round(4*P + 4*C + 9*F, 1),
+                     "price_per_serving": int(round(price * spread[i, 0] / 1000.0)) * 1000 or 1000,
+                     "meal_types": meal_types, "cuisine": list(CUISINE_LISTS[cuis_ix[i]][0]), "diet_tags": [],
+                     "allergens": [ALLERGENS[allergen_ix[i]]] if has_allergen[i] else [], "status": "active"})
+    return pd.DataFrame(rows)
+
+def synthetic_pairings(catalog: pd.DataFrame, per_row: float = 2.0, seed: int = 0) -> pd.DataFrame:
+    """Pairing table (ingredient_a, ingredient_b ids, pairing_score 1–10), mostly protein/carb × other roles."""
+    rng = np.random.default_rng(seed + 1)
+    ids = catalog["id"].to_numpy(); n = len(ids); m = int(n * per_row)
+    anchors = np.nonzero(catalog["role"].isin(["base_protein", "base_carb"]).to_numpy())[0]
+    a = anchors[rng.integers(0, len(anchors), size=m)] if len(anchors) else rng.integers(0, n, size=m)
+    b = rng.integers(0, n, size=m); keep = a != b
+    return pd.DataFrame({"ingredient_a": ids[a[keep]], "ingredient_b": ids[b[keep]],
+                         "pairing_score": rng.integers(1, 11, size=int(keep.sum()))})
+
+def pairing_sets(pairings: pd.DataFrame, catalog: pd.DataFrame, min_score: int = 5) -> List[set]:
+    """Same conversion as load_pairings_from_supabase: {name_a, name_b} for score >= min_score."""
+    names = dict(zip(catalog["id"], catalog["name"].astype(str).str.strip().str.lower()))
+    ok = pairings[pairings["pairing_score"] >= min_score]
+    return [{names[a], names[b]} for a, b in zip(ok["ingredient_a"], ok["ingredient_b"])]
+
+def write_csv(catalog: pd.DataFrame, path: str) -> None:
+    out = catalog.copy()
+    for col in ["meal_types", "cuisine", "diet_tags", "allergens"]:
+        out[col] = [json.dumps(v) for v in out[col]]
+    out.to_csv(path, index=False)
+
+# --------------- measurement ---------------
+def _percentiles(ms: List[float]) -> Dict[str, float]:
+    a = np.asarray(ms)
+    return {"min": float(a.min()), "p50": float(np.percentile(a, 50)), "p90": float(np.percentile(a, 90)),
+            "p99": float(np.percentile(a, 99)), "max": float(a.max()), "mean": float(a.mean())}
+
+def measure(fn: Callable[[], Any], repeats: int, units: float, unit: str, memory: bool = True,
+            warmup: int = 1) -> Dict[str, Any]:
+    """
+    Time `fn` `repeats` times after `warmup` untimed calls. Throughput is `units`
+    per second at the median latency. Peak memory comes from one extra call under
+    tracemalloc (numpy allocations are traced too), so tracing never skews timings.
+    """
+    for _ in range(warmup): fn()
+    ms = []
+    for _ in range(repeats):
+        t0 = time.perf_counter(); fn(); ms.append((time.perf_counter() - t0) * 1000.0)
+    lat = _percentiles(ms)
+    out: Dict[str, Any] = {"repeats": repeats, "latency_ms": lat,
+                           "throughput": {"unit": unit, "value": units / (lat["p50"] / 1000.0) if lat["p50"] else None}}
+    if memory:
+        import tracemalloc
+        tracemalloc.start(); fn(); _, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+        out["peak_mb"] = round(peak / 2**20, 3)
+    return out
+
+def _max_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+# ----------------- stages ------------------
+def bench_size(n: int, presets: List[str], repeats: int, week_repeats: int, seed: int, memory: bool,
+               allergens: List[str], P: float, C: float, F: float, workdir: str,
+               modes: Tuple[str, ...]) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    def rec(stage: str, params: Dict[str, Any], m: Dict[str, Any]) -> None:
+        results.append({"rows": n, "stage": stage, "params": params, **m})
+        lat = m["latency_ms"]
+        print(f"  {n:>6} {stage:<22} {json.dumps(params):<44} p50={lat['p50']:9.2f} ms  p90={lat['p90']:9.2f} ms",
+              file=sys.stderr, flush=True)
+
+    syn = synthetic_catalog(n, seed); pairs = pairing_sets(synthetic_pairings(syn, seed=seed), syn)
+    csv = os.path.join(workdir, f"catalog_{n}.csv"); write_csv(syn, csv)
+    rec("load_csv", {}, measure(lambda: ref.load_csv(csv), repeats, n, "rows/s", memory))
+
+    df = ref.load_csv(csv); cat = ref.build_catalog(df); pidx = ref.as_pairing_index(pairs)
+    rec("build_catalog", {}, measure(lambda: ref.build_catalog(df), repeats, n, "rows/s", memory))
+    rec("filter_pool", {"input": "frame", "allergens": allergens},
+        measure(lambda: [ref.filter_pool(df, s, allergens) for s in ref.SLOTS], repeats, 3, "pools/s", memory))
+    rec("filter_pool", {"input": "catalog", "allergens": allergens},
+        measure(lambda: [ref.filter_pool(cat, s, allergens) for s in ref.SLOTS], repeats, 3, "pools/s", memory))
+
+    pools = {s: ref.filter_pool(cat, s, allergens) for s in ref.SLOTS}
+    slot = "lunch"; pool = pools[slot]; tgt = ref.slot_targets(P, C, F, slot)
+    batch_n = max(ref.PRESETS[p][0] for p in presets)
+    rng = np.random.default_rng(seed)
+    if "scalar" in modes:
+        rec("generate_batch", {"slot": slot, "n": batch_n, "generator": "scalar"},
+            measure(lambda: ref.generate_batch(pool, slot, n=batch_n, rng=rng), repeats, batch_n, "candidates/s", memory))
+    if "batched" in modes:
+        rec("generate_batch", {"slot": slot, "n": batch_n, "generator": "batched"},
+            measure(lambda: ref.generate_batch_np(pool, slot, n=batch_n, rng=rng), repeats, batch_n, "candidates/s", memory))
+
+    batch = ref.generate_batch_np(pool, slot, n=batch_n, rng=np.random.default_rng(seed))
+    cands = batch.to_cands(); k = len(cands)
+    if "scalar" in modes:
+        rec("score", {"slot": slot, "n": k, "scorer": "scalar"},
+            measure(lambda: ref.score_slot(cands, slot, tgt, set(), {}, {}, pidx), repeats, k, "candidates/s", memory))
+    if "batched" in modes:
+        rec("score", {"slot": slot, "n": k, "scorer": "batched"},
+            measure(lambda: ref.score_slot_batch(batch, slot, tgt, set(), {}, {}, pidx), repeats, k, "candidates/s", memory))
+
+    lists = {}
+    for s in ref.SLOTS:
+        b = ref.generate_batch_np(pools[s], s, n=batch_n, rng=np.random.default_rng(seed))
+        lists[s] = ref.score_slot_batch(b, s, ref.slot_targets(P, C, F, s), set(), {}, {}, pidx)
+    for top_k in sorted({ref.PRESETS[p][1] for p in presets}):
+        B, L, D = (lists[s][:top_k] for s in ref.SLOTS)
+        triples = len(B) * len(L) * len(D)
+        rec("best_combo", {"top_k": top_k}, measure(lambda: ref.best_combo(B, L, D, P, C, F), repeats, triples,
+                                                     "combos/s", memory))
+
+    store = ref.CatalogStore(df, pairs)
+    for preset in presets:
+        for mode in modes:
+            run = lambda: ref.build_week_with_presets(store, P, C, F, allergens, preset=preset,
+                                                      batched=(mode == "batched"), seed=seed,
+                                                      solver="exact" if mode == "exact" else "sample")
+            rec("build_week", {"preset": preset, "generator": mode},
+                measure(run, week_repeats, 7, "days/s", memory, warmup=0))
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the weekly meal planner on synthetic catalogs")
+    ap.add_argument("--sizes", type=str, default="100,1000,10000", help="Comma-separated catalog sizes (rows)")
+    ap.add_argument("--presets", type=str, default=",".join(ref.PRESETS), help="Comma-separated presets for build_week")
+    ap.add_argument("--modes", type=str, default="scalar,batched",
+                    help="Generators to time: scalar, batched, exact (build_week only)")
+    ap.add_argument("--repeats", type=int, default=5, help="Timed runs per stage")
+    ap.add_argument("--week-repeats", type=int, default=3, help="Timed runs per build_week preset")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--allergens", type=str, default="dairy")
+    ap.add_argument("--P", type=float, default=150.0); ap.add_argument("--C", type=float, default=250.0)
+    ap.add_argument("--F", type=float, default=60.0)
+    ap.add_argument("--no-memory", action="store_true", help="Skip the traced-memory run per stage")
+    ap.add_argument("--out", type=str, default=None, help="Write the JSON report here (default: stdout)")
+    args = ap.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    presets = [p.strip() for p in args.presets.split(",") if p.strip()]
+    modes = tuple(m.strip() for m in args.modes.split(",") if m.strip())
+    for p in presets:
+        if p not in ref.PRESETS: ap.error(f"unknown preset {p!r}; choose from {list(ref.PRESETS)}")
+    for m in modes:
+        if m not in ("scalar", "batched", "exact"): ap.error(f"unknown mode {m!r}")
+    allergens = [a.strip().lower() for a in args.allergens.split(",") if a.strip()]
+
+    t0 = time.time(); results: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in sizes:
+            results += bench_size(n, presets, args.repeats, args.week_repeats, args.seed, not args.no_memory,
+                                  allergens, args.P, args.C, args.F, workdir, modes)
+    report = {
+        "benchmark": "meal-planner", "format": 1,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t0)), "wall_s": round(time.time() - t0, 2),
+        "env": {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                "platform": platform.platform(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "config": {"sizes": sizes, "presets": presets, "modes": list(modes), "repeats": args.repeats,
+                   "week_repeats": args.week_repeats, "seed": args.seed, "allergens": allergens,
+                   "targets": {"P": args.P, "C": args.C, "F": args.F}, "memory": not args.no_memory},
+        "results": results, "max_rss_mb": _max_rss_mb(),
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        outp = Path(args.out); outp.parent.mkdir(parents=True, exist_ok=True)
+        outp.write_text(text + "\n", encoding="utf-8")
+        print(f"[OK] Saved: {outp}", file=sys.stderr)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
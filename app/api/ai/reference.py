@@ -15,13 +15,31 @@ Run:
     --P 150 --C 250 --F 60 \
     --allergens "gluten,dairy" \
     --out runs/weekly_plan.json
+
+  Add `--preset deep --batched` for the larger search with the vectorized generator.
+  `--solver exact` builds meals by a DP over discretized macros instead of sampling.
+  Rolling horizon: `--days 28 --state runs/state.json` (later runs continue from the state).
+  Batch mode: `--batch requests.jsonl --workers 8 --out runs/plans.jsonl`.
+  Server mode: `--serve --port 8765` (POST /plan, POST /reload, GET /health).
+  `--timings` prints import / load / run times to stderr.
+
+The planner itself runs on numpy arrays (Catalog); pandas is only imported by the
+DataFrame loaders (load_csv, Supabase), so the CLI starts without it.
 """
-import argparse, json, math, os
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from __future__ import annotations
+import argparse, contextvars, json, math, os, sys, time
+_IMPORT_T0 = time.perf_counter()  # --timings: module import starts here
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
-import numpy as np, pandas as pd
+import numpy as np
+if TYPE_CHECKING:
+    import pandas as pd
 
+# Default generator for callers that pass neither `rng` nor `seed`. Seeded plans use
+# independent SeedSequence streams per day and slot instead (see slot_rngs).
 RNG = np.random.default_rng(12345)
 
 SLOTS = ["breakfast", "lunch", "dinner"]
@@ -50,8 +68,16 @@ COMPOSITION = {
 }
 BAN_KEYWORDS = [("whey","blueberry"), ("soba","blueberry"), ("noodle","blueberry")]
 
+# Meal types and allergens are encoded once at load time as integer bitmasks so that
+# pool filtering is a single vectorized expression. An empty meal_types list means
+# "any slot", so it gets every bit set.
+MEAL_BITS = {m: 1 << i for i, m in enumerate(SLOTS + ["universal"])}
+MEAL_ANY = sum(MEAL_BITS.values())
+MAX_ALLERGEN_BITS = 63
+
 # -------------------- IO --------------------
 def load_csv(csv_path: str) -> pd.DataFrame:
+    import pandas as pd
     df = pd.read_csv(csv_path)
     for col in ["meal_types","cuisine","diet_tags","allergens"]:
         if col in df.columns:
@@ -60,48 +86,150 @@ def load_csv(csv_path: str) -> pd.DataFrame:
             df[col] = [[] for _ in range(len(df))]
     for col in ["protein","carbs","fat","sugar","fiber","kcal","price_per_serving"]:
         if col in df.columns:
-            df[col] = df[col].fillna(0.0).astype(float)
+            v = df[col].fillna(0.0).astype(float)
+            df[col] = v.where(np.isfinite(v), 0.0)
         else:
             df[col] = 0.0
     df["name_lc"] = df["name"].astype(str).str.lower()
     df["role"] = df.get("role", "other")
     df["category"] = df.get("category", "other")
-    return df
+    return _encode_masks(df)
 
-def load_from_supabase(supabase_url: str, api_key: str, table: str = "ingredient") -> pd.DataFrame:
+# pandas.read_csv's default na_values: cells read_csv_catalog treats as missing too.
+_CSV_NA = frozenset(["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                     "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"])
+
+def _csv_float(v: Optional[str]) -> float:
+    if v is None: return 0.0
+    x = float(v)
+    return x if math.isfinite(x) else 0.0
+
+def read_csv_catalog(csv_path: str) -> Catalog:
     """
-    Fetch rows from Supabase REST API and normalize to the same DataFrame shape
-    expected by the generator. Uses the project's anon/service key as `api_key`.
+    build_catalog(load_csv(csv_path)) without pandas: the CSV is read with the csv
+    module and normalized the same way straight into a Catalog. Empty cells and
+    pandas' default NA tokens ("NaN", "N/A", "null", ...) read as missing (0.0,
+    [], role "other"); non-finite numbers read as 0.0, as in load_csv.
+    """
+    import csv
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        rows = [{k: (None if v in _CSV_NA else v) for k, v in r.items()} for r in csv.DictReader(f)]
+    n = len(rows)
+    lists = {c: [_parse_list(r.get(c)) for r in rows] for c in ("meal_types", "cuisine", "allergens")}
+    num = lambda c: np.asarray([_csv_float(r.get(c)) for r in rows], dtype=np.float64)
+    meal_mask, allergen_mask, bits = _mask_arrays(lists["meal_types"], lists["allergens"])
+    roles = [r.get("role") or "other" for r in rows]
+    return Catalog(
+        ids=np.arange(n, dtype=np.int64), keys=[r.get("id") or None for r in rows],
+        names=[r.get("name") or "" for r in rows], roles=roles, cuisines=lists["cuisine"],
+        allergens=[[a.strip().lower() for a in x if a.strip()] for x in lists["allergens"]],
+        protein=num("protein"), carbs=num("carbs"), fat=num("fat"), kcal=num("kcal"), price=num("price_per_serving"),
+        meal_mask=meal_mask, allergen_mask=allergen_mask, allergen_bits=bits, by_role=_group_by_role(roles),
+    )
 
-    Example SUPABASE_URL: https://<project_ref>.supabase.co
-    Endpoint: {SUPABASE_URL}/rest/v1/{table}?select=*
+# Only the columns the generator uses are requested from PostgREST.
+INGREDIENT_COLUMNS = ["id", "name", "role", "category", "protein", "carbs", "fat", "sugar", "fiber", "kcal",
+                      "price_per_serving", "meal_types", "cuisine", "diet_tags", "allergens", "updated_at"]
+PAIRING_COLUMNS = ["ingredient_a", "ingredient_b", "pairing_score"]
+
+class NotModified(Exception):
+    """Raised by SupabaseREST.pages when the server answers 304 to If-None-Match."""
 
-    This function avoids adding external dependencies by using urllib from the
-    standard library and json for parsing.
+class SupabaseREST:
     """
-    import urllib.request
-    import urllib.error
+    Minimal PostgREST client over one persistent HTTP(S) connection (stdlib only).
+    Tables are read in pages with Range headers; `timeout` applies per request,
+    so large tables no longer have to arrive within a single deadline.
+    """
+    def __init__(self, supabase_url: str, api_key: str, timeout: float = 30.0, page_size: int = 1000):
+        from urllib.parse import urlsplit
+        u = urlsplit(supabase_url.rstrip("/"))
+        self.scheme, self.host, self.base = u.scheme or "https", u.netloc, u.path
+        self.timeout = timeout; self.page_size = page_size
+        self.headers = {"apikey": api_key, "Authorization": f"Bearer {api_key}", "Accept": "application/json"}
+        self.etag: Optional[str] = None  # ETag of the last first page fetched
+        self._conn = None
 
-    url = supabase_url.rstrip("/") + f"/rest/v1/{table}?select=*"
-    headers = {
-        "apikey": api_key,
-        "Authorization": f"Bearer {api_key}",
-        "Accept": "application/json",
-    }
-    req = urllib.request.Request(url, headers=headers)
-    try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            data = json.load(resp)
-    except urllib.error.HTTPError as e:
-        raise RuntimeError(f"Supabase request failed: {e.code} {e.reason}")
-    except Exception as e:
-        raise RuntimeError(f"Supabase request error: {e}")
+    def _connect(self):
+        import http.client
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        self._conn = cls(self.host, timeout=self.timeout)
+        return self._conn
 
-    if not isinstance(data, list):
-        raise RuntimeError("Unexpected response from Supabase; expected a JSON list of rows")
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close(); self._conn = None
 
-    df = pd.DataFrame(data)
+    def __enter__(self) -> "SupabaseREST":
+        return self
 
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def request(self, path: str, headers: Dict[str,str]) -> Tuple[int, Dict[str,str], bytes]:
+        import http.client
+        for attempt in (0, 1):  # reconnect once if the kept-alive connection was dropped
+            conn = self._conn or self._connect()
+            try:
+                conn.request("GET", path, headers={**self.headers, **headers})
+                resp = conn.getresponse()
+                body = resp.read()
+                return resp.status, {k.lower(): v for k, v in resp.getheaders()}, body
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.CannotSendRequest,
+                    http.client.BadStatusLine):
+                self.close()
+                if attempt: raise
+        raise RuntimeError("unreachable")
+
+    def pages(self, table: str, columns: Optional[List[str]] = None, filters: Optional[Dict[str,str]] = None,
+              order: str = "id.asc", if_none_match: Optional[str] = None) -> Iterator[List[Dict[str,Any]]]:
+        """
+        Yield the rows of `table` page by page. `filters` are PostgREST filters such
+        as {"updated_at": "gt.2025-01-01T00:00:00"}. With if_none_match, a 304 on the
+        first page raises NotModified. A short page does not end the read (the
+        server's max-rows may be below page_size): paging stops at an empty page,
+        a 416, or the total of a Content-Range header that carries one.
+        """
+        from urllib.parse import quote, urlencode
+        q = {"select": ",".join(columns) if columns else "*", "order": order, **(filters or {})}
+        path = f"{self.base}/rest/v1/{table}?" + urlencode(q, quote_via=quote, safe=",.*")
+        start = 0
+        while True:
+            hdrs = {"Range-Unit": "items", "Range": f"{start}-{start + self.page_size - 1}"}
+            if start == 0 and if_none_match: hdrs["If-None-Match"] = if_none_match
+            try:
+                status, rh, body = self.request(path, hdrs)
+            except Exception as e:
+                raise RuntimeError(f"Supabase request error: {e}")
+            if status == 304: raise NotModified()
+            if status == 416: return  # range past the end
+            if status >= 400:
+                raise RuntimeError(f"Supabase request failed: {status} {body[:200].decode('utf-8', 'replace')}")
+            if start == 0: self.etag = rh.get("etag")
+            page = json.loads(body)
+            if not isinstance(page, list):
+                raise RuntimeError("Unexpected response from Supabase; expected a JSON list of rows")
+            if not page: return
+            yield page
+            start += len(page)
+            total = rh.get("content-range", "").rpartition("/")[2]
+            if total.isdigit() and start >= int(total): return
+
+def _collect_columns(pages: Iterable[List[Dict[str,Any]]], columns: Optional[List[str]]) -> Dict[str, List[Any]]:
+    """Decode pages incrementally into per-column lists (rows are not kept)."""
+    cols: Dict[str, List[Any]] = {c: [] for c in columns or []}
+    n = 0
+    for page in pages:
+        for row in page:
+            for k in row.keys() - cols.keys():
+                cols[k] = [None] * n
+            for k, v in cols.items():
+                v.append(row.get(k))
+            n += 1
+    return cols
+
+def _normalize_rest_frame(df: pd.DataFrame) -> pd.DataFrame:
+    import pandas as pd
     # Normalize array/list columns
     for col in ["meal_types", "cuisine", "diet_tags", "allergens"]:
         if col in df.columns:
@@ -119,62 +247,160 @@ def load_from_supabase(supabase_url: str, api_key: str, table: str = "ingredient
     df["name_lc"] = df["name"].astype(str).str.lower()
     df["role"] = df.get("role", "other")
     df["category"] = df.get("category", "other")
+    return _encode_masks(df)
+
+def load_from_supabase(supabase_url: str, api_key: str, table: str = "ingredient",
+                       columns: Optional[List[str]] = INGREDIENT_COLUMNS, page_size: int = 1000,
+                       timeout: float = 30.0, client: Optional[SupabaseREST] = None) -> pd.DataFrame:
+    """
+    Fetch rows from Supabase REST API and normalize to the same DataFrame shape
+    expected by the generator. Uses the project's anon/service key as `api_key`.
+
+    Example SUPABASE_URL: https://<project_ref>.supabase.co
+    Endpoint: {SUPABASE_URL}/rest/v1/{table}?select=<columns>&order=id.asc, read in
+    pages of `page_size` rows over one connection (pass `client` to reuse it across
+    calls). `columns=None` selects everything.
+
+    The returned frame carries `attrs["etag"]` and `attrs["watermark"]` (max
+    updated_at) for refresh_from_supabase. Stdlib only (http.client + json).
+    """
+    import pandas as pd
+    own = client is None
+    client = client or SupabaseREST(supabase_url, api_key, timeout=timeout, page_size=page_size)
+    try:
+        cols = _collect_columns(client.pages(table, columns), columns)
+    finally:
+        if own: client.close()
+    df = _normalize_rest_frame(pd.DataFrame(cols))
+    df.attrs["etag"] = client.etag
+    df.attrs["watermark"] = _watermark(df)
     return df
 
+def _watermark(df: pd.DataFrame) -> Optional[str]:
+    if "updated_at" not in df.columns: return None
+    import pandas as pd
+    vals = [v for v in df["updated_at"].tolist() if isinstance(v, str) and v]
+    return max(vals, key=lambda v: pd.Timestamp(v)) if vals else None
+
+def refresh_from_supabase(df: pd.DataFrame, supabase_url: str, api_key: str, table: str = "ingredient",
+                          columns: Optional[List[str]] = INGREDIENT_COLUMNS, page_size: int = 1000,
+                          timeout: float = 30.0, client: Optional[SupabaseREST] = None) -> Tuple[pd.DataFrame, int]:
+    """
+    Conditional refresh of a frame from load_from_supabase: only rows with
+    updated_at past the frame's watermark are fetched and upserted by id.
+    Returns (frame, rows changed). When nothing changed, the returned frame
+    remembers the ETag of the (empty) watermark query in
+    attrs["watermark_etag"]; repeating the refresh with it sends the same query
+    with If-None-Match, and a 304 returns the frame as-is. Deletions are not
+    visible to a watermark, so schedule an occasional full load_from_supabase.
+    """
+    import pandas as pd
+    mark = df.attrs.get("watermark")
+    if not mark:
+        new = load_from_supabase(supabase_url, api_key, table, columns, page_size, timeout, client)
+        return new, len(new)
+    own = client is None
+    client = client or SupabaseREST(supabase_url, api_key, timeout=timeout, page_size=page_size)
+    try:
+        cols = _collect_columns(client.pages(table, columns, filters={"updated_at": f"gt.{mark}"},
+                                             if_none_match=df.attrs.get("watermark_etag")), columns)
+    except NotModified:
+        return df, 0
+    finally:
+        if own: client.close()
+    changed = _normalize_rest_frame(pd.DataFrame(cols))
+    if len(changed) == 0:
+        same = df.copy(deep=False)
+        same.attrs["watermark_etag"] = client.etag  # same query next time, so a 304 can match
+        return same, 0
+    keep = ~df["id"].astype(str).isin(set(changed["id"].astype(str)))
+    merged = pd.concat([df[keep], changed[[c for c in df.columns if c in changed.columns]]], ignore_index=True)
+    merged = _encode_masks(merged)
+    merged.attrs["etag"] = df.attrs.get("etag")
+    merged.attrs["watermark_etag"] = None  # the watermark moved, so the next query differs
+    merged.attrs["watermark"] = max(filter(None, [mark, _watermark(changed)]), key=lambda v: pd.Timestamp(v))
+    return merged, len(changed)
+
 def load_pairings_from_supabase(supabase_url: str, api_key: str, ingredient_df: pd.DataFrame, 
-                                 min_score: int = 5) -> List[set]:
+                                 min_score: int = 5, page_size: int = 1000, timeout: float = 30.0,
+                                 client: Optional[SupabaseREST] = None) -> List[set]:
     """
     Fetch pairing table from Supabase, join ingredient names, and return as list of sets.
-    Only includes pairings with pairing_score >= min_score.
+    Only includes pairings with pairing_score >= min_score (filtered server-side).
     
     Returns: list of sets, where each set contains two lowercased ingredient names that form a validated pair.
     """
-    import urllib.request
-    import urllib.error
-
-    url = supabase_url.rstrip("/") + f"/rest/v1/pairing?select=*"
-    headers = {
-        "apikey": api_key,
-        "Authorization": f"Bearer {api_key}",
-        "Accept": "application/json",
-    }
-    req = urllib.request.Request(url, headers=headers)
-    try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            data = json.load(resp)
-    except urllib.error.HTTPError as e:
-        raise RuntimeError(f"Supabase pairing request failed: {e.code} {e.reason}")
-    except Exception as e:
-        raise RuntimeError(f"Supabase pairing request error: {e}")
-
-    if not isinstance(data, list):
-        raise RuntimeError("Unexpected response from Supabase pairing table")
+    own = client is None
+    client = client or SupabaseREST(supabase_url, api_key, timeout=timeout, page_size=page_size)
 
     # Build a map from ingredient id (UUID) to name (lowercased)
-    id_to_name = {}
-    for _, row in ingredient_df.iterrows():
-        ing_id = row.get("id")
-        if ing_id:
-            id_to_name[str(ing_id)] = str(row.get("name", "")).strip().lower()
+    ids = ingredient_df["id"].tolist() if "id" in ingredient_df.columns else []
+    id_to_name = {str(i): str(n).strip().lower() for i, n in zip(ids, ingredient_df["name"].tolist()) if i}
 
     # Convert pairings: for each row with score >= min_score, create a set of two names
     validated_pairings = []
-    for row in data:
-        try:
-            score = int(row.get("pairing_score", 0))
-            if score < min_score:
-                continue
-            ing_a_id = str(row.get("ingredient_a", ""))
-            ing_b_id = str(row.get("ingredient_b", ""))
-            name_a = id_to_name.get(ing_a_id)
-            name_b = id_to_name.get(ing_b_id)
-            if name_a and name_b:
-                validated_pairings.append({name_a, name_b})
-        except Exception:
-            continue
+    try:
+        for page in client.pages("pairing", PAIRING_COLUMNS, filters={"pairing_score": f"gte.{int(min_score)}"},
+                                 order="ingredient_a.asc,ingredient_b.asc"):
+            for row in page:
+                try:
+                    score = int(row.get("pairing_score", 0))
+                    if score < min_score:
+                        continue
+                    name_a = id_to_name.get(str(row.get("ingredient_a", "")))
+                    name_b = id_to_name.get(str(row.get("ingredient_b", "")))
+                    if name_a and name_b:
+                        validated_pairings.append({name_a, name_b})
+                except Exception:
+                    continue
+    except RuntimeError as e:
+        raise RuntimeError(str(e).replace("Supabase request", "Supabase pairing request"))
+    finally:
+        if own: client.close()
 
     return validated_pairings
 
+def _encode_masks(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add integer `meal_mask` / `allergen_mask` columns. The allergen vocabulary
+    (normalized name -> bit) is stored in `df.attrs["allergen_bits"]`.
+    """
+    meal_mask, allergen_mask, bits = _mask_arrays(df["meal_types"], df["allergens"])
+    df["meal_mask"] = meal_mask
+    df["allergen_mask"] = allergen_mask
+    df.attrs["allergen_bits"] = bits
+    return df
+
+def _mask_arrays(meal_types: Iterable[List[str]],
+                 allergens: Iterable[List[str]]) -> Tuple[np.ndarray, np.ndarray, Dict[str,int]]:
+    """(meal_mask, allergen_mask, allergen_bits) for per-row meal type and allergen lists."""
+    meal_mask = np.asarray([meal_type_mask(mts) for mts in meal_types], dtype=np.int64)
+
+    norm = [{a.strip().lower() for a in (als or [])} - {""} for als in allergens]
+    vocab = sorted(set().union(*norm)) if norm else []
+    if len(vocab) > MAX_ALLERGEN_BITS:
+        raise ValueError(f"Too many distinct allergens to encode ({len(vocab)} > {MAX_ALLERGEN_BITS})")
+    bits = {a: 1 << i for i, a in enumerate(vocab)}
+    allergen_mask = np.zeros(len(norm), dtype=np.int64)
+    for i, als in enumerate(norm):
+        m = 0
+        for a in als: m |= bits[a]
+        allergen_mask[i] = m
+    return meal_mask, allergen_mask, bits
+
+def meal_type_mask(meal_types: List[str]) -> int:
+    if not meal_types: return MEAL_ANY
+    m = 0
+    for mt in meal_types: m |= MEAL_BITS.get(mt, 0)
+    return m
+
+def allergen_query_mask(allergens: List[str], bits: Dict[str,int]) -> int:
+    """OR of the bits for the requested allergens; unknown allergens match nothing."""
+    m = 0
+    for a in allergens:
+        m |= bits.get(a.strip().lower(), 0)
+    return m
+
 def _parse_list(x: Any) -> List[str]:
     if isinstance(x, list): return [str(i) for i in x]
     if isinstance(x, str):
@@ -188,24 +414,215 @@ def _parse_list(x: Any) -> List[str]:
         return [s]
     return []
 
+# ------------- instrumentation -------------
+_PROFILE: "contextvars.ContextVar[Optional[Profile]]" = contextvars.ContextVar("planner_profile", default=None)
+_SLOT_REC: "contextvars.ContextVar[Optional[Dict[str,Any]]]" = contextvars.ContextVar("planner_slot", default=None)
+
+def _slot_counters(rows: int = 0) -> Dict[str,Any]:
+    return {"pool_rows": rows, "pool_ms": 0.0, "generate_ms": 0.0, "score_ms": 0.0, "attempts": 0, "accepted": 0,
+            "rejected": {"banned": 0, "no_cuisine": 0}, "duplicates": 0}
+
+class Profile:
+    """
+    Opt-in stage timers and counters for one plan, activated with `with profiling():`.
+    Planners look the active profile up once per day / slot and the generators only
+    when they reject a draw, so with none active the overhead is a few
+    context-variable reads per slot.
+      days[i]  = {"day", "slots": {slot: counters}, "combo_ms", "combos"}
+                 attempts counts every drawn row (the batched generator draws surplus
+                 rows per round); stage times are summed over slot threads, so with
+                 parallel slots they can add up to more than total_ms.
+      hooks    = callables (metric, value, tags) fed as each day closes and once with
+                 the totals, e.g. to forward to a metrics pipeline. A failing hook is
+                 counted in hook_errors, never raised into the planner.
+    """
+    def __init__(self, hooks: Iterable[Any] = ()):
+        import threading, time
+        self.hooks = list(hooks); self.days: List[Dict[str,Any]] = []; self.hook_errors = 0
+        self._lock = threading.Lock(); self._t0 = time.perf_counter()
+
+    def day(self) -> Dict[str,Any]:
+        with self._lock:
+            rec = {"day": len(self.days) + 1, "slots": {}, "combo_ms": 0.0, "combos": 0}
+            self.days.append(rec)
+        return rec
+
+    def slot(self, day: Dict[str,Any], slot: str) -> Dict[str,Any]:
+        with self._lock:
+            return day["slots"].setdefault(slot, _slot_counters())
+
+    def _emit(self, metric: str, value: float, tags: Dict[str,Any]) -> None:
+        for h in self.hooks:
+            try:
+                h(metric, value, tags)
+            except Exception:
+                self.hook_errors += 1
+
+    def close_day(self, day: Dict[str,Any]) -> None:
+        if not self.hooks: return
+        for slot, c in day["slots"].items():
+            tags = {"day": day["day"], "slot": slot}
+            for k in ("pool_ms", "generate_ms", "score_ms", "attempts", "accepted", "duplicates"):
+                self._emit(f"planner.slot.{k}", c[k], tags)
+            for why, v in c["rejected"].items():
+                self._emit("planner.slot.rejected", v, {**tags, "reason": why})
+        self._emit("planner.day.combo_ms", day["combo_ms"], {"day": day["day"]})
+        self._emit("planner.day.combos", day["combos"], {"day": day["day"]})
+
+    def report(self) -> Dict[str,Any]:
+        """The "diagnostics" block: totals per stage and counter, plus the per-day records."""
+        import time
+        tot = _slot_counters(); combo_ms = 0.0; combos = 0
+        for d in self.days:
+            combo_ms += d["combo_ms"]; combos += d["combos"]
+            for c in d["slots"].values():
+                for k in ("pool_ms", "generate_ms", "score_ms", "attempts", "accepted", "duplicates"): tot[k] += c[k]
+                for why, v in c["rejected"].items(): tot["rejected"][why] += v
+        stages = {k: round(tot[k], 3) for k in ("pool_ms", "generate_ms", "score_ms")}
+        stages["combo_ms"] = round(combo_ms, 3)
+        return {"total_ms": round((time.perf_counter() - self._t0) * 1000, 3), "stages": stages,
+                "counters": {"attempts": tot["attempts"], "accepted": tot["accepted"], "rejected": tot["rejected"],
+                             "duplicates": tot["duplicates"], "combos": combos},
+                "days": self.days, "hook_errors": self.hook_errors}
+
+    def finish(self) -> None:
+        if not self.hooks: return
+        rep = self.report()
+        self._emit("planner.plan.total_ms", rep["total_ms"], {})
+        for k, v in rep["stages"].items(): self._emit(f"planner.plan.{k}", v, {})
+        for k in ("attempts", "accepted", "duplicates", "combos"): self._emit(f"planner.plan.{k}", rep["counters"][k], {})
+
+@contextmanager
+def profiling(hooks: Iterable[Any] = ()) -> Iterator[Profile]:
+    """Activate a Profile for the planning done inside the block (joins an already active one)."""
+    active = _PROFILE.get()
+    if active is not None:
+        active.hooks.extend(hooks); yield active; return
+    prof = Profile(hooks); token = _PROFILE.set(prof)
+    try:
+        yield prof
+    finally:
+        _PROFILE.reset(token); prof.finish()
+
+def _timed(rec: Optional[Dict[str,Any]], key: str, fn: Any, *args: Any, **kw: Any) -> Any:
+    if rec is None: return fn(*args, **kw)
+    import time
+    t0 = time.perf_counter()
+    try:
+        return fn(*args, **kw)
+    finally:
+        rec[key] += (time.perf_counter() - t0) * 1000.0
+
+def _count_reject(reason: str) -> None:
+    rec = _SLOT_REC.get()
+    if rec is not None: rec["rejected"][reason] += 1
+
 # ---------------- candidate ----------------
 @dataclass
 class Cand:
     names: List[str]; roles: List[str]; cuisines: List[str]
     P: float; C: float; F: float; kcal: float; price: float; allergens: List[str]
+    idx: Optional[np.ndarray] = None  # catalog rows the candidate was built from
+    sig: Optional[int] = None         # meal_signature(names), filled in where the catalog is at hand
+
+_SIG_MASK = (1 << 64) - 1
+
+@lru_cache(maxsize=1 << 16)
+def _name_key(name: str) -> int:
+    """Stable 64-bit key of an ingredient name, the same in every pool and process."""
+    import hashlib
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little")
+
+def meal_signature(names: Iterable[str]) -> int:
+    """
+    64-bit signature of a meal's ingredient multiset (what no_repeat_signatures
+    holds): the wrapping sum of its name keys, so it needs no sorting and a
+    whole batch gets its signatures from one vectorized sum.
+    """
+    return sum(_name_key(n) for n in names) & _SIG_MASK
+
+def cand_signature(c: "Cand") -> int:
+    return meal_signature(c.names) if c.sig is None else c.sig
+
+@dataclass
+class Catalog:
+    """
+    Compact, array-backed ingredient table built once per pool (or once for the
+    whole catalog, e.g. from a snapshot). Rows are addressed by integer position;
+    candidates are index arrays into it.
+    """
+    ids: np.ndarray                    # 0..n-1
+    keys: List[Any]                    # original ingredient ids (uuid)
+    names: List[str]; roles: List[str]
+    cuisines: List[List[str]]; allergens: List[List[str]]
+    protein: np.ndarray; carbs: np.ndarray; fat: np.ndarray; kcal: np.ndarray; price: np.ndarray
+    meal_mask: np.ndarray; allergen_mask: np.ndarray; allergen_bits: Dict[str,int]
+    by_role: Dict[str, np.ndarray]
+    cache: Dict[str, Any] = field(default_factory=dict, repr=False)  # lazily built lookup tables
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def take(self, rows: np.ndarray) -> "Catalog":
+        """Sub-catalog of the given rows (renumbered from 0)."""
+        rl = [int(i) for i in rows]; roles = [self.roles[i] for i in rl]
+        return Catalog(
+            ids=np.arange(len(rl), dtype=np.int64), keys=[self.keys[i] for i in rl],
+            names=[self.names[i] for i in rl], roles=roles,
+            cuisines=[self.cuisines[i] for i in rl], allergens=[self.allergens[i] for i in rl],
+            protein=self.protein[rows], carbs=self.carbs[rows], fat=self.fat[rows],
+            kcal=self.kcal[rows], price=self.price[rows],
+            meal_mask=self.meal_mask[rows], allergen_mask=self.allergen_mask[rows],
+            allergen_bits=self.allergen_bits, by_role=_group_by_role(roles),
+        )
+
+def _group_by_role(roles: List[str]) -> Dict[str, np.ndarray]:
+    by_role: Dict[str, List[int]] = {}
+    for i, r in enumerate(roles):
+        by_role.setdefault(r, []).append(i)
+    return {r: np.asarray(ix, dtype=np.int64) for r, ix in by_role.items()}
+
+def build_catalog(pool: pd.DataFrame) -> Catalog:
+    if "meal_mask" not in pool.columns or "allergen_bits" not in pool.attrs:
+        pool = _encode_masks(pool.copy())
+    n = len(pool)
+    roles = [str(r) for r in pool["role"].tolist()]
+    col = lambda c: np.ascontiguousarray(pool[c].to_numpy(dtype=np.float64))
+    return Catalog(
+        ids=np.arange(n, dtype=np.int64),
+        keys=pool["id"].tolist() if "id" in pool.columns else [None]*n,
+        names=[str(x) for x in pool["name"].tolist()], roles=roles,
+        cuisines=[list(x or []) for x in pool["cuisine"].tolist()],
+        allergens=[[a.strip().lower() for a in (x or []) if a.strip()] for x in pool["allergens"].tolist()],
+        protein=col("protein"), carbs=col("carbs"), fat=col("fat"), kcal=col("kcal"),
+        price=col("price_per_serving"),
+        meal_mask=pool["meal_mask"].to_numpy(dtype=np.int64),
+        allergen_mask=pool["allergen_mask"].to_numpy(dtype=np.int64),
+        allergen_bits=dict(pool.attrs["allergen_bits"]),
+        by_role=_group_by_role(roles),
+    )
+
+def _as_catalog(pool: Any) -> Catalog:
+    return pool if isinstance(pool, Catalog) else build_catalog(pool)
+
+def _allergen_bits(df: Any) -> Dict[str,int]:
+    return df.allergen_bits if isinstance(df, Catalog) else df.attrs["allergen_bits"]
 
 def filter_pool(df: pd.DataFrame, slot: str, allergens: List[str]) -> pd.DataFrame:
-    aset = set(a.strip().lower() for a in allergens if a.strip())
-    ok = []
-    for _, r in df.iterrows():
-        mts = r["meal_types"] or []
-        if not (slot in mts or "universal" in mts or len(mts)==0):
-            ok.append(False); continue
-        r_all = set(a.strip().lower() for a in (r["allergens"] or []))
-        if aset and r_all.intersection(aset):
-            ok.append(False); continue
-        ok.append(True)
-    return df[pd.Series(ok).values].copy().reset_index(drop=True)
+    """Rows usable for `slot` without the given allergens; a Catalog in gives a Catalog out."""
+    if isinstance(df, Catalog):
+        ok = (df.meal_mask & (MEAL_BITS.get(slot, 0) | MEAL_BITS["universal"])) != 0
+        amask = allergen_query_mask(allergens, df.allergen_bits)
+        if amask:
+            ok &= (df.allergen_mask & amask) == 0
+        return df.take(np.nonzero(ok)[0])
+    if "meal_mask" not in df.columns or "allergen_bits" not in df.attrs:
+        df = _encode_masks(df.copy())
+    ok = (df["meal_mask"].to_numpy() & (MEAL_BITS.get(slot, 0) | MEAL_BITS["universal"])) != 0
+    amask = allergen_query_mask(allergens, df.attrs["allergen_bits"])
+    if amask:
+        ok &= (df["allergen_mask"].to_numpy() & amask) == 0
+    return df[ok].copy().reset_index(drop=True)
 
 def banned(names: List[str]) -> bool:
     s = " ".join(n.lower() for n in names)
@@ -225,45 +642,81 @@ def cuisine_majority(c_lists: List[List[str]]) -> List[str]:
         return [max(counts.items(), key=lambda kv: kv[1])[0]]
     return ["universal"] if has_uni else []
 
-def role_index(pool: pd.DataFrame) -> Dict[str, List[Dict[str,Any]]]:
-    idx: Dict[str, List[Dict[str,Any]]] = {}
-    for _, r in pool.iterrows():
-        idx.setdefault(str(r["role"]), []).append(r.to_dict())
-    return idx
+def role_index(pool: Any) -> Dict[str, np.ndarray]:
+    return _as_catalog(pool).by_role
 
-def sample_unique(items: List[Dict[str,Any]], k: int) -> List[Dict[str,Any]]:
-    if k<=0 or not items: return []
+def _cuisine_index(cat: Catalog) -> Dict[str, Any]:
+    """
+    Per-catalog partition of rows by (role, cuisine), built on first use:
+      parts:     {role or None (all rows): {cuisine: rows}}, "universal" is its own bucket
+      majority:  cuisine_majority over the whole pool
+      preferred: memo of (role, cuisine) -> rows matching the cuisine or universal
+    Row arrays are ascending, like by_role, so draws from them match a filtered by_role.
+    """
+    t = cat.cache.get("cuisine_index")
+    if t is not None: return t
+    parts: Dict[Optional[str], Dict[str, List[int]]] = {}
+    for i, (r, cs) in enumerate(zip(cat.roles, cat.cuisines)):
+        for c in dict.fromkeys(cs):
+            parts.setdefault(r, {}).setdefault(c, []).append(i)
+            parts.setdefault(None, {}).setdefault(c, []).append(i)
+    t = {"parts": {r: {c: np.asarray(ix, dtype=np.int64) for c, ix in d.items()} for r, d in parts.items()},
+         "majority": cuisine_majority(cat.cuisines), "preferred": {}}
+    cat.cache["cuisine_index"] = t
+    return t
+
+def _preferred_rows(cat: Catalog, role: Optional[str], cuisine: str) -> np.ndarray:
+    """Rows of `role` (None: any role) tagged with `cuisine` or universal, ascending."""
+    t = _cuisine_index(cat); key = (role, cuisine)
+    rows = t["preferred"].get(key)
+    if rows is None:
+        d = t["parts"].get(role, {}); empty = cat.ids[:0]
+        rows = t["preferred"][key] = np.union1d(d.get(cuisine, empty), d.get("universal", empty)).astype(np.int64)
+    return rows
+
+def _rng(rng: Optional[np.random.Generator]) -> np.random.Generator:
+    return RNG if rng is None else rng
+
+def sample_unique(items: np.ndarray, k: int, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    if k<=0 or len(items)==0: return items[:0]
     k = min(k, len(items))
-    sel = RNG.choice(len(items), size=k, replace=False)
-    return [items[int(i)] for i in sel]
+    sel = _rng(rng).choice(len(items), size=k, replace=False)
+    return items[sel]
+
+def _unused(rows: np.ndarray, used: List[int]) -> np.ndarray:
+    return rows[~np.isin(rows, used)] if used else rows
 
-def sample_candidate(pool: pd.DataFrame, slot: str) -> Optional[Cand]:
-    comp = COMPOSITION[slot]; idx = role_index(pool)
-    mn, mx = comp["total_range"]; target = int(RNG.integers(mn, mx+1))
-    picks: List[Dict[str,Any]] = []; used=set()
+def sample_candidate(pool: Any, slot: str, cat: Optional[Catalog] = None,
+                     rng: Optional[np.random.Generator] = None) -> Optional[Cand]:
+    """`cat` lets callers reuse one catalog across many draws from the same pool."""
+    comp = COMPOSITION[slot]; rng = _rng(rng)
+    if cat is None: cat = _as_catalog(pool)
+    idx = cat.by_role; empty = cat.ids[:0]
+    mn, mx = comp["total_range"]; target = int(rng.integers(mn, mx+1))
+    picks: List[int] = []
 
     # required first
     for role, count in comp["required"].items():
         if count<=0: continue
-        avail = [r for r in idx.get(role, []) if r.get("id") not in used]
-        chosen = sample_unique(avail, count)
-        for r in chosen: picks.append(r); used.add(r.get("id"))
+        chosen = sample_unique(_unused(idx.get(role, empty), picks), count, rng)
+        picks.extend(int(i) for i in chosen)
 
     # choose cuisine target
     if picks:
-        maj = cuisine_majority([p.get("cuisine", []) for p in picks])
+        maj = cuisine_majority([cat.cuisines[i] for i in picks])
     else:
-        maj = cuisine_majority([r.get("cuisine", []) for _, r in pool.iterrows()])
-    if not maj: return None
+        maj = _cuisine_index(cat)["majority"]
+    if not maj:
+        _count_reject("no_cuisine"); return None
     target_c = maj[0]
 
     # optional roles
     def add_role(role: str, kmax: int):
         if kmax<=0: return
-        avail = [r for r in idx.get(role, []) if r.get("id") not in used]
-        prefer = [r for r in avail if target_c in (r.get("cuisine") or []) or "universal" in (r.get("cuisine") or [])]
-        chosen = sample_unique(prefer if prefer else avail, kmax)
-        for r in chosen: picks.append(r); used.add(r.get("id"))
+        prefer = _unused(_preferred_rows(cat, role, target_c), picks)
+        if not len(prefer): prefer = _unused(idx.get(role, empty), picks)
+        chosen = sample_unique(prefer, kmax, rng)
+        picks.extend(int(i) for i in chosen)
 
     for role, kmax in comp["optional_max"].items():
         if len(picks) >= target: break
@@ -271,46 +724,384 @@ def sample_candidate(pool: pd.DataFrame, slot: str) -> Optional[Cand]:
 
     # fill remainder if under min
     if len(picks) < mn:
-        left = [r.to_dict() for _, r in pool.iterrows() if r.get("id") not in used]
-        prefer = [r for r in left if target_c in (r.get("cuisine") or []) or "universal" in (r.get("cuisine") or [])]
-        chosen = sample_unique(prefer if prefer else left, mn - len(picks))
-        for r in chosen: picks.append(r); used.add(r.get("id"))
+        prefer = _unused(_preferred_rows(cat, None, target_c), picks)
+        if not len(prefer): prefer = _unused(cat.ids, picks)
+        chosen = sample_unique(prefer, mn - len(picks), rng)
+        picks.extend(int(i) for i in chosen)
 
-    names = [str(p["name"]) for p in picks]
-    if banned(names): return None
+    names = [cat.names[i] for i in picks]
+    if banned(names):
+        _count_reject("banned"); return None
 
     # enforce exactly one dressing if >1
-    roles = [str(p.get("role","")) for p in picks]
+    roles = [cat.roles[i] for i in picks]
     if roles.count("dressing_sauce") > 1:
-        keep_i = int(RNG.integers(0, roles.count("dressing_sauce")))
+        keep_i = int(rng.integers(0, roles.count("dressing_sauce")))
         kept = 0; new=[]
-        for p in picks:
-            if p.get("role")=="dressing_sauce":
-                if kept==keep_i: new.append(p); kept+=1
+        for i in picks:
+            if cat.roles[i]=="dressing_sauce":
+                if kept==keep_i: new.append(i); kept+=1
             else:
-                new.append(p)
+                new.append(i)
         picks = new
-        roles = [str(p.get("role","")) for p in picks]
+        names = [cat.names[i] for i in picks]
+        roles = [cat.roles[i] for i in picks]
 
-    cuisines = cuisine_majority([p.get("cuisine") or [] for p in picks])
-    if not cuisines: return None
+    cuisines = cuisine_majority([cat.cuisines[i] for i in picks])
+    if not cuisines:
+        _count_reject("no_cuisine"); return None
 
-    P = float(sum(p.get("protein",0.0) for p in picks))
-    C = float(sum(p.get("carbs",0.0) for p in picks))
-    F = float(sum(p.get("fat",0.0) for p in picks))
-    kcal = float(sum(p.get("kcal",0.0) for p in picks))
-    price = float(sum(p.get("price_per_serving",0.0) for p in picks))
-    allergens = sorted({a.strip().lower() for p in picks for a in (p.get("allergens") or []) if a})
-    return Cand(names=names, roles=roles, cuisines=cuisines, P=P, C=C, F=F, kcal=kcal, price=price, allergens=allergens)
+    ix = np.asarray(picks, dtype=np.int64)
+    allergens = sorted({a.strip().lower() for i in picks for a in cat.allergens[i] if a})
+    return Cand(names=names, roles=roles, cuisines=cuisines,
+                P=float(cat.protein[ix].sum()), C=float(cat.carbs[ix].sum()), F=float(cat.fat[ix].sum()),
+                kcal=float(cat.kcal[ix].sum()), price=float(cat.price[ix].sum()),
+                allergens=allergens, idx=ix, sig=int(_sig_keys(cat)[ix].sum()))
 
-def generate_batch(pool: pd.DataFrame, slot: str, n: int=360) -> List[Cand]:
+def generate_batch(pool: Any, slot: str, n: int=360, batched: bool=False,
+                   rng: Optional[np.random.Generator] = None) -> List[Cand]:
+    cat=_as_catalog(pool)
+    if batched:
+        return generate_batch_np(cat, slot, n, rng=rng).to_cands()
     out=[]; attempts=0; cap=n*40
     while len(out)<n and attempts<cap:
         attempts+=1
-        c=sample_candidate(pool, slot)
+        c=sample_candidate(pool, slot, cat=cat, rng=rng)
         if c is not None: out.append(c)
+    rec=_SLOT_REC.get()
+    if rec is not None:
+        rec["attempts"]+=attempts; rec["accepted"]+=len(out)
     return out
 
+# ------------- catalog snapshot ------------
+SNAPSHOT_FORMAT = 1
+_SNAPSHOT_ARRAYS = ["protein", "carbs", "fat", "kcal", "price", "meal_mask", "allergen_mask",
+                    "role_code", "cuisine_ptr", "cuisine_code"]
+
+def file_hash(path: str) -> str:
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()
+
+def catalog_hash(cat: Catalog) -> str:
+    """Content hash of the normalized catalog (arrays + string tables)."""
+    import hashlib
+    h = hashlib.sha256()
+    for a in (cat.protein, cat.carbs, cat.fat, cat.kcal, cat.price, cat.meal_mask, cat.allergen_mask):
+        h.update(np.ascontiguousarray(a).tobytes())
+    h.update(json.dumps([cat.keys, cat.names, cat.roles, cat.cuisines, cat.allergens, cat.allergen_bits],
+                        sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+def save_snapshot(df: Any, path: str, source_hash: Optional[str] = None) -> str:
+    """
+    Write the normalized catalog to directory `path`: one .npy per numeric column
+    (memory-mappable), role and cuisine as integer codes, allergens as the bitmask,
+    plus meta.json with the string tables and hashes. Returns the content hash.
+    Cuisine lists keep their order (it decides cuisine_majority ties), so they are
+    stored as CSR codes rather than a bitmask.
+    """
+    cat = _as_catalog(df); out = Path(path); out.mkdir(parents=True, exist_ok=True)
+    roles = sorted(set(cat.roles)); cvocab: Dict[str,int] = {}; ptr = [0]; codes: List[int] = []
+    for cs in cat.cuisines:
+        codes.extend(cvocab.setdefault(c, len(cvocab)) for c in cs); ptr.append(len(codes))
+    arrays = {"protein": cat.protein, "carbs": cat.carbs, "fat": cat.fat, "kcal": cat.kcal, "price": cat.price,
+              "meal_mask": cat.meal_mask, "allergen_mask": cat.allergen_mask,
+              "role_code": np.asarray([roles.index(r) for r in cat.roles], dtype=np.int32),
+              "cuisine_ptr": np.asarray(ptr, dtype=np.int64), "cuisine_code": np.asarray(codes, dtype=np.int32)}
+    for name, a in arrays.items():
+        np.save(out / f"{name}.npy", np.ascontiguousarray(a))
+    digest = catalog_hash(cat)
+    meta = {"format": SNAPSHOT_FORMAT, "rows": len(cat), "hash": digest, "source_hash": source_hash,
+            "keys": [None if k is None else str(k) for k in cat.keys], "names": cat.names,
+            "roles": roles, "cuisines": list(cvocab), "allergen_bits": cat.allergen_bits}
+    tmp = out / "meta.json.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, out / "meta.json")  # meta last: a snapshot is only valid once it exists
+    return digest
+
+def load_snapshot(path: str, source_hash: Optional[str] = None, mmap: bool = True) -> Catalog:
+    """
+    Load a snapshot written by save_snapshot, memory-mapping the numeric columns.
+    Raises ValueError if it is missing, of another format, or was built from a
+    different source than `source_hash`.
+    """
+    d = Path(path)
+    try:
+        with open(d / "meta.json", encoding="utf-8") as f: meta = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"No usable snapshot at {d}: {e}")
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Snapshot format {meta.get('format')} != {SNAPSHOT_FORMAT}")
+    if source_hash is not None and meta.get("source_hash") != source_hash:
+        raise ValueError("Snapshot is stale (source content changed)")
+    a = {name: np.load(d / f"{name}.npy", mmap_mode="r" if mmap else None) for name in _SNAPSHOT_ARRAYS}
+    roles_v = meta["roles"]; cuis_v = meta["cuisines"]; bits = meta["allergen_bits"]
+    roles = [roles_v[i] for i in a["role_code"].tolist()]
+    ptr = a["cuisine_ptr"].tolist(); cc = [cuis_v[i] for i in a["cuisine_code"].tolist()]
+    by_bit = [(m, name) for name, m in sorted(bits.items(), key=lambda kv: kv[1])]
+    amask = a["allergen_mask"].tolist()
+    cat = Catalog(
+        ids=np.arange(meta["rows"], dtype=np.int64), keys=meta["keys"], names=meta["names"], roles=roles,
+        cuisines=[cc[ptr[i]:ptr[i+1]] for i in range(meta["rows"])],
+        allergens=[[name for m, name in by_bit if am & m] if am else [] for am in amask],
+        protein=a["protein"], carbs=a["carbs"], fat=a["fat"], kcal=a["kcal"], price=a["price"],
+        meal_mask=a["meal_mask"], allergen_mask=a["allergen_mask"], allergen_bits=bits,
+        by_role=_group_by_role(roles))
+    cat.cache["hash"] = meta["hash"]
+    return cat
+
+def load_csv_cached(csv_path: str, snapshot_dir: str) -> Catalog:
+    """load_csv through a snapshot: reuse it while the CSV content is unchanged, rebuild otherwise."""
+    src = file_hash(csv_path)
+    try:
+        return load_snapshot(snapshot_dir, source_hash=src)
+    except ValueError:
+        save_snapshot(read_csv_catalog(csv_path), snapshot_dir, source_hash=src)
+        return load_snapshot(snapshot_dir, source_hash=src)
+
+# ------------- batched candidates ----------
+@dataclass
+class CandBatch:
+    """
+    Struct-of-arrays candidate batch: row i is one candidate whose ingredients
+    are idx[i, :count[i]] (padded with -1). cuisine holds the main cuisine code
+    into cuisine_names(cat), or -1 for "universal".
+    """
+    cat: Catalog
+    idx: np.ndarray; count: np.ndarray; cuisine: np.ndarray
+    P: np.ndarray; C: np.ndarray; F: np.ndarray; kcal: np.ndarray; price: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.count)
+
+    def take(self, rows: np.ndarray) -> "CandBatch":
+        return CandBatch(cat=self.cat, idx=self.idx[rows], count=self.count[rows], cuisine=self.cuisine[rows],
+                         P=self.P[rows], C=self.C[rows], F=self.F[rows], kcal=self.kcal[rows], price=self.price[rows])
+
+    def names(self, i: int) -> List[str]:
+        return [self.cat.names[j] for j in self.idx[i, :self.count[i]]]
+
+    def signatures(self) -> np.ndarray:
+        """meal_signature of every row (uint64)."""
+        return _sig_keys(self.cat)[self.idx].sum(axis=1, dtype=np.uint64)
+
+    def to_cands(self) -> List[Cand]:
+        cat = self.cat; cnames = cuisine_names(cat); sigs = self.signatures(); out = []
+        for i in range(len(self)):
+            ix = self.idx[i, :self.count[i]].astype(np.int64); picks = ix.tolist()
+            cu = int(self.cuisine[i])
+            out.append(Cand(names=[cat.names[j] for j in picks], roles=[cat.roles[j] for j in picks],
+                            cuisines=[cnames[cu] if cu >= 0 else "universal"],
+                            P=float(self.P[i]), C=float(self.C[i]), F=float(self.F[i]),
+                            kcal=float(self.kcal[i]), price=float(self.price[i]),
+                            allergens=sorted({a.strip().lower() for j in picks for a in cat.allergens[j] if a}),
+                            idx=ix, sig=int(sigs[i])))
+        return out
+
+def _batch_tables(cat: Catalog) -> Dict[str, Any]:
+    """Per-catalog lookup tables for the batched generator, built on first use."""
+    t = cat.cache.get("batch")
+    if t is not None: return t
+    n = len(cat)
+    vocab: Dict[str,int] = {}; ptr = [0]; codes: List[int] = []
+    has_uni = np.zeros(n, dtype=bool)
+    for i, cs in enumerate(cat.cuisines):
+        for c in cs:
+            if c == "universal": has_uni[i] = True
+            else: codes.append(vocab.setdefault(c, len(vocab)))
+        ptr.append(len(codes))
+    K = len(vocab)
+    ptr_a = np.asarray(ptr, dtype=np.int64); codes_a = np.asarray(codes, dtype=np.int64)
+    # prefer[c, i]: row i matches target cuisine c (or is universal); prefer[K] is the universal target
+    prefer = np.zeros((K+1, n), dtype=bool)
+    prefer[codes_a, np.repeat(np.arange(n), np.diff(ptr_a))] = True
+    prefer |= has_uni[None, :]
+    ban_bits = np.zeros(n, dtype=np.int64)
+    for j, (a, b) in enumerate(BAN_KEYWORDS):
+        for i, nm in enumerate(cat.names):
+            nl = nm.lower()
+            if a in nl: ban_bits[i] |= 1 << (2*j)
+            if b in nl: ban_bits[i] |= 1 << (2*j+1)
+    role_names = sorted(set(cat.roles))
+    role_code = np.asarray([role_names.index(r) for r in cat.roles] + [-1], dtype=np.int64)
+    pad = lambda a: np.append(a, 0.0)  # idx -1 gathers the trailing zero
+    t = {"cuisine_names": list(vocab), "role_names": role_names, "role_code": role_code, "ptr": ptr_a, "codes": codes_a, "has_uni": np.append(has_uni, False),
+         "prefer": prefer, "ban_bits": np.append(ban_bits, 0),
+         "dressing": np.append(np.asarray([r == "dressing_sauce" for r in cat.roles], dtype=bool), False),
+         "protein": pad(cat.protein), "carbs": pad(cat.carbs), "fat": pad(cat.fat),
+         "kcal": pad(cat.kcal), "price": pad(cat.price)}
+    t["pool_majority"] = int(_batch_majority(t, np.arange(n)[None, :])[0]) if n else -2
+    cat.cache["batch"] = t
+    return t
+
+def cuisine_names(cat: Catalog) -> List[str]:
+    return _batch_tables(cat)["cuisine_names"]
+
+def _batch_majority(t: Dict[str, Any], idx: np.ndarray) -> np.ndarray:
+    """
+    Vectorized cuisine_majority over each row of idx: returns the winning cuisine
+    code, -1 for "universal" and -2 when no pick carries a cuisine. Ties go to the
+    cuisine seen first, as in cuisine_majority.
+    """
+    M = idx.shape[0]; K = len(t["cuisine_names"]); ptr = t["ptr"]
+    rows, cols = np.nonzero(idx >= 0)
+    items = idx[rows, cols]
+    lens = ptr[items+1] - ptr[items]
+    rrow = np.repeat(rows, lens)
+    start = np.repeat(ptr[items], lens)
+    offs = np.arange(len(rrow)) - np.repeat(np.cumsum(lens) - lens, lens)
+    code = t["codes"][start + offs]
+    counts = np.zeros((M, max(K, 1)), dtype=np.int64)
+    np.add.at(counts, (rrow, code), 1)
+    first = np.full((M, max(K, 1)), len(rrow), dtype=np.int64)
+    np.minimum.at(first, (rrow, code), np.arange(len(rrow)))  # rank in pick order
+    key = np.where(counts > 0, counts * (len(rrow)+1) - first, -1)
+    best = key.argmax(axis=1)
+    any_uni = t["has_uni"][idx].any(axis=1)
+    return np.where(counts.max(axis=1) > 0, best, np.where(any_uni, -1, -2))
+
+def _ban_ok(t: Dict[str, Any], idx: np.ndarray) -> np.ndarray:
+    """Vectorized `not banned(...)` over each row of idx."""
+    bits = np.bitwise_or.reduce(t["ban_bits"][idx], axis=1)
+    ok = np.ones(idx.shape[0], dtype=bool)
+    for j in range(len(BAN_KEYWORDS)):
+        both = (3 << (2*j))
+        ok &= (bits & both) != both
+    return ok
+
+def _make_batch(cat: Catalog, idx: np.ndarray, count: np.ndarray, cuisine: Optional[np.ndarray] = None) -> CandBatch:
+    """CandBatch for an index matrix (rows padded with -1); macros and price are summed here."""
+    t = _batch_tables(cat)
+    if cuisine is None: cuisine = _batch_majority(t, idx)
+    gsum = lambda a: a[idx].sum(axis=1)
+    return CandBatch(cat=cat, idx=idx, count=count, cuisine=cuisine,
+                     P=gsum(t["protein"]), C=gsum(t["carbs"]), F=gsum(t["fat"]),
+                     kcal=gsum(t["kcal"]), price=gsum(t["price"]))
+
+def _draw_rows(rows: np.ndarray, keys: np.ndarray, limit: np.ndarray,
+               idx: np.ndarray, count: np.ndarray, sel: np.ndarray) -> None:
+    """Append rows[...] with the limit[i] smallest keys to each selected batch row."""
+    kmax = int(limit.max()) if len(limit) else 0
+    if kmax <= 0: return
+    if kmax < keys.shape[1]:
+        part = np.argpartition(keys, kmax-1, axis=1)[:, :kmax]
+        order = np.take_along_axis(part, np.argsort(np.take_along_axis(keys, part, axis=1), axis=1), axis=1)
+    else:
+        order = np.argsort(keys, axis=1)
+    for j in range(kmax):
+        m = j < limit
+        idx[sel[m], count[sel[m]]] = rows[order[m, j]]
+        count[sel[m]] += 1
+
+_DRAW_CHUNK = 1 << 22  # max random keys materialized per draw
+
+def _sample_rows(t: Dict[str, Any], idx: np.ndarray, count: np.ndarray, sel: np.ndarray,
+                 rows: np.ndarray, k: np.ndarray, target_c: Optional[np.ndarray],
+                 rng: np.random.Generator) -> None:
+    """
+    Draw up to k[i] distinct items from `rows` for each selected batch row, without
+    replacement and skipping items the row already holds. With target_c, draws stay
+    within the preferred (target cuisine or universal) items whenever the row has
+    any, mirroring sample_candidate.
+    """
+    if len(sel) == 0 or len(rows) == 0: return
+    step = max(1, _DRAW_CHUNK // len(rows))
+    if len(sel) > step:
+        for a in range(0, len(sel), step):
+            _sample_rows(t, idx, count, sel[a:a+step], rows, k[a:a+step], target_c, rng)
+        return
+    pos = np.full(len(t["protein"]), -1, dtype=np.int64)  # catalog row -> position in rows (-1 pad maps to -1)
+    pos[rows] = np.arange(len(rows))
+    held = pos[idx[sel]]
+    taken = np.zeros((len(sel), len(rows)), dtype=bool)
+    r, c = np.nonzero(held >= 0)
+    taken[r, held[r, c]] = True
+    keys = rng.random((len(sel), len(rows)))
+    keys[taken] = np.inf
+    avail = len(rows) - taken.sum(axis=1)
+    if target_c is None:
+        limit = np.minimum(k, avail)
+    else:
+        pref = t["prefer"][target_c[sel]][:, rows] & ~taken
+        n_pref = pref.sum(axis=1)
+        keys[~pref & ~taken] += 1.0  # non-preferred only sort after every preferred item
+        limit = np.where(n_pref > 0, np.minimum(k, n_pref), np.minimum(k, avail))
+    _draw_rows(rows, keys, limit, idx, count, sel)
+
+def generate_batch_np(pool: Any, slot: str, n: int=360, rng: Optional[np.random.Generator] = None) -> CandBatch:
+    """
+    Batched generator: draws all candidates for a slot at once into an
+    (N x max_items) index matrix, with the same composition rules as
+    sample_candidate (required roles, cuisine-preferring optional roles,
+    fill to the minimum, single dressing) and vectorized rejection of
+    banned / cuisine-less rows. Draws rounds until n rows are accepted or
+    n*40 rows have been tried.
+    """
+    cat = _as_catalog(pool); t = _batch_tables(cat); rng = _rng(rng); rec = _SLOT_REC.get()
+    comp = COMPOSITION[slot]; mn, mx = comp["total_range"]; K = len(t["cuisine_names"])
+    empty = cat.ids[:0]; all_rows = np.arange(len(cat))
+    pool_maj = t["pool_majority"]
+    parts: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []; accepted = 0; attempts = 0; cap = n*40
+    while accepted < n and attempts < cap:
+        M = int(min(cap - attempts, max(2*(n - accepted), 32))); attempts += M
+        idx = np.full((M, mx), -1, dtype=np.int64); count = np.zeros(M, dtype=np.int64)
+        target = rng.integers(mn, mx+1, size=M)
+        every = np.arange(M)
+
+        for role, k in comp["required"].items():
+            if k <= 0: continue
+            _sample_rows(t, idx, count, every, cat.by_role.get(role, empty), np.full(M, k), None, rng)
+
+        maj = _batch_majority(t, idx) if count.any() else np.full(M, -2)
+        maj = np.where(count > 0, maj, pool_maj)
+        ok = maj != -2
+        target_c = np.where(maj == -1, K, maj)
+
+        for role, kmax in comp["optional_max"].items():
+            k = np.minimum(kmax, target - count)
+            sel = every[ok & (k > 0)]
+            _sample_rows(t, idx, count, sel, cat.by_role.get(role, empty), k[sel], target_c, rng)
+
+        under = every[ok & (count < mn)]
+        if len(under):
+            _sample_rows(t, idx, count, under, all_rows, mn - count[under], target_c, rng)
+
+        ban_ok = _ban_ok(t, idx)  # checked before dressing removal, as in sample_candidate
+
+        # enforce exactly one dressing: keep a random one, drop the rest and compact
+        is_d = t["dressing"][idx]
+        multi = is_d.sum(axis=1) > 1
+        if multi.any():
+            rank = np.cumsum(is_d, axis=1) - 1
+            keep = (rng.random(M) * is_d.sum(axis=1)).astype(np.int64)
+            drop = multi[:, None] & is_d & (rank != keep[:, None])
+            idx[drop] = -1
+            order = np.argsort(idx < 0, axis=1, kind="stable")
+            idx = np.take_along_axis(idx, order, axis=1)
+            count = (idx >= 0).sum(axis=1)
+
+        cuisine = _batch_majority(t, idx)
+        if rec is not None:
+            rec["rejected"]["no_cuisine"] += int((~ok).sum() + (ok & ban_ok & (cuisine == -2)).sum())
+            rec["rejected"]["banned"] += int((ok & ~ban_ok).sum())
+        ok &= ban_ok & (cuisine != -2)
+        keep_rows = every[ok][:n - accepted]
+        parts.append((idx[keep_rows], count[keep_rows], cuisine[keep_rows]))
+        accepted += len(keep_rows)
+    if rec is not None:
+        rec["attempts"] += attempts; rec["accepted"] += accepted
+
+    if parts:
+        idx = np.concatenate([p[0] for p in parts]); count = np.concatenate([p[1] for p in parts])
+        cuisine = np.concatenate([p[2] for p in parts])
+    else:
+        idx = np.full((0, mx), -1, dtype=np.int64); count = np.zeros(0, dtype=np.int64); cuisine = count.copy()
+    return _make_batch(cat, idx, count, cuisine)
+
 # --------------- scoring -----------------
 def slot_targets(P:float,C:float,F:float, slot:str)->Dict[str,float]:
     sp,sc,sf = COMPOSITION[slot]["split"]; return {"P":P*sp,"C":C*sc,"F":F*sf}
@@ -321,7 +1112,10 @@ def macro_score(c:Cand, tgt:Dict[str,float])->float:
     return max(0.0, 1.0-rel)
 
 def count_score(c:Cand, slot:str)->float:
-    mn,mx=COMPOSITION[slot]["total_range"]; n=len(c.roles)
+    return _count_score_n(len(c.roles), slot)
+
+def _count_score_n(n:int, slot:str)->float:
+    mn,mx=COMPOSITION[slot]["total_range"]
     if n<mn: return max(0.0, 1.0-(mn-n)*0.3)
     if n>mx: return max(0.0, 1.0-(n-mx)*0.2)
     mid=(mn+mx)/2.0
@@ -339,9 +1133,11 @@ def role_coverage(c:Cand, slot:str)->float:
     return min(1.0, ok/total + bonus)
 
 def cuisine_focus(c:Cand)->float:
-    cs=[x for x in c.cuisines if x!="universal"]
-    if not cs: return 0.5
-    n=len(cs); p=1.0/n; H=-n*p*math.log(p+1e-9); return max(0.0, 1.0-(H/1.5))
+    return _cuisine_focus_n(len([x for x in c.cuisines if x!="universal"]))
+
+def _cuisine_focus_n(n:int)->float:
+    if n==0: return 0.5
+    p=1.0/n; H=-n*p*math.log(p+1e-9); return max(0.0, 1.0-(H/1.5))
 
 def score_candidate(c:Cand, slot:str, tgt:Dict[str,float])->float:
     ms=macro_score(c,tgt); coh=cuisine_focus(c); rc=role_coverage(c,slot); cnt=count_score(c,slot)
@@ -352,56 +1148,315 @@ def score_candidate(c:Cand, slot:str, tgt:Dict[str,float])->float:
         if dcount>1: dpen+=0.3
     return float(max(0.0, min(1.0, 0.45*ms + 0.20*coh + 0.20*rc + 0.10*cnt - 0.05*dpen)))
 
+def _pair_names(pair: Any) -> set:
+    """Validated pairings are sets of lowercased names; tolerate other iterables."""
+    if isinstance(pair, (set, frozenset)): return pair
+    try:
+        return {str(x).strip().lower() for x in pair}
+    except Exception:
+        return set()
+
+class PairingIndex:
+    """
+    Sparse adjacency over normalized ingredient names built once from the
+    validated pairings. A candidate's bonus only looks at the pairs among its
+    own items, so the cost no longer grows with the size of the pairing table.
+    """
+    def __init__(self, validated_pairings: Optional[List[set]] = None):
+        self.vocab: Dict[str,int] = {}
+        self.names: List[str] = []  # code -> name
+        self.adj: Dict[int, set] = {}
+        self.extra: List[frozenset] = []  # pairings with more than two names
+        self._mult: Dict[Tuple[int,int], int] = {}  # a pair may be added more than once
+        self._keys: Optional[np.ndarray] = None
+        for pair in validated_pairings or []:
+            self.add(pair)
+
+    def _code(self, name: str) -> int:
+        c = self.vocab.get(name)
+        if c is None:
+            c = self.vocab[name] = len(self.names); self.names.append(name)
+        return c
+
+    def add(self, pair: Any) -> None:
+        pset = _pair_names(pair)
+        if not pset: return
+        if len(pset) > 2:
+            self.extra.append(frozenset(pset)); return
+        names = sorted(pset)  # a single-name pairing pairs the name with itself
+        a = self._code(names[0]); b = self._code(names[-1])
+        self._mult[(a, b)] = self._mult.get((a, b), 0) + 1
+        self.adj.setdefault(a, set()).add(b); self.adj.setdefault(b, set()).add(a)
+        self._keys = None
+
+    def remove(self, pair: Any) -> bool:
+        pset = _pair_names(pair)
+        if not pset: return False
+        if len(pset) > 2:
+            fs = frozenset(pset)
+            if fs in self.extra: self.extra.remove(fs); return True
+            return False
+        names = sorted(pset)
+        if names[0] not in self.vocab or names[-1] not in self.vocab: return False
+        a = self.vocab[names[0]]; b = self.vocab[names[-1]]
+        left = self._mult.get((a, b), 0) - 1
+        if left < 0: return False
+        if left:
+            self._mult[(a, b)] = left; return True
+        del self._mult[(a, b)]
+        self.adj[a].discard(b); self.adj[b].discard(a)
+        self._keys = None
+        return True
+
+    def remove_name(self, name: str) -> int:
+        """Remove every pairing that mentions `name`, with all its multiplicity; returns how many."""
+        n = 0
+        a = self.vocab.get(name)
+        if a is not None and a in self.adj:
+            for b in self.adj.pop(a):
+                n += self._mult.pop((a, b), 0) or self._mult.pop((b, a), 0)
+                if b != a: self.adj[b].discard(a)
+            self._keys = None
+        keep = [p for p in self.extra if name not in p]
+        n += len(self.extra) - len(keep); self.extra = keep
+        return n
+
+    def rename_name(self, old: str, new: str) -> int:
+        """Move every pairing that mentions `old` over to `new`, keeping multiplicity; returns how many."""
+        a = self.vocab.get(old); moved = []
+        for b in (self.adj.get(a, ()) if a is not None else ()):
+            m = self._mult.get((a, b)) or self._mult.get((b, a), 0)
+            moved.append((new if b == a else self.names[b], m))
+        extra = [p for p in self.extra if old in p]
+        n = self.remove_name(old)
+        for other, m in moved:
+            for _ in range(m): self.add({new, other})
+        for p in extra: self.add((p - {old}) | {new})
+        return n
+
+    def __len__(self) -> int:
+        return sum(len(v) + (a in v) for a, v in self.adj.items()) // 2 + len(self.extra)
+
+    def keys(self) -> np.ndarray:
+        """Sorted a*V+b (a<=b) codes of every pair, for batched lookups."""
+        if self._keys is None:
+            V = len(self.vocab)
+            self._keys = np.unique(np.asarray([min(a,b)*V+max(a,b) for a, nb in self.adj.items() for b in nb],
+                                              dtype=np.int64))
+        return self._keys
+
+    def digest(self) -> str:
+        """Content hash of the pairs (with multiplicity), independent of insertion order."""
+        import hashlib
+        names = self.names
+        pairs = sorted([names[a], names[b], m] for (a, b), m in self._mult.items())
+        extra = sorted(sorted(p) for p in self.extra)
+        return hashlib.sha256(json.dumps([pairs, extra]).encode("utf-8")).hexdigest()
+
+    def has_pair(self, names_lc: set) -> bool:
+        codes = {self.vocab[n] for n in names_lc if n in self.vocab}
+        for a in codes:
+            if self.adj.get(a, set()) & codes: return True
+        return any(p.issubset(names_lc) for p in self.extra)
+
+def as_pairing_index(validated_pairings: Any) -> Optional[PairingIndex]:
+    if not validated_pairings: return None
+    return validated_pairings if isinstance(validated_pairings, PairingIndex) else PairingIndex(validated_pairings)
+
+def pairing_bonus(c:Cand, validated_pairings:Any)->float:
+    if not validated_pairings: return 0.0
+    names_lc = {str(n).strip().lower() for n in c.names}
+    if isinstance(validated_pairings, PairingIndex):
+        return 0.25 if validated_pairings.has_pair(names_lc) else 0.0
+    for pair in validated_pairings:
+        pset = _pair_names(pair)
+        if pset and pset.issubset(names_lc):
+            return 0.25
+    return 0.0
+
+def adjusted_score(c:Cand, slot:str, tgt:Dict[str,float], cuisine_bias:Dict[str,int],
+                   ingredient_usage:Dict[str,int], validated_pairings:Optional[List[set]] = None,
+                   usage_rows:Optional[np.ndarray] = None)->float:
+    """
+    score_candidate plus the weekly fatigue (cuisine, ingredient usage) and pairing adjustments.
+    usage_rows (_usage_rows of the candidate's catalog) replaces the per-name usage lookups.
+    """
+    s=score_candidate(c, slot, tgt)
+    # much stronger cuisine fatigue penalty to promote rotation
+    main_c = c.cuisines[0] if c.cuisines else "universal"
+    s -= 0.15 * cuisine_bias.get(main_c, 0)
+    # much stronger ingredient usage penalty
+    if usage_rows is not None and c.idx is not None:
+        ing_penalty = 0.0 + usage_rows[c.idx].sum()
+    else:
+        ing_penalty = 0.0
+        for nm in c.names:
+            ing_penalty += ingredient_usage.get(str(nm).strip().lower(), 0)
+    s -= 0.12 * ing_penalty
+    # pairing bonus: if candidate contains any validated pairing, give a boost
+    s += pairing_bonus(c, validated_pairings)
+    return s
+
+def score_slot(cands:List[Cand], slot:str, tgt:Dict[str,float], no_repeat_signatures:set,
+               cuisine_bias:Dict[str,int], ingredient_usage:Dict[str,int],
+               validated_pairings:Optional[List[set]] = None, cat:Optional[Catalog] = None)->List[Tuple[Cand,float]]:
+    """
+    Scalar reference path: score every candidate that is neither repeated nor a
+    duplicate of an earlier one in `cands`, best first. `cat` is the catalog the
+    candidates were drawn from (enables the per-row usage array).
+    """
+    scored=[]; seen=set()
+    use = _usage_rows(cat, ingredient_usage) if cat is not None and ingredient_usage else None
+    for c in cands:
+        sig = cand_signature(c)
+        if sig in no_repeat_signatures or sig in seen:
+            continue
+        seen.add(sig)
+        scored.append((c, adjusted_score(c, slot, tgt, cuisine_bias, ingredient_usage, validated_pairings, use)))
+    scored.sort(key=lambda x:-x[1])
+    rec=_SLOT_REC.get()
+    if rec is not None: rec["duplicates"]+=len(cands)-len(scored)
+    return scored
+
+def _name_codes(cat: Catalog) -> Tuple[Dict[str,int], np.ndarray]:
+    """Normalized (stripped, lowercased) name -> code, plus the code of every catalog row."""
+    t = cat.cache.get("names")
+    if t is None:
+        vocab: Dict[str,int] = {}
+        codes = np.asarray([vocab.setdefault(str(n).strip().lower(), len(vocab)) for n in cat.names], dtype=np.int64)
+        t = cat.cache["names"] = (vocab, codes)
+    return t
+
+def _sig_keys(cat: Catalog) -> np.ndarray:
+    """_name_key of every catalog row (uint64), plus a trailing 0 that -1 padding gathers."""
+    k = cat.cache.get("sig_keys")
+    if k is None:
+        k = cat.cache["sig_keys"] = np.asarray([_name_key(n) for n in cat.names] + [0], dtype=np.uint64)
+    return k
+
+def _usage_rows(cat: Catalog, ingredient_usage: Dict[str,int]) -> np.ndarray:
+    """ingredient_usage as an array by catalog row, plus a trailing 0 that -1 padding gathers."""
+    vocab, codes = _name_codes(cat)
+    use = np.asarray([ingredient_usage.get(nm, 0) for nm in vocab], dtype=np.float64)
+    return np.append(use[codes], 0.0)
+
+def _fresh_rows(sigs: np.ndarray, no_repeat_signatures: set) -> np.ndarray:
+    """Ascending rows whose signature is not in no_repeat_signatures, first occurrence of each only."""
+    keep = np.zeros(len(sigs), dtype=bool)
+    keep[np.unique(sigs, return_index=True)[1]] = True
+    if no_repeat_signatures:
+        used = np.fromiter(no_repeat_signatures, dtype=np.uint64, count=len(no_repeat_signatures))
+        keep &= ~np.isin(sigs, used)
+    return np.nonzero(keep)[0]
+
+def _batch_pairing_bonus(batch: CandBatch, validated_pairings: Any) -> np.ndarray:
+    """Batched sparse lookup: every item pair of every row is probed against the sorted pair keys."""
+    N = len(batch); out = np.zeros(N)
+    pi = as_pairing_index(validated_pairings)
+    if pi is None or N == 0: return out
+    hit = np.zeros(N, dtype=bool)
+    if pi.adj:
+        vocab, codes = _name_codes(batch.cat)
+        pcode = np.asarray([pi.vocab.get(nm, -1) for nm in vocab] + [-1], dtype=np.int64)
+        rc = pcode[np.append(codes, len(vocab))[batch.idx]]
+        keys = pi.keys(); V = len(pi.vocab); W = rc.shape[1]
+        i, j = np.triu_indices(W)  # diagonal covers single-name pairings
+        a = np.minimum(rc[:, i], rc[:, j]); b = np.maximum(rc[:, i], rc[:, j])
+        k = a*V + b
+        pos = np.minimum(np.searchsorted(keys, k), len(keys)-1)
+        hit = ((keys[pos] == k) & (a >= 0)).any(axis=1)
+    if pi.extra:
+        for r in np.nonzero(~hit)[0]:
+            names_lc = {str(n).strip().lower() for n in batch.names(int(r))}
+            hit[r] = any(p.issubset(names_lc) for p in pi.extra)
+    out[hit] = 0.25
+    return out
+
+def score_batch(batch: CandBatch, slot: str, tgt: Dict[str,float], cuisine_bias: Optional[Dict[str,int]] = None,
+                ingredient_usage: Optional[Dict[str,int]] = None,
+                validated_pairings: Optional[List[set]] = None) -> np.ndarray:
+    """
+    Vectorized adjusted_score over a whole CandBatch. Every term is evaluated with
+    the same operations and in the same order as the scalar functions, so the
+    results are bit-for-bit equal to adjusted_score on batch.to_cands().
+    """
+    t = _batch_tables(batch.cat); comp = COMPOSITION[slot]; idx = batch.idx; eps=1e-6
+    rel=(np.abs(batch.P-tgt["P"])/(tgt["P"]+eps)+np.abs(batch.C-tgt["C"])/(tgt["C"]+eps)
+         +np.abs(batch.F-tgt["F"])/(tgt["F"]+eps))/3.0
+    ms=np.maximum(0.0, 1.0-rel)
+
+    uni = batch.cuisine < 0
+    coh=np.where(uni, _cuisine_focus_n(0), _cuisine_focus_n(1))
+
+    rc_codes = t["role_code"][idx]
+    def has(role: str) -> np.ndarray:
+        if role not in t["role_names"]: return np.zeros(len(batch), dtype=bool)
+        return (rc_codes == t["role_names"].index(role)).any(axis=1)
+    req=comp["required"]; ok=np.zeros(len(batch), dtype=np.int64); total=max(len(req),1)
+    for role,count in req.items():
+        ok += 1 if count==0 else has(role)
+    bonus=0.0+np.where(has("leafy_green"), 0.15, 0.0)
+    bonus=bonus+np.where(has("vegetable"), 0.10, 0.0)
+    bonus=bonus+np.where(has("fat_source"), 0.10, 0.0)
+    rc=np.minimum(1.0, ok/total + bonus)
+
+    mx=int(batch.count.max()) if len(batch) else 0
+    cnt=np.asarray([_count_score_n(n, slot) for n in range(mx+1)])[batch.count]
+
+    dpen=np.zeros(len(batch))
+    if slot in ("lunch","dinner"):
+        dcount=(t["dressing"][idx]).sum(axis=1)
+        dpen=np.where(dcount==0, 0.0+0.2, np.where(dcount>1, 0.0+0.3, 0.0))
+    s=np.maximum(0.0, np.minimum(1.0, 0.45*ms + 0.20*coh + 0.20*rc + 0.10*cnt - 0.05*dpen))
+
+    # subtracting a zero penalty leaves s unchanged, so empty fatigue state is skipped
+    if cuisine_bias:
+        cnames = t["cuisine_names"]
+        bias = np.asarray([cuisine_bias.get(c, 0) for c in cnames] + [cuisine_bias.get("universal", 0)], dtype=np.float64)
+        s = s - 0.15 * bias[np.where(uni, len(cnames), batch.cuisine)]
+    if ingredient_usage:
+        ing_penalty = 0.0 + _usage_rows(batch.cat, ingredient_usage)[idx].sum(axis=1)
+        s = s - 0.12 * ing_penalty
+    return s + _batch_pairing_bonus(batch, validated_pairings)
+
+def score_slot_batch(batch: CandBatch, slot: str, tgt: Dict[str,float], no_repeat_signatures: set,
+                     cuisine_bias: Dict[str,int], ingredient_usage: Dict[str,int],
+                     validated_pairings: Optional[List[set]] = None, top_k: Optional[int] = None) -> List[Tuple[Cand,float]]:
+    """Vectorized score_slot: only the top_k rows are materialized as Cand objects."""
+    rows = _fresh_rows(batch.signatures(), no_repeat_signatures)
+    rec = _SLOT_REC.get()
+    if rec is not None: rec["duplicates"] += len(batch) - len(rows)
+    s = score_batch(batch.take(rows), slot, tgt, cuisine_bias, ingredient_usage, validated_pairings)
+    order = np.argsort(-s, kind="stable")[:top_k]
+    return list(zip(batch.take(rows[order]).to_cands(), (float(x) for x in s[order])))
+
 # --------------- day selection -----------
 def pick_day(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str],
              no_repeat_signatures:set, cuisine_bias:Dict[str,int], ingredient_usage:Dict[str,int],
-             validated_pairings:Optional[List[set]] = None) -> Dict[str,Any]:
-    out={"meals":{}, "info":{}}
-    per_slot_tgts = {s: slot_targets(P,C,F,s) for s in SLOTS}
-    per_slot_lists: Dict[str, List[Tuple[Cand,float]]] = {}
-
-    for slot in SLOTS:
-        pool=filter_pool(df, slot, allergens)
-        cands=generate_batch(pool, slot, n=360)
-        RNG.shuffle(cands)  # Add randomness to candidate order
-        tg=per_slot_tgts[slot]
-        scored=[]
-        for c in cands:
-            sig = tuple(sorted(c.names))
-            if sig in no_repeat_signatures:
-                continue
-            s=score_candidate(c, slot, tg)
-            # much stronger cuisine fatigue penalty to promote rotation
-            main_c = c.cuisines[0] if c.cuisines else "universal"
-            s -= 0.15 * cuisine_bias.get(main_c, 0)
-            # much stronger ingredient usage penalty
-            ing_penalty = 0.0
-            for nm in c.names:
-                ing_penalty += ingredient_usage.get(str(nm).strip().lower(), 0)
-            s -= 0.12 * ing_penalty
-            # pairing bonus: if candidate contains any validated pairing, give a boost
-            if validated_pairings:
-                names_lc = {str(n).strip().lower() for n in c.names}
-                for pair in validated_pairings:
-                    try:
-                        if pair and pair.issubset(names_lc):
-                            s += 0.25
-                            break
-                    except Exception:
-                        # pair may not be a set (defensive), try converting
-                        try:
-                            pset = set([str(x).strip().lower() for x in pair])
-                            if pset and pset.issubset(names_lc):
-                                s += 0.25
-                                break
-                        except Exception:
-                            continue
-            scored.append((c, s))
-        scored.sort(key=lambda x:-x[1])
-        per_slot_lists[slot]=scored[:30]  # Top-30 for combo search, more variety
+             validated_pairings:Optional[List[set]] = None, rng:Optional[np.random.Generator] = None,
+             seed:Any = None, workers:int = 1, top_lists:Optional[List[Dict[str,Any]]] = None) -> Dict[str,Any]:
+    # Top-30 of 360 candidates per slot for the combo search, more variety
+    return pick_day_with_params(df, P,C,F, allergens, no_repeat_signatures, cuisine_bias, ingredient_usage,
+                                batch_size=360, top_k=30, validated_pairings=validated_pairings,
+                                rng=rng, seed=seed, workers=workers, top_lists=top_lists)
+
+def seed_child(seed:Any, i:int) -> np.random.SeedSequence:
+    """
+    i-th independent child stream of `seed` (an int or SeedSequence). Unlike
+    SeedSequence.spawn this does not mutate the parent, so the same (seed, i)
+    always yields the same stream regardless of call order.
+    """
+    ss = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return np.random.SeedSequence(ss.entropy, spawn_key=tuple(ss.spawn_key) + (i,), pool_size=ss.pool_size)
+
+def slot_rngs(seed:Any) -> Dict[str, np.random.Generator]:
+    """One generator per slot, so slots can be generated concurrently and still reproduce."""
+    return {slot: np.random.default_rng(seed_child(seed, i)) for i, slot in enumerate(SLOTS)}
 
+def best_combo_loop(B:List[Tuple[Cand,float]], L:List[Tuple[Cand,float]], D:List[Tuple[Cand,float]],
+                    P:float,C:float,F:float) -> Tuple[Optional[Tuple[Cand,Cand,Cand]], Dict[str,float]]:
+    """Reference triple loop over the top-k lists; best_combo must return the same argmin."""
     best=None; best_cost=1e9; meta={}
-    B=per_slot_lists["breakfast"]; L=per_slot_lists["lunch"]; D=per_slot_lists["dinner"]
     for (cb,sb) in B:
         for (cl,sl) in L:
             for (cd,sd) in D:
@@ -416,25 +1471,49 @@ def pick_day(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str],
                 cost=0.65*rel - 0.35*quality
                 if cost<best_cost:
                     best_cost=cost; best=(cb,cl,cd); meta={"rel_err":float(rel), "quality":float(quality)}
+    return best, meta
 
-    b,l,d = best
-    out["meals"]["breakfast"]={"names":b.names,"roles":b.roles,"cuisines":b.cuisines,
-                               "macros":{"P":b.P,"C":b.C,"F":b.F,"kcal":b.kcal},"price":b.price}
-    out["meals"]["lunch"]={"names":l.names,"roles":l.roles,"cuisines":l.cuisines,
-                           "macros":{"P":l.P,"C":l.C,"F":l.F,"kcal":l.kcal},"price":l.price}
-    out["meals"]["dinner"]={"names":d.names,"roles":d.roles,"cuisines":d.cuisines,
-                            "macros":{"P":d.P,"C":d.C,"F":d.F,"kcal":d.kcal},"price":d.price}
-    out["info"]=meta
-    out["totals"]={"P":b.P+l.P+d.P,"C":b.C+l.C+d.C,"F":b.F+l.F+d.F,"kcal":b.kcal+l.kcal+d.kcal,"price":b.price+l.price+d.price}
-    # update diversity trackers and ingredient usage
-    for c in [b,l,d]:
-        no_repeat_signatures.add(tuple(sorted(c.names)))
-        cu = c.cuisines[0] if c.cuisines else "universal"
-        cuisine_bias[cu] = cuisine_bias.get(cu, 0) + 1
-        for nm in c.names:
-            key = str(nm).strip().lower()
-            ingredient_usage[key] = ingredient_usage.get(key, 0) + 1
-    return out
+_COMBO_CHUNK = 1 << 20  # max (b,l,d) cells evaluated per broadcast
+
+def best_combo(B:List[Tuple[Cand,float]], L:List[Tuple[Cand,float]], D:List[Tuple[Cand,float]],
+               P:float,C:float,F:float) -> Tuple[Optional[Tuple[Cand,Cand,Cand]], Dict[str,float]]:
+    """
+    Day-level combo search as a (kB, kL, kD) broadcast, evaluated in chunks of
+    breakfasts to bound memory. Uses the same arithmetic as best_combo_loop and
+    keeps the first minimum in loop order, so it returns the identical combo.
+    """
+    if not (B and L and D): return None, {}
+    def cols(lst: List[Tuple[Cand,float]]):
+        cs=[c for c,_ in lst]
+        main=[c.cuisines[0] if c.cuisines else "universal" for c in cs]
+        return (np.asarray([c.P for c in cs]), np.asarray([c.C for c in cs]), np.asarray([c.F for c in cs]),
+                np.asarray([s for _,s in lst], dtype=np.float64), main)
+    Pb,Cb,Fb,Sb,mb = cols(B); Pl,Cl,Fl,Sl,ml = cols(L); Pd,Cd,Fd,Sd,md = cols(D)
+    vocab = {c: i for i, c in enumerate(dict.fromkeys(mb+ml+md))}
+    ub = np.asarray([vocab[c] for c in mb]); ul = np.asarray([vocab[c] for c in ml]); ud = np.asarray([vocab[c] for c in md])
+
+    # B-independent pieces
+    eq_ld = (ul[:,None]==ud[None,:])
+    PlD = Pl[:,None]; ClD = Cl[:,None]; FlD = Fl[:,None]; SlD = Sl[:,None]
+    step = max(1, _COMBO_CHUNK // (len(L)*len(D)))
+    best_cost = 1e9; best_ix = None; meta: Dict[str,float] = {}
+    for a in range(0, len(B), step):
+        sl_ = slice(a, a+step)
+        pb = Pb[sl_,None,None]; cb = Cb[sl_,None,None]; fb = Fb[sl_,None,None]
+        Pday = pb+PlD+Pd; Cday = cb+ClD+Cd; Fday = fb+FlD+Fd
+        rel = (np.abs(Pday-P)/(P+1e-6)+np.abs(Cday-C)/(C+1e-6)+np.abs(Fday-F)/(F+1e-6))/3.0
+        eq = ((ub[sl_,None,None]==ul[None,:,None]).astype(np.int64) + (ub[sl_,None,None]==ud[None,None,:]) + eq_ld[None])
+        distinct = 3 - eq + (eq==3)  # eq is 0, 1 or 3 for three labels
+        quality = (Sb[sl_,None,None]+SlD+Sd)/3.0 + 0.04*distinct
+        cost = 0.65*rel - 0.35*quality
+        cost = np.where(np.isnan(cost), np.inf, cost)
+        k = int(np.argmin(cost))
+        if cost.flat[k] < best_cost:
+            best_cost = float(cost.flat[k]); i, j, m = np.unravel_index(k, cost.shape)
+            best_ix = (a+int(i), int(j), int(m))
+            meta = {"rel_err": float(rel[i,j,m]), "quality": float(quality[i,j,m])}
+    if best_ix is None: return None, {}
+    return (B[best_ix[0]][0], L[best_ix[1]][0], D[best_ix[2]][0]), meta
 
 # --------------- presets -----------
 # Presets: (candidate_batch_size, per_slot_top_k)
@@ -443,149 +1522,1875 @@ PRESETS = {
     "balanced": (180, 15),  # medium speed/diversity (default, was n=360, top-30 -> now halved)
     "quality": (360, 30),   # high diversity (original settings)
     "deep": (720, 50),      # very thorough (slower, highest diversity)
+    "ultra": (1440, 100),   # widest search; meant for batched=True (combo search is vectorized)
 }
 
 def build_week_with_presets(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str], 
-                            preset:str="balanced", validated_pairings:Optional[List[set]] = None) -> Dict[str,Any]:
+                            preset:str="balanced", validated_pairings:Optional[List[set]] = None,
+                            batched:bool=False, rng:Optional[np.random.Generator] = None,
+                            seed:Any = None, workers:int = 1, refine:bool = False,
+                            solver:str = "sample", bank:Optional["CandidateBank"] = None) -> Dict[str,Any]:
     """
     Build a week using a named preset to configure generation parameters.
-    preset: "fast" | "balanced" | "quality" | "deep"
+    preset: "fast" | "balanced" | "quality" | "deep" | "ultra"
+    batched: draw each slot's candidates with the vectorized generator (generate_batch_np).
+    seed: gives every (day, slot) its own stream, so the plan is reproducible for the
+          seed and slots may be generated by `workers` threads. Otherwise `rng`
+          (default: the module RNG) is consumed sequentially.
+    refine: run refine_week over the greedy week (adds a "refine" block).
+    solver: "sample" (random candidates) or "exact" (solve_slot per slot; the
+            preset's top_k sizes the combo search, batched/workers are ignored).
+    bank:   draw the sampled candidates from this CandidateBank.
     """
     if preset not in PRESETS:
         raise ValueError(f"Unknown preset: {preset}. Must be one of {list(PRESETS.keys())}")
     
     batch_size, top_k = PRESETS[preset]
     
-    # Temporarily patch generate_batch to use the batch_size
-    global RNG
-    days=[]; no_repeat=set(); cuisine_bias={}; ingredient_usage={}
-    for day in range(1,8):
-        day_out = pick_day_with_params(df, P,C,F, allergens, no_repeat, cuisine_bias, ingredient_usage, 
-                                        batch_size=batch_size, top_k=top_k, validated_pairings=validated_pairings)
-        day_out["day"]=day
-        days.append(day_out)
+    validated_pairings = as_pairing_index(validated_pairings)
+    top_lists: Optional[List[Dict[str,Any]]] = [] if refine else None
+    days = list(iter_days(df, P,C,F, allergens, batch_size=batch_size, top_k=top_k,
+                          validated_pairings=validated_pairings, batched=batched, rng=rng,
+                          seed=seed, workers=workers, top_lists=top_lists, solver=solver, bank=bank))
     
-    totals={"P":0.0,"C":0.0,"F":0.0,"kcal":0.0,"price":0.0}
-    for d in days:
-        for sl in SLOTS:
-            m=d["meals"][sl]["macros"]
-            totals["P"]+=m["P"]; totals["C"]+=m["C"]; totals["F"]+=m["F"]; totals["kcal"]+=m["kcal"]
-            totals["price"]+=d["meals"][sl]["price"]
-    return {"inputs":{"daily_P":P,"daily_C":C,"daily_F":F,"allergens":allergens,"preset":preset},
-            "days":days, "weekly_totals":totals}
+    stats = refine_week(days, top_lists, P,C,F, validated_pairings) if refine else None
+    totals=week_totals(days)
+    out = {"inputs":{"daily_P":P,"daily_C":C,"daily_F":F,"allergens":allergens,"preset":preset},
+           "days":days, "weekly_totals":totals}
+    if solver != "sample": out["inputs"]["solver"]=solver
+    if stats is not None: out["refine"]=stats
+    return out
 
 def pick_day_with_params(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str],
                          no_repeat_signatures:set, cuisine_bias:Dict[str,int], ingredient_usage:Dict[str,int],
-                         batch_size:int=360, top_k:int=30, validated_pairings:Optional[List[set]] = None) -> Dict[str,Any]:
+                         batch_size:int=360, top_k:int=30, validated_pairings:Optional[List[set]] = None,
+                         batched:bool=False, rng:Optional[np.random.Generator] = None,
+                         seed:Any = None, workers:int = 1,
+                         top_lists:Optional[List[Dict[str,Any]]] = None,
+                         bank:Optional["CandidateBank"] = None) -> Dict[str,Any]:
     """
     Like pick_day but with explicit batch_size and top_k parameters for preset support.
+    With a seed, each slot draws from its own stream (slot_rngs) and the three slots
+    run on up to `workers` threads; the diversity state is only read until the day
+    is chosen, so the result does not depend on the degree of parallelism.
+    top_lists, if given, receives the day's scored per-slot lists (for refine_week).
+    bank, if given, supplies each slot's batch_size candidates (scored batched)
+    instead of generating them.
     """
-    out={"meals":{}, "info":{}}
     per_slot_tgts = {s: slot_targets(P,C,F,s) for s in SLOTS}
-    per_slot_lists: Dict[str, List[Tuple[Cand,float]]] = {}
-
-    for slot in SLOTS:
-        pool=filter_pool(df, slot, allergens)
-        # Use batch_size parameter instead of hardcoded 360
-        cands=generate_batch(pool, slot, n=batch_size)
-        RNG.shuffle(cands)
-        tg=per_slot_tgts[slot]
-        scored=[]
-        for c in cands:
-            sig = tuple(sorted(c.names))
-            if sig in no_repeat_signatures:
-                continue
-            s=score_candidate(c, slot, tg)
-            main_c = c.cuisines[0] if c.cuisines else "universal"
-            s -= 0.15 * cuisine_bias.get(main_c, 0)
-            ing_penalty = 0.0
-            for nm in c.names:
-                ing_penalty += ingredient_usage.get(str(nm).strip().lower(), 0)
-            s -= 0.12 * ing_penalty
-            if validated_pairings:
-                names_lc = {str(n).strip().lower() for n in c.names}
-                for pair in validated_pairings:
-                    try:
-                        if pair and pair.issubset(names_lc):
-                            s += 0.25
-                            break
-                    except Exception:
-                        try:
-                            pset = set([str(x).strip().lower() for x in pair])
-                            if pset and pset.issubset(names_lc):
-                                s += 0.25
-                                break
-                        except Exception:
-                            continue
-            scored.append((c, s))
-        scored.sort(key=lambda x:-x[1])
-        # Use top_k parameter instead of hardcoded 30
-        per_slot_lists[slot]=scored[:top_k]
+    rngs = slot_rngs(seed) if seed is not None else {s: _rng(rng) for s in SLOTS}
+    prof = _PROFILE.get(); day_rec = prof.day() if prof is not None else None
 
-    best=None; best_cost=1e9; meta={}
-    B=per_slot_lists["breakfast"]; L=per_slot_lists["lunch"]; D=per_slot_lists["dinner"]
-    for (cb,sb) in B:
-        for (cl,sl) in L:
-            for (cd,sd) in D:
-                Pday=cb.P+cl.P+cd.P; Cday=cb.C+cl.C+cd.C; Fday=cb.F+cl.F+cd.F
-                rel=(abs(Pday-P)/(P+1e-6)+abs(Cday-C)/(C+1e-6)+abs(Fday-F)/(F+1e-6))/3.0
-                distinct_cuisines = len({(cb.cuisines[0] if cb.cuisines else "universal"),
-                                        (cl.cuisines[0] if cl.cuisines else "universal"),
-                                        (cd.cuisines[0] if cd.cuisines else "universal")})
-                diversity_bonus = 0.04 * distinct_cuisines
-                quality=(sb+sl+sd)/3.0 + diversity_bonus
-                cost=0.65*rel - 0.35*quality
-                if cost<best_cost:
-                    best_cost=cost; best=(cb,cl,cd); meta={"rel_err":float(rel), "quality":float(quality)}
+    def slot_list(slot: str) -> List[Tuple[Cand,float]]:
+        rec = prof.slot(day_rec, slot) if prof is not None else None
+        token = _SLOT_REC.set(rec)  # per thread: worker threads start from an empty context
+        try:
+            tg=per_slot_tgts[slot]; r=rngs[slot]
+            if bank is not None:
+                batch=_timed(rec, "generate_ms", bank.draw, df, slot, allergens, batch_size, r)
+                return _timed(rec, "score_ms", score_slot_batch, batch, slot, tg, no_repeat_signatures, cuisine_bias,
+                              ingredient_usage, validated_pairings, top_k=top_k)
+            pool=_timed(rec, "pool_ms", slot_pool, df, slot, allergens)
+            if rec is not None: rec["pool_rows"]=len(pool)
+            if batched:
+                batch=_timed(rec, "generate_ms", generate_batch_np, pool, slot, n=batch_size, rng=r)
+                batch=batch.take(r.permutation(len(batch)))
+                return _timed(rec, "score_ms", score_slot_batch, batch, slot, tg, no_repeat_signatures, cuisine_bias,
+                              ingredient_usage, validated_pairings, top_k=top_k)
+            # Use batch_size parameter instead of hardcoded 360
+            cat=_as_catalog(pool)
+            cands=_timed(rec, "generate_ms", generate_batch, cat, slot, n=batch_size, rng=r)
+            r.shuffle(cands)  # Add randomness to candidate order
+            scored=_timed(rec, "score_ms", score_slot, cands, slot, tg, no_repeat_signatures, cuisine_bias,
+                          ingredient_usage, validated_pairings, cat=cat)
+            # Use top_k parameter instead of hardcoded 30
+            return scored[:top_k]
+        finally:
+            _SLOT_REC.reset(token)
 
-    b,l,d = best
-    out["meals"]["breakfast"]={"names":b.names,"roles":b.roles,"cuisines":b.cuisines,
-                               "macros":{"P":b.P,"C":b.C,"F":b.F,"kcal":b.kcal},"price":b.price}
-    out["meals"]["lunch"]={"names":l.names,"roles":l.roles,"cuisines":l.cuisines,
-                           "macros":{"P":l.P,"C":l.C,"F":l.F,"kcal":l.kcal},"price":l.price}
-    out["meals"]["dinner"]={"names":d.names,"roles":d.roles,"cuisines":d.cuisines,
-                            "macros":{"P":d.P,"C":d.C,"F":d.F,"kcal":d.kcal},"price":d.price}
-    out["info"]=meta
-    out["totals"]={"P":b.P+l.P+d.P,"C":b.C+l.C+d.C,"F":b.F+l.F+d.F,"kcal":b.kcal+l.kcal+d.kcal,"price":b.price+l.price+d.price}
-    for c in [b,l,d]:
-        no_repeat_signatures.add(tuple(sorted(c.names)))
-        cu = c.cuisines[0] if c.cuisines else "universal"
-        cuisine_bias[cu] = cuisine_bias.get(cu, 0) + 1
-        for nm in c.names:
-            key = str(nm).strip().lower()
-            ingredient_usage[key] = ingredient_usage.get(key, 0) + 1
+    if seed is not None and workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(min(workers, len(SLOTS))) as ex:
+            per_slot_lists = dict(zip(SLOTS, ex.map(slot_list, SLOTS)))
+    else:
+        per_slot_lists = {slot: slot_list(slot) for slot in SLOTS}
+
+    if top_lists is not None: top_lists.append(per_slot_lists)
+    B, L, D = per_slot_lists["breakfast"], per_slot_lists["lunch"], per_slot_lists["dinner"]
+    best, meta = _timed(day_rec, "combo_ms", best_combo, B, L, D, P,C,F)
+    if prof is not None:
+        day_rec["combos"] += len(B)*len(L)*len(D); prof.close_day(day_rec)
+    return commit_day(best, meta, no_repeat_signatures, cuisine_bias, ingredient_usage)
+
+def meal_json(c:Cand) -> Dict[str,Any]:
+    return {"names":c.names,"roles":c.roles,"cuisines":c.cuisines,
+            "macros":{"P":c.P,"C":c.C,"F":c.F,"kcal":c.kcal},"price":c.price}
+
+def day_totals(meals:Dict[str,Dict[str,Any]]) -> Dict[str,float]:
+    b,l,d = (meals[s]["macros"] for s in SLOTS)
+    return {"P":b["P"]+l["P"]+d["P"],"C":b["C"]+l["C"]+d["C"],"F":b["F"]+l["F"]+d["F"],
+            "kcal":b["kcal"]+l["kcal"]+d["kcal"],
+            "price":meals["breakfast"]["price"]+meals["lunch"]["price"]+meals["dinner"]["price"]}
+
+def _record_meal(names:List[str], cuisines:List[str], no_repeat_signatures:set,
+                 cuisine_bias:Dict[str,int], ingredient_usage:Dict[str,int]) -> None:
+    no_repeat_signatures.add(meal_signature(names))
+    cu = cuisines[0] if cuisines else "universal"
+    cuisine_bias[cu] = cuisine_bias.get(cu, 0) + 1
+    for nm in names:
+        key = str(nm).strip().lower()
+        ingredient_usage[key] = ingredient_usage.get(key, 0) + 1
+
+def _forget_meal(names:List[str], cuisines:List[str], cuisine_bias:Dict[str,int],
+                 ingredient_usage:Dict[str,int]) -> None:
+    """Undo _record_meal's fatigue counts (the signature is handled by the caller)."""
+    def dec(d:Dict[str,int], k:str) -> None:
+        v = d.get(k, 0) - 1
+        if v > 0: d[k] = v
+        else: d.pop(k, None)
+    dec(cuisine_bias, cuisines[0] if cuisines else "universal")
+    for nm in names: dec(ingredient_usage, str(nm).strip().lower())
+
+def commit_day(best:Tuple[Cand,Cand,Cand], meta:Dict[str,float], no_repeat_signatures:set,
+               cuisine_bias:Dict[str,int], ingredient_usage:Dict[str,int]) -> Dict[str,Any]:
+    """Day output for the chosen (breakfast, lunch, dinner) and the diversity-state update."""
+    out={"meals":{s: meal_json(c) for s, c in zip(SLOTS, best)}, "info":meta}
+    out["totals"]=day_totals(out["meals"])
+    for c in best:
+        _record_meal(c.names, c.cuisines, no_repeat_signatures, cuisine_bias, ingredient_usage)
     return out
 
 # --------------- weekly planner -----------
-def build_week(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str], validated_pairings:Optional[List[set]] = None) -> Dict[str,Any]:
-    days=[]; no_repeat=set(); cuisine_bias={}; ingredient_usage={}
-    for day in range(1,8):
-        day_out = pick_day(df, P,C,F, allergens, no_repeat, cuisine_bias, ingredient_usage, validated_pairings=validated_pairings)
-        day_out["day"]=day
-        days.append(day_out)
-
+def week_totals(days:List[Dict[str,Any]]) -> Dict[str,float]:
     totals={"P":0.0,"C":0.0,"F":0.0,"kcal":0.0,"price":0.0}
     for d in days:
         for sl in SLOTS:
             m=d["meals"][sl]["macros"]
             totals["P"]+=m["P"]; totals["C"]+=m["C"]; totals["F"]+=m["F"]; totals["kcal"]+=m["kcal"]
             totals["price"]+=d["meals"][sl]["price"]
-    return {"inputs":{"daily_P":P,"daily_C":C,"daily_F":F,"allergens":allergens},
-            "days":days, "weekly_totals":totals}
+    return totals
+
+def iter_days(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str], batch_size:int=360, top_k:int=30,
+              validated_pairings:Optional[List[set]] = None, batched:bool=False,
+              rng:Optional[np.random.Generator] = None, seed:Any = None, workers:int = 1,
+              top_lists:Optional[List[Dict[str,Any]]] = None, solver:str = "sample",
+              bank:Optional["CandidateBank"] = None) -> Iterator[Dict[str,Any]]:
+    """
+    The greedy week one day at a time: each day's output is final when yielded,
+    so callers can forward it before the next day is planned. The defaults are
+    pick_day's settings. solver="exact" picks days with pick_day_exact (top_k
+    still sizes the combo search; batch_size, batched and workers are unused).
+    With a CandidateBank, sampling draws from the bank instead of generating.
+    """
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver: {solver}. Must be one of {list(SOLVERS)}")
+    validated_pairings = as_pairing_index(validated_pairings)
+    no_repeat=set(); cuisine_bias={}; ingredient_usage={}
+    for day in range(1,8):
+        day_out = plan_day(df, P,C,F, allergens, no_repeat, cuisine_bias, ingredient_usage,
+                           batch_size=batch_size, top_k=top_k, validated_pairings=validated_pairings,
+                           batched=batched, rng=rng, seed=None if seed is None else seed_child(seed, day-1),
+                           workers=workers, top_lists=top_lists, solver=solver, bank=bank)
+        day_out["day"]=day
+        yield day_out
+
+def plan_day(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str],
+             no_repeat_signatures:set, cuisine_bias:Dict[str,int], ingredient_usage:Dict[str,int],
+             batch_size:int=360, top_k:int=30, validated_pairings:Any = None, batched:bool=False,
+             rng:Optional[np.random.Generator] = None, seed:Any = None, workers:int = 1,
+             top_lists:Optional[List[Dict[str,Any]]] = None, solver:str = "sample",
+             bank:Optional["CandidateBank"] = None) -> Dict[str,Any]:
+    """One greedy day against the given diversity state, with the solver iter_days would use."""
+    if solver == "exact":
+        return pick_day_exact(df, P,C,F, allergens, no_repeat_signatures, cuisine_bias, ingredient_usage, top_k=top_k,
+                              validated_pairings=validated_pairings, rng=rng, seed=seed, top_lists=top_lists)
+    return pick_day_with_params(df, P,C,F, allergens, no_repeat_signatures, cuisine_bias, ingredient_usage,
+                                batch_size=batch_size, top_k=top_k, validated_pairings=validated_pairings,
+                                batched=batched, rng=rng, seed=seed, workers=workers, top_lists=top_lists, bank=bank)
+
+def build_week(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str], validated_pairings:Optional[List[set]] = None,
+               rng:Optional[np.random.Generator] = None, seed:Any = None, workers:int = 1,
+               refine:bool = False, bank:Optional["CandidateBank"] = None) -> Dict[str,Any]:
+    validated_pairings = as_pairing_index(validated_pairings)
+    top_lists: Optional[List[Dict[str,Any]]] = [] if refine else None
+    days = list(iter_days(df, P,C,F, allergens, validated_pairings=validated_pairings,
+                          rng=rng, seed=seed, workers=workers, top_lists=top_lists, bank=bank))
+
+    stats = refine_week(days, top_lists, P,C,F, validated_pairings) if refine else None
+    totals=week_totals(days)
+    out = {"inputs":{"daily_P":P,"daily_C":C,"daily_F":F,"allergens":allergens},
+           "days":days, "weekly_totals":totals}
+    if stats is not None: out["refine"]=stats
+    return out
+
+# --------------- week refinement -----------
+# Per extra use of an ingredient / main cuisine, at combo-cost scale: the greedy pass
+# subtracts 0.12 / 0.15 per prior use from a meal score, which enters the combo cost
+# as -0.35 * score / 3.
+_REFINE_ING, _REFINE_CUISINE = 0.35*0.12/3, 0.35*0.15/3
+
+def _pairs(counts: Dict[str,int]) -> int:
+    return sum(c*(c-1)//2 for c in counts.values())
+
+def refine_week(days:List[Dict[str,Any]], top_lists:List[Dict[str,List[Tuple[Cand,float]]]],
+                P:float,C:float,F:float, validated_pairings:Any = None, max_passes:int = 20) -> Dict[str,Any]:
+    """
+    Local search over a greedy week, in place. The week objective is the sum of
+    day costs (best_combo's 0.65*rel_err - 0.35*quality, with fatigue-free meal
+    scores) plus a penalty per repeated pair of ingredient uses and of main
+    cuisines across the week. Moves, all drawn from the days' cached top-k lists:
+      replace - put another candidate for the slot (any day's list; the targets
+                are the same every day) into a day, keeping signatures unique;
+      swap    - exchange the same slot between two days.
+    Each move is priced from the one or two day costs and the handful of count
+    changes it touches, so a delta is O(1) in the size of the week. Each pass
+    applies the best improving move per (day, slot) until a pass changes nothing.
+    Days get fresh info (rel_err, quality on the fatigue-free scale).
+    """
+    import time
+    t0 = time.perf_counter()
+    tgts = {s: slot_targets(P,C,F,s) for s in SLOTS}
+    cands: Dict[str, List[Cand]] = {s: [] for s in SLOTS}; ix: Dict[str, Dict[int,int]] = {s: {} for s in SLOTS}
+    for lists in top_lists:
+        for s in SLOTS:
+            for c, _ in lists[s]:
+                sig = cand_signature(c)
+                if sig not in ix[s]: ix[s][sig] = len(cands[s]); cands[s].append(c)
+    sigs = {s: list(ix[s]) for s in SLOTS}
+    score = {s: [adjusted_score(c, s, tgts[s], {}, {}, validated_pairings) for c in cands[s]] for s in SLOTS}
+    main = {s: [c.cuisines[0] if c.cuisines else "universal" for c in cands[s]] for s in SLOTS}
+    items = {s: [[str(n).strip().lower() for n in c.names] for c in cands[s]] for s in SLOTS}
+    assign = [{s: ix[s][meal_signature(d["meals"][s]["names"])] for s in SLOTS} for d in days]
+
+    def day_cost(a: Dict[str,int]) -> Tuple[float,float,float]:
+        cs = [cands[s][a[s]] for s in SLOTS]
+        Pd = cs[0].P+cs[1].P+cs[2].P; Cd = cs[0].C+cs[1].C+cs[2].C; Fd = cs[0].F+cs[1].F+cs[2].F
+        rel = (abs(Pd-P)/(P+1e-6)+abs(Cd-C)/(C+1e-6)+abs(Fd-F)/(F+1e-6))/3.0
+        quality = sum(score[s][a[s]] for s in SLOTS)/3.0 + 0.04*len({main[s][a[s]] for s in SLOTS})
+        return 0.65*rel - 0.35*quality, rel, quality
+
+    ing: Dict[str,int] = {}; cui: Dict[str,int] = {}; used = set()
+    for a in assign:
+        for s in SLOTS:
+            for n in items[s][a[s]]: ing[n] = ing.get(n, 0) + 1
+            cui[main[s][a[s]]] = cui.get(main[s][a[s]], 0) + 1
+            used.add(sigs[s][a[s]])
+    cost = [day_cost(a)[0] for a in assign]
+    def objective() -> float:
+        return sum(cost) + _REFINE_ING*_pairs(ing) + _REFINE_CUISINE*_pairs(cui)
+    before = objective()
+
+    def count_delta(counts: Dict[str,int], out_: List[str], in_: List[str]) -> int:
+        ch: Dict[str,int] = {}
+        for n in out_: ch[n] = ch.get(n, 0) - 1
+        for n in in_: ch[n] = ch.get(n, 0) + 1
+        dl = 0
+        for n, k in ch.items():
+            if k: c = counts.get(n, 0); dl += ((c+k)*(c+k-1) - c*(c-1))//2
+        return dl
+    def apply_counts(counts: Dict[str,int], out_: List[str], in_: List[str]) -> None:
+        for n in out_: counts[n] -= 1
+        for n in in_: counts[n] = counts.get(n, 0) + 1
+
+    passes = replaces = swaps = 0
+    while passes < max_passes:
+        passes += 1; moved = False
+        for di, a in enumerate(assign):
+            for s in SLOTS:
+                cur = a[s]; best_d = -1e-12; best_mv = None
+                for j in range(len(cands[s])):
+                    if sigs[s][j] in used: continue
+                    a[s] = j; nc = day_cost(a)[0]; a[s] = cur
+                    d = (nc - cost[di] + _REFINE_ING*count_delta(ing, items[s][cur], items[s][j])
+                         + _REFINE_CUISINE*count_delta(cui, [main[s][cur]], [main[s][j]]))
+                    if d < best_d: best_d = d; best_mv = ("replace", j, nc)
+                for dj, b in enumerate(assign):
+                    if dj == di or b[s] == cur: continue
+                    other = b[s]
+                    a[s] = other; b[s] = cur
+                    nci = day_cost(a)[0]; ncj = day_cost(b)[0]
+                    a[s] = cur; b[s] = other
+                    d = nci + ncj - cost[di] - cost[dj]
+                    if d < best_d: best_d = d; best_mv = ("swap", dj, nci, ncj)
+                if best_mv is None: continue
+                moved = True
+                if best_mv[0] == "replace":
+                    j = best_mv[1]
+                    apply_counts(ing, items[s][cur], items[s][j]); apply_counts(cui, [main[s][cur]], [main[s][j]])
+                    used.discard(sigs[s][cur]); used.add(sigs[s][j])
+                    a[s] = j; cost[di] = best_mv[2]; replaces += 1
+                else:
+                    dj = best_mv[1]; b = assign[dj]
+                    a[s], b[s] = b[s], cur; cost[di] = best_mv[2]; cost[dj] = best_mv[3]; swaps += 1
+        if not moved: break
+
+    for d, a in zip(days, assign):
+        _, rel, quality = day_cost(a)
+        day = commit_day(tuple(cands[s][a[s]] for s in SLOTS), {"rel_err": float(rel), "quality": float(quality)},
+                         set(), {}, {})
+        d["meals"] = day["meals"]; d["totals"] = day["totals"]; d["info"] = day["info"]
+    return {"passes": passes, "replaces": replaces, "swaps": swaps,
+            "objective_before": float(before), "objective_after": float(objective()),
+            "elapsed_ms": round((time.perf_counter()-t0)*1000, 2)}
+
+# --------------- anytime planner -----------
+_ANYTIME_FIRST, _ANYTIME_MAX = 32, 512  # candidates per slot in the first / largest round
+
+def _merge_top(cur:List[Tuple[Cand,float]], new:List[Tuple[Cand,float]], top_k:int) -> List[Tuple[Cand,float]]:
+    """Best top_k of both lists by score (stable), one entry per ingredient signature."""
+    seen=set(); out=[]
+    for c, s in sorted(cur + new, key=lambda cs: -cs[1]):
+        sig = cand_signature(c)
+        if sig in seen: continue
+        seen.add(sig); out.append((c, s))
+        if len(out) == top_k: break
+    return out
+
+def pick_day_anytime(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str],
+                     no_repeat_signatures:set, cuisine_bias:Dict[str,int], ingredient_usage:Dict[str,int],
+                     deadline:float, top_k:int=30, validated_pairings:Any = None,
+                     rng:Optional[np.random.Generator] = None, seed:Any = None) -> Dict[str,Any]:
+    """
+    Day selection that keeps sampling until `deadline` (time.perf_counter()).
+    Each round draws a batch per slot with the vectorized generator, merges it into
+    the per-slot top-k and re-runs best_combo; the batch doubles while the next
+    round is predicted to fit. At least one round always runs, so a day is returned
+    even with an exhausted budget. info["search"] reports the work done.
+    """
+    import time
+    t0 = time.perf_counter()
+    tgts = {s: slot_targets(P,C,F,s) for s in SLOTS}
+    rngs = slot_rngs(seed) if seed is not None else {s: _rng(rng) for s in SLOTS}
+    prof = _PROFILE.get(); day_rec = prof.day() if prof is not None else None
+    recs = {s: prof.slot(day_rec, s) if prof is not None else None for s in SLOTS}
+    pools = {s: _timed(recs[s], "pool_ms", slot_pool, df, s, allergens) for s in SLOTS}
+    if prof is not None:
+        for s in SLOTS: recs[s]["pool_rows"] = len(pools[s])
+    lists: Dict[str, List[Tuple[Cand,float]]] = {s: [] for s in SLOTS}
+    best = None; meta: Dict[str,float] = {}; n = _ANYTIME_FIRST
+    rounds = cands = combos = 0
+    while True:
+        r0 = time.perf_counter()
+        for slot in SLOTS:
+            r = rngs[slot]; rec = recs[slot]; token = _SLOT_REC.set(rec)
+            try:
+                batch = _timed(rec, "generate_ms", generate_batch_np, pools[slot], slot, n=n, rng=r)
+                batch = batch.take(r.permutation(len(batch)))
+                cands += len(batch)
+                scored = _timed(rec, "score_ms", score_slot_batch, batch, slot, tgts[slot], no_repeat_signatures,
+                                cuisine_bias, ingredient_usage, validated_pairings, top_k=top_k)
+            finally:
+                _SLOT_REC.reset(token)
+            lists[slot] = _merge_top(lists[slot], scored, top_k)
+        combos += len(lists["breakfast"]) * len(lists["lunch"]) * len(lists["dinner"])
+        best, meta = _timed(day_rec, "combo_ms", best_combo, lists["breakfast"], lists["lunch"], lists["dinner"], P,C,F)
+        rounds += 1
+        now = time.perf_counter(); took = now - r0
+        if now + took > deadline: break
+        if n < _ANYTIME_MAX and now + 2*took <= deadline: n *= 2
+    if best is None:
+        raise RuntimeError(f"No feasible day: a slot has no candidates for allergens {allergens}")
+    if prof is not None:
+        day_rec["combos"] += combos; prof.close_day(day_rec)
+    out = commit_day(best, meta, no_repeat_signatures, cuisine_bias, ingredient_usage)
+    out["info"]["search"] = {"rounds": rounds, "candidates": cands, "combos": combos,
+                             "elapsed_ms": round((time.perf_counter()-t0)*1000, 2)}
+    return out
+
+def iter_days_anytime(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str], budget_ms:float = 300.0,
+                      top_k:int = 30, validated_pairings:Optional[List[set]] = None,
+                      rng:Optional[np.random.Generator] = None, seed:Any = None) -> Iterator[Dict[str,Any]]:
+    """
+    Anytime week one day at a time. The clock starts at the first day, and the
+    remaining budget is split evenly over the remaining days, so slack left by a
+    fast day carries over to the next.
+    """
+    import time
+    end = time.perf_counter() + max(float(budget_ms), 0.0) / 1000.0
+    validated_pairings = as_pairing_index(validated_pairings)
+    no_repeat=set(); cuisine_bias={}; ingredient_usage={}
+    for day in range(1,8):
+        now = time.perf_counter()
+        day_out = pick_day_anytime(df, P,C,F, allergens, no_repeat, cuisine_bias, ingredient_usage,
+                                   deadline=now + max(end-now, 0.0)/(8-day), top_k=top_k,
+                                   validated_pairings=validated_pairings, rng=rng,
+                                   seed=None if seed is None else seed_child(seed, day-1))
+        day_out["day"]=day
+        yield day_out
+
+def anytime_search(days:List[Dict[str,Any]], budget_ms:float, elapsed_ms:float) -> Dict[str,Any]:
+    errs=[d["info"]["rel_err"] for d in days]
+    return {"budget_ms": float(budget_ms), "elapsed_ms": round(elapsed_ms, 2),
+            "rounds": sum(d["info"]["search"]["rounds"] for d in days),
+            "candidates_evaluated": sum(d["info"]["search"]["candidates"] for d in days),
+            "combos_searched": sum(d["info"]["search"]["combos"] for d in days),
+            "rel_err": float(np.mean(errs)), "max_rel_err": float(max(errs)),
+            "quality": float(np.mean([d["info"]["quality"] for d in days]))}
+
+def build_week_anytime(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str], budget_ms:float = 300.0,
+                       top_k:int = 30, validated_pairings:Optional[List[set]] = None,
+                       rng:Optional[np.random.Generator] = None, seed:Any = None) -> Dict[str,Any]:
+    """
+    Build a week within a wall-clock budget instead of a fixed preset (see
+    iter_days_anytime). The week can overrun by at most one minimal round per day.
+    "search" sums the work done; rel_err is the mean (and worst) daily relative
+    macro error of the plan returned, quality the mean day quality (best_combo
+    trades the two, so more budget lowers their combined cost rather than
+    rel_err alone).
+    """
+    import time
+    t0 = time.perf_counter()
+    days = list(iter_days_anytime(df, P,C,F, allergens, budget_ms=budget_ms, top_k=top_k,
+                                  validated_pairings=validated_pairings, rng=rng, seed=seed))
+    search = anytime_search(days, budget_ms, (time.perf_counter()-t0)*1000)
+    return {"inputs":{"daily_P":P,"daily_C":C,"daily_F":F,"allergens":allergens,"budget_ms":float(budget_ms)},
+            "days":days, "weekly_totals":week_totals(days), "search":search}
+
+# --------------- exact solver -----------
+SOLVERS = ("sample", "exact")
+# rows kept per role, macro buckets per slot target, DP states kept per layer,
+# cuisine targets per slot, meals returned per cuisine target
+_EXACT_ROWS, _EXACT_GRID, _EXACT_STATES, _EXACT_CUISINES, _EXACT_KEEP = 8, 40, 512, 4, 24
+# Weight of a meal's relative macro error, in adjusted_score units: its own 0.45 plus
+# the day rel_err it moves, which best_combo weighs 0.65 against 0.35 x mean slot score.
+_EXACT_REL = 0.45 + 0.65/0.35
+
+def _role_options(t:Dict[str,Any], rows:np.ndarray, lo:int, hi:int, base:int) -> Dict[str,np.ndarray]:
+    """Every subset of `rows` with lo..hi items as a padded (O, hi) matrix, plus its sums."""
+    from itertools import combinations
+    subs = [c for k in range(lo, hi+1) for c in combinations(rows.tolist(), k)]
+    opt = np.full((len(subs), max(hi, 1)), -1, dtype=np.int64)
+    for i, c in enumerate(subs): opt[i, :len(c)] = c
+    n = (opt >= 0).sum(axis=1)
+    return {"opt": opt, "n": n, "extra": np.maximum(n - base, 0),
+            "P": t["protein"][opt].sum(axis=1), "C": t["carbs"][opt].sum(axis=1), "F": t["fat"][opt].sum(axis=1)}
+
+def solve_slot(pool:Any, slot:str, tgt:Dict[str,float], cuisine:Optional[int] = None,
+               penalty:Optional[np.ndarray] = None, rng:Optional[np.random.Generator] = None,
+               rows:int = _EXACT_ROWS, grid:int = _EXACT_GRID, max_states:int = _EXACT_STATES,
+               keep:int = _EXACT_KEEP) -> Tuple[np.ndarray, np.ndarray, Dict[str,Any]]:
+    """
+    Best meals for one slot by dynamic programming over discretized macros.
+    Each layer is one role and picks a subset of its rows: exactly the required
+    count, up to optional_max otherwise, never a second dressing_sauce; when the
+    pool cannot reach the minimum item count, roles may go over their maximum
+    for meals of exactly that minimum (the sampler's fill step). Every state is
+    therefore a valid composition. States are merged per (items, fill items,
+    macro bucket of tgt/grid) keeping the lowest penalty, and dropped once their
+    overshoot plus the undershoot the remaining layers cannot make up leaves no
+    macro score. Meals are ranked by
+      _EXACT_REL*rel_err + penalty - 0.10*count_score
+    (the macro, count and fatigue terms of adjusted_score, macros weighted as
+    best_combo sees them); banned and cuisine-less ones are dropped.
+    cuisine:    code into cuisine_names(cat); optional roles then prefer rows of
+                that cuisine or "universal", like sample_candidate. None = all rows.
+    penalty:    per catalog row cost, e.g. 0.12 * ingredient usage.
+    rows:       rows kept per role, lowest penalty first (ties in rng order).
+    max_states: states kept per layer, by estimated final cost; this bounds the
+                runtime. stats["exact"] is True when no layer was cut, i.e. the
+                result is optimal up to the grid.
+    Returns (idx, count, stats) of up to `keep` meals, best first.
+    """
+    cat = _as_catalog(pool); t = _batch_tables(cat); comp = COMPOSITION[slot]; rng = _rng(rng)
+    mn, mx = comp["total_range"]; eps = 1e-6
+    pen = np.zeros(len(cat)) if penalty is None else np.asarray(penalty, dtype=np.float64)
+    allowed = t["prefer"][cuisine] if cuisine is not None else np.ones(len(cat), dtype=bool)
+    stats: Dict[str,Any] = {"layers": 0, "states": 0, "exact": True}
+    empty = (np.full((0, mx), -1, dtype=np.int64), np.zeros(0, dtype=np.int64), stats)
+
+    bounds = {role: (k, k) for role, k in comp["required"].items()}
+    for role, k in comp["optional_max"].items(): bounds[role] = (0, k)
+    by_role = {}
+    for role, r in cat.by_role.items():
+        if bounds.get(role, (0, 0))[0] == 0 and allowed[r].any(): r = r[allowed[r]]  # as sample_candidate's preferred()
+        if len(r) > rows: r = r[np.lexsort((rng.random(len(r)), pen[r]))][:rows]
+        if len(r): by_role[role] = np.sort(r)
+    if any(len(by_role.get(role, ())) < lo for role, (lo, _) in bounds.items()): return empty
+    fill = max(0, mn - sum(min(hi, len(by_role.get(role, ()))) for role, (_, hi) in bounds.items()))
+    layers = []
+    for role in list(bounds) + sorted(set(by_role) - set(bounds)):
+        r = by_role.get(role)
+        if r is None: continue
+        lo, hi = bounds.get(role, (0, 0))
+        ext = max(hi, min(fill, 1)) if role == "dressing_sauce" else hi + fill
+        ext = min(ext, len(r))
+        if ext > 0: layers.append(_role_options(t, r, lo, ext, hi))
+    if not layers: return empty
+    for o in layers: o["pen"] = np.append(pen, 0.0)[o["opt"]].sum(axis=1)
+
+    T0 = np.asarray([tgt["P"], tgt["C"], tgt["F"]]); T = T0 + eps
+    # what the layers after i can still add: most macros (bound), median macros
+    # (cut priority), fewest and most items
+    rem = np.zeros((len(layers)+1, 3)); mid = rem.copy(); rem_lo = np.zeros(len(layers)+1, dtype=np.int64)
+    rem_hi = np.zeros(len(layers)+1, dtype=np.int64)
+    for i in range(len(layers)-1, -1, -1):
+        o = layers[i]
+        rem[i] = rem[i+1] + [o["P"].max(), o["C"].max(), o["F"].max()]
+        mid[i] = mid[i+1] + [np.median(o["P"]), np.median(o["C"]), np.median(o["F"])]
+        rem_lo[i] = rem_lo[i+1] + o["n"].min(); rem_hi[i] = rem_hi[i+1] + o["n"].max()
+    NB = 4*grid + 1
+    n = np.zeros(1, dtype=np.int64); ex = n.copy(); X = np.zeros((1, 3)); spen = np.zeros(1)
+    trail: List[Tuple[np.ndarray, np.ndarray]] = []
+    for i, o in enumerate(layers):
+        nn = n[:, None] + o["n"][None, :]; ne = ex[:, None] + o["extra"][None, :]
+        ok = (ne <= fill) & (nn + rem_lo[i+1] <= mx) & (nn + rem_hi[i+1] >= mn)
+        si, oi = np.nonzero(ok)
+        nX = X[si] + np.stack([o["P"], o["C"], o["F"]], axis=1)[oi]; npen = spen[si] + o["pen"][oi]
+        gap = (np.maximum(nX - T0, 0.0) + np.maximum(T0 - nX - rem[i+1], 0.0)) / T
+        lb = gap.sum(axis=1) / 3.0
+        live = lb < 1.0
+        si, oi, nX, npen, lb = si[live], oi[live], nX[live], npen[live], lb[live]
+        nn = nn[si, oi]; ne = ne[si, oi]
+        b = np.minimum(np.floor(nX / T * grid), NB - 1).astype(np.int64)
+        key = (((nn * (fill+1) + ne) * NB + b[:, 0]) * NB + b[:, 1]) * NB + b[:, 2]
+        order = np.lexsort((npen, key))
+        first = order[np.r_[True, key[order][1:] != key[order][:-1]]] if len(order) else order
+        if len(first) > max_states:
+            est = (np.abs(nX[first] + mid[i+1] - T0) / T).sum(axis=1) / 3.0
+            first = first[np.argsort(_EXACT_REL*est + npen[first], kind="stable")[:max_states]]
+            stats["exact"] = False
+        stats["states"] += len(first)
+        trail.append((si[first], oi[first]))
+        n, ex, X, spen = nn[first], ne[first], nX[first], npen[first]
+    stats["layers"] = len(layers)
+
+    done = (n >= mn) & (n <= mx) & ((ex == 0) | (n == mn))
+    rel = (np.abs(X - T0) / T).sum(axis=1) / 3.0
+    cnt = np.asarray([_count_score_n(k, slot) for k in range(mx+1)])[np.minimum(n, mx)]
+    cost = np.where(done, _EXACT_REL*rel + spen - 0.10*cnt, np.inf)
+    best = np.argsort(cost, kind="stable")[:2*keep]
+    best = best[np.isfinite(cost[best])]
+    picks = []; cur = best
+    for o, (si, oi) in zip(reversed(layers), reversed(trail)):
+        picks.append(o["opt"][oi[cur]]); cur = si[cur]
+    idx = np.full((len(best), mx), -1, dtype=np.int64); count = n[best].copy()
+    at = np.zeros(len(best), dtype=np.int64)
+    for p in reversed(picks):  # layer order: required roles first, as the sampler does
+        for j in range(p.shape[1]):
+            has = p[:, j] >= 0
+            idx[has, at[has]] = p[has, j]; at += has
+    cuis = _batch_majority(t, idx)
+    ok = _ban_ok(t, idx) & (cuis != -2)
+    return idx[ok][:keep], count[ok][:keep], stats
+
+def pick_day_exact(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str],
+                   no_repeat_signatures:set, cuisine_bias:Dict[str,int], ingredient_usage:Dict[str,int],
+                   top_k:int=30, validated_pairings:Any = None, rng:Optional[np.random.Generator] = None,
+                   seed:Any = None, top_lists:Optional[List[Dict[str,Any]]] = None) -> Dict[str,Any]:
+    """
+    pick_day with solve_slot in place of random sampling: per slot, the best meals
+    for the least-used cuisines (up to _EXACT_CUISINES) with today's ingredient
+    fatigue as penalty, then the usual scoring, top_k cut and best_combo. Runtime
+    is bounded by the solver settings, not by luck. info["solver"] reports the
+    DP work and whether every layer stayed within max_states.
+    """
+    tgts = {s: slot_targets(P,C,F,s) for s in SLOTS}
+    rngs = slot_rngs(seed) if seed is not None else {s: _rng(rng) for s in SLOTS}
+    prof = _PROFILE.get(); day_rec = prof.day() if prof is not None else None
+    stats = {"states": 0, "meals": 0, "exact": True}
+
+    def slot_list(slot: str) -> List[Tuple[Cand,float]]:
+        rec = prof.slot(day_rec, slot) if prof is not None else None
+        token = _SLOT_REC.set(rec)
+        try:
+            pool = _timed(rec, "pool_ms", slot_pool, df, slot, allergens)
+            if rec is not None: rec["pool_rows"] = len(pool)
+            cat = _as_catalog(pool); t = _batch_tables(cat); K = len(t["cuisine_names"])
+            pen = 0.12 * _usage_rows(cat, ingredient_usage)[:-1]
+            rows = np.bincount(t["codes"], minlength=K)
+            targets = sorted((c for c in range(K) if rows[c]), key=lambda c: (cuisine_bias.get(t["cuisine_names"][c], 0), -rows[c]))
+            targets = targets[:_EXACT_CUISINES] or [K]
+            parts = []
+            for c in targets:
+                idx, count, st = _timed(rec, "generate_ms", solve_slot, cat, slot, tgts[slot], cuisine=c,
+                                        penalty=pen, rng=rngs[slot])
+                parts.append((idx, count)); stats["states"] += st["states"]; stats["exact"] &= st["exact"]
+            batch = _make_batch(cat, np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]))
+            stats["meals"] += len(batch)
+            if rec is not None: rec["attempts"] += len(batch); rec["accepted"] += len(batch)
+            return _timed(rec, "score_ms", score_slot_batch, batch, slot, tgts[slot], no_repeat_signatures,
+                          cuisine_bias, ingredient_usage, validated_pairings, top_k=top_k)
+        finally:
+            _SLOT_REC.reset(token)
+
+    lists = {slot: slot_list(slot) for slot in SLOTS}
+    if top_lists is not None: top_lists.append(lists)
+    B, L, D = lists["breakfast"], lists["lunch"], lists["dinner"]
+    best, meta = _timed(day_rec, "combo_ms", best_combo, B, L, D, P,C,F)
+    if prof is not None:
+        day_rec["combos"] += len(B)*len(L)*len(D); prof.close_day(day_rec)
+    if best is None:
+        raise RuntimeError(f"No feasible day: a slot has no valid meal for allergens {allergens}")
+    out = commit_day(best, meta, no_repeat_signatures, cuisine_bias, ingredient_usage)
+    out["info"]["solver"] = stats
+    return out
+
+# --------------- rolling horizon -----------
+HORIZON_FORMAT = 1
+
+class HorizonState:
+    """
+    Diversity state carried across the days, weeks and runs of the horizon planner.
+    Fatigue (cuisine_bias, ingredient_usage) counts only the meals of the last
+    `window` days and exact repeats are blocked for `repeat_window` days, so the
+    state - and the cost of planning a day - stays bounded however long the
+    horizon, and the fatigue terms cannot drag every score negative. `day` is the
+    last planned or recorded day; to_json / save round-trip everything later days
+    depend on, so a resumed run plans the same days as an uninterrupted one.
+    """
+    def __init__(self, seed: Any = None, window: int = 7, repeat_window: int = 28):
+        from collections import deque
+        self.seed = DEFAULT_SEED if seed is None else int(seed)
+        self.window = int(window); self.repeat_window = int(repeat_window)
+        if self.window < 1 or self.repeat_window < 1:
+            raise ValueError("window and repeat_window must be at least one day")
+        self.day = 0; self._faded = self._unblocked = 0  # last day dropped from fatigue / from repeats
+        self.log: "deque[Tuple[int, List[Tuple[List[str], List[str]]]]]" = deque()
+        self.no_repeat: set = set(); self.cuisine_bias: Dict[str,int] = {}; self.ingredient_usage: Dict[str,int] = {}
+        self._sig_day: Dict[int, int] = {}
+
+    def _log(self, day: int, meals: List[Tuple[List[str], List[str]]]) -> None:
+        if day <= self.day: raise ValueError(f"day {day} is not after the last recorded day {self.day}")
+        for names, _ in meals: self._sig_day[meal_signature(names)] = day
+        self.log.append((day, meals)); self.day = day
+        for d, ms in self.log:
+            if d <= self.day - self.window and d > self._faded:
+                for names, cuisines in ms: _forget_meal(names, cuisines, self.cuisine_bias, self.ingredient_usage)
+                self._faded = d
+            if d <= self.day - self.repeat_window and d > self._unblocked:
+                for names, _ in ms:
+                    sig = meal_signature(names)
+                    if self._sig_day.get(sig) == d:
+                        self.no_repeat.discard(sig); del self._sig_day[sig]
+                self._unblocked = d
+        while self.log and self.log[0][0] <= min(self._faded, self._unblocked): self.log.popleft()
+
+    def commit(self, day_out: Dict[str,Any]) -> None:
+        """Log a day the planner just chose (commit_day already counted its meals)."""
+        self._log(int(day_out["day"]), [(list(day_out["meals"][s]["names"]), list(day_out["meals"][s]["cuisines"]))
+                                         for s in SLOTS])
+
+    def record_day(self, meals: Dict[str,Dict[str,Any]], day: Optional[int] = None) -> None:
+        """Count an already delivered day ({slot: meal JSON}), by default as the day after `day`."""
+        ms = [(list(meals[s]["names"]), list(meals[s]["cuisines"])) for s in SLOTS]
+        for names, cuisines in ms:
+            _record_meal(names, cuisines, self.no_repeat, self.cuisine_bias, self.ingredient_usage)
+        self._log(self.day + 1 if day is None else int(day), ms)
+
+    def record_plan(self, plan: Dict[str,Any]) -> "HorizonState":
+        """Carry over a delivered plan (e.g. a build_week week): its days follow the current `day`."""
+        for d in plan["days"]: self.record_day(d["meals"])
+        return self
+
+    def to_json(self) -> Dict[str,Any]:
+        return {"format": HORIZON_FORMAT, "seed": self.seed, "window": self.window,
+                "repeat_window": self.repeat_window, "day": self.day,
+                "log": [{"day": d, "meals": [{"names": n, "cuisines": c} for n, c in ms]} for d, ms in self.log]}
+
+    @classmethod
+    def from_json(cls, data: Dict[str,Any]) -> "HorizonState":
+        if data.get("format") != HORIZON_FORMAT:
+            raise ValueError(f"unsupported horizon state format {data.get('format')!r}")
+        st = cls(data["seed"], data["window"], data["repeat_window"])
+        log = data["log"]
+        # Replaying the logged days reproduces the counts; days before the log are
+        # already out of both windows, so start from the first logged one.
+        if log: st.day = st._faded = st._unblocked = int(log[0]["day"]) - 1
+        for e in log:
+            st.record_day(dict(zip(SLOTS, e["meals"])), day=e["day"])
+        if int(data["day"]) > st.day: st.day = int(data["day"])
+        return st
+
+    def save(self, path: str) -> None:
+        """Atomic write, so an interrupted run never leaves a torn state file."""
+        p = Path(path); p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(p.name + ".tmp")
+        tmp.write_text(json.dumps(self.to_json(), ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, p)
+
+    @classmethod
+    def load(cls, path: str) -> "HorizonState":
+        with open(path, encoding="utf-8") as f:
+            return cls.from_json(json.load(f))
+
+def iter_horizon(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str], days:int,
+                 state:Optional[HorizonState] = None, batch_size:int=360, top_k:int=30,
+                 validated_pairings:Any = None, batched:bool=False, workers:int = 1,
+                 solver:str = "sample", bank:Optional["CandidateBank"] = None,
+                 checkpoint:Optional[str] = None) -> Iterator[Dict[str,Any]]:
+    """
+    Rolling-horizon planner: `days` more days after state.day, each picked with
+    plan_day against the windowed state and seeded by its absolute day number.
+    With a fresh state and the default windows the first 7 days are build_week's
+    (seed=state.seed). checkpoint: save the state there after every day, so an
+    interrupted run can resume from the last finished day.
+    """
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver: {solver}. Must be one of {list(SOLVERS)}")
+    state = state if state is not None else HorizonState()
+    validated_pairings = as_pairing_index(validated_pairings)
+    for _ in range(int(days)):
+        day = state.day + 1
+        day_out = plan_day(df, P,C,F, allergens, state.no_repeat, state.cuisine_bias, state.ingredient_usage,
+                           batch_size=batch_size, top_k=top_k, validated_pairings=validated_pairings,
+                           batched=batched, seed=seed_child(state.seed, day-1), workers=workers,
+                           solver=solver, bank=bank)
+        day_out["day"]=day
+        state.commit(day_out)
+        if checkpoint: state.save(checkpoint)
+        yield day_out
+
+def horizon_totals(days:List[Dict[str,Any]]) -> Dict[str,Any]:
+    """Totals per calendar week of the horizon (days 1-7, 8-14, ...) and overall."""
+    weeks: Dict[int, List[Dict[str,Any]]] = {}
+    for d in days: weeks.setdefault((d["day"]-1)//7 + 1, []).append(d)
+    return {"weekly_totals": [{"week": w, "days": len(ds), **week_totals(ds)} for w, ds in weeks.items()],
+            "totals": week_totals(days)}
+
+def build_horizon(df:pd.DataFrame, P:float,C:float,F:float, allergens:List[str], days:int = 28,
+                  state:Optional[HorizonState] = None, preset:Optional[str] = None,
+                  validated_pairings:Any = None, batched:bool=False, workers:int = 1, solver:str = "sample",
+                  bank:Optional["CandidateBank"] = None, checkpoint:Optional[str] = None) -> Dict[str,Any]:
+    """
+    Plan `days` days with iter_horizon. preset picks batch_size/top_k as in
+    build_week_with_presets (default: pick_day's settings). The plan carries the
+    final state as "state" for the next call.
+    """
+    if preset is not None and preset not in PRESETS:
+        raise ValueError(f"Unknown preset: {preset}. Must be one of {list(PRESETS.keys())}")
+    batch_size, top_k = PRESETS[preset] if preset else (360, 30)
+    state = state if state is not None else HorizonState()
+    inputs = {"daily_P":P,"daily_C":C,"daily_F":F,"allergens":allergens,"start_day":state.day+1,"days":int(days),
+              "window":state.window,"repeat_window":state.repeat_window}
+    if preset: inputs["preset"] = preset
+    if solver != "sample": inputs["solver"] = solver
+    out_days = list(iter_horizon(df, P,C,F, allergens, days, state, batch_size=batch_size, top_k=top_k,
+                                 validated_pairings=validated_pairings, batched=batched, workers=workers,
+                                 solver=solver, bank=bank, checkpoint=checkpoint))
+    return {"inputs": inputs, "days": out_days, **horizon_totals(out_days), "state": state.to_json()}
+
+# --------------- replanning -----------
+def plan_state(plan:Dict[str,Any], exclude:Iterable[Tuple[int,str]] = ()) -> Tuple[set, Dict[str,int], Dict[str,int]]:
+    """(no_repeat_signatures, cuisine_bias, ingredient_usage) of a plan's meals, skipping (day, slot) in exclude."""
+    skip = set(exclude); no_repeat: set = set(); cuisine_bias: Dict[str,int] = {}; usage: Dict[str,int] = {}
+    for d in plan["days"]:
+        for s in SLOTS:
+            if (d["day"], s) in skip: continue
+            m = d["meals"][s]
+            _record_meal(m["names"], m["cuisines"], no_repeat, cuisine_bias, usage)
+    return no_repeat, cuisine_bias, usage
+
+def _meal_cand(m:Dict[str,Any]) -> Cand:
+    mac = m["macros"]
+    return Cand(names=list(m["names"]), roles=list(m["roles"]), cuisines=list(m["cuisines"]),
+                P=float(mac["P"]), C=float(mac["C"]), F=float(mac["F"]), kcal=float(mac["kcal"]),
+                price=float(m["price"]), allergens=[])
+
+def _plan_day(plan:Dict[str,Any], day:int) -> Dict[str,Any]:
+    for d in plan["days"]:
+        if d["day"] == day: return d
+    raise ValueError(f"plan has no day {day}")
+
+def replan_batch(df:Any, slot:str, allergens:List[str], n:int = 360, seed:Any = None) -> CandBatch:
+    """
+    Unscored candidate batch used for replanning `slot`. When the pool is a Catalog
+    (always with a CatalogStore) the batch is kept in the pool's cache, so it is
+    reused until an update drops that pool; scoring against the plan happens per call.
+    Only the most recent seed is kept per batch size, so client-chosen seeds cannot
+    pile up batches on a long-lived store.
+    """
+    pool = slot_pool(df, slot, allergens)
+    cache = pool.cache if isinstance(pool, Catalog) else {}
+    key = ("replan", n)
+    hit = cache.get(key)
+    if hit is not None and hit[0] == seed:
+        return hit[1]
+    rng = np.random.default_rng(seed_child(DEFAULT_SEED if seed is None else seed, SLOTS.index(slot)))
+    batch = generate_batch_np(pool, slot, n=n, rng=rng)
+    cache[key] = (seed, batch)
+    return batch
+
+def _reject(day:Dict[str,Any], slots:Iterable[str]) -> set:
+    """Remember the current meals of `slots` as rejected; returns every rejected signature of the day."""
+    rejected = day["info"].setdefault("rejected", {})
+    for s in slots:
+        rejected.setdefault(s, []).append(sorted(day["meals"][s]["names"]))
+    return {meal_signature(r) for lst in rejected.values() for r in lst}
+
+def replan_meal(df:Any, plan:Dict[str,Any], day:int, slot:str, validated_pairings:Any = None,
+                seed:Any = None, batch_size:int = 360) -> Dict[str,Any]:
+    """
+    Replace one meal of a build_week-style plan (day is the plan's 1-based "day").
+    The diversity state is rebuilt from the other 20 meals; the new meal minimizes
+    best_combo's day cost with the other two meals of the day fixed. The replaced
+    meal is recorded in info["rejected"] and never offered again for that day.
+    Returns a new plan; the input is not modified.
+    """
+    import copy, time
+    t0 = time.perf_counter()
+    if slot not in SLOTS: raise ValueError(f"unknown slot {slot!r}; expected one of {SLOTS}")
+    inp = plan["inputs"]; P, C, F = float(inp["daily_P"]), float(inp["daily_C"]), float(inp["daily_F"])
+    allergens = _parse_allergens(inp.get("allergens")); validated_pairings = as_pairing_index(validated_pairings)
+    out = copy.deepcopy(plan); d = _plan_day(out, day)
+    banned_sigs = _reject(d, [slot])
+    no_repeat, cuisine_bias, usage = plan_state(out, exclude=[(day, slot)])
+    no_repeat |= banned_sigs
+
+    batch = replan_batch(df, slot, allergens, batch_size, seed)
+    rows = _fresh_rows(batch.signatures(), no_repeat)
+    if not len(rows): raise RuntimeError(f"No replacement left for day {day} {slot}")
+    cb = batch.take(rows)
+    sc = score_batch(cb, slot, slot_targets(P,C,F,slot), cuisine_bias, usage, validated_pairings)
+    others = [s for s in SLOTS if s != slot]
+    fixed = {s: _meal_cand(d["meals"][s]) for s in others}
+    fixed_score = 0.0
+    for s in others:  # each fixed meal scored against the rest of the plan, as the new one is
+        _, cbias, use = plan_state(out, exclude=[(day, slot), (day, s)])
+        fixed_score += adjusted_score(fixed[s], s, slot_targets(P,C,F,s), cbias, use, validated_pairings)
+    Pd = cb.P + sum(fixed[s].P for s in others); Cd = cb.C + sum(fixed[s].C for s in others)
+    Fd = cb.F + sum(fixed[s].F for s in others)
+    rel = (np.abs(Pd-P)/(P+1e-6)+np.abs(Cd-C)/(C+1e-6)+np.abs(Fd-F)/(F+1e-6))/3.0
+    mains = {fixed[s].cuisines[0] if fixed[s].cuisines else "universal" for s in others}
+    cnames = cuisine_names(batch.cat)
+    new_main = np.asarray([(cnames[c] if c >= 0 else "universal") not in mains for c in cb.cuisine], dtype=np.int64)
+    quality = (fixed_score + sc)/3.0 + 0.04*(len(mains) + new_main)
+    cost = 0.65*rel - 0.35*quality
+    k = int(np.argmin(np.where(np.isnan(cost), np.inf, cost)))
+
+    d["meals"][slot] = meal_json(cb.take(np.asarray([k])).to_cands()[0])
+    d["totals"] = day_totals(d["meals"])
+    d["info"].update({"rel_err": float(rel[k]), "quality": float(quality[k])})
+    out["weekly_totals"] = week_totals(out["days"])
+    out["replan"] = {"day": day, "slots": [slot], "candidates": int(len(rows)),
+                     "elapsed_ms": round((time.perf_counter()-t0)*1000, 2)}
+    return out
+
+def replan_day(df:Any, plan:Dict[str,Any], day:int, validated_pairings:Any = None,
+               seed:Any = None, batch_size:int = 360, top_k:int = 30) -> Dict[str,Any]:
+    """
+    Replace all three meals of one day: the state comes from the other six days,
+    the day's current (and previously rejected) meals are excluded, and the cached
+    replan batches go through score_slot_batch and best_combo as in the planner.
+    """
+    import copy, time
+    t0 = time.perf_counter()
+    inp = plan["inputs"]; P, C, F = float(inp["daily_P"]), float(inp["daily_C"]), float(inp["daily_F"])
+    allergens = _parse_allergens(inp.get("allergens")); validated_pairings = as_pairing_index(validated_pairings)
+    out = copy.deepcopy(plan); d = _plan_day(out, day)
+    banned_sigs = _reject(d, SLOTS)
+    no_repeat, cuisine_bias, usage = plan_state(out, exclude=[(day, s) for s in SLOTS])
+    no_repeat |= banned_sigs
+    lists = {s: score_slot_batch(replan_batch(df, s, allergens, batch_size, seed), s, slot_targets(P,C,F,s),
+                                 no_repeat, cuisine_bias, usage, validated_pairings, top_k=top_k) for s in SLOTS}
+    best, meta = best_combo(lists["breakfast"], lists["lunch"], lists["dinner"], P,C,F)
+    if best is None: raise RuntimeError(f"No replacement left for day {day}")
+    new = commit_day(best, meta, set(), {}, {})
+    d["meals"] = new["meals"]; d["totals"] = new["totals"]; d["info"].update(new["info"])
+    out["weekly_totals"] = week_totals(out["days"])
+    out["replan"] = {"day": day, "slots": list(SLOTS), "candidates": sum(len(v) for v in lists.values()),
+                     "elapsed_ms": round((time.perf_counter()-t0)*1000, 2)}
+    return out
+
+def replan_request(df:Any, req:Dict[str,Any], validated_pairings:Any = None) -> Dict[str,Any]:
+    """{"plan": {...}, "day": int, "slot": optional, "seed": optional} -> replan_meal / replan_day."""
+    if validated_pairings is None and isinstance(df, CatalogStore):
+        validated_pairings = df.pairings
+    plan = req["plan"]; day = int(req["day"]); seed = req.get("seed")
+    if req.get("slot"):
+        return replan_meal(df, plan, day, str(req["slot"]), validated_pairings, seed=seed)
+    return replan_day(df, plan, day, validated_pairings, seed=seed)
+
+# --------------- warm catalog -------------
+_STORE_ARRAYS = ("ids", "protein", "carbs", "fat", "kcal", "price", "meal_mask", "allergen_mask")
+
+def _ingredient_fields(row: Dict[str,Any]) -> Dict[str,Any]:
+    """Normalize one ingredient record (Supabase row shape) like the frame loaders do."""
+    lst = lambda c: row[c] if isinstance(row.get(c), list) else _parse_list(row.get(c))
+    def num(c: str) -> float:
+        try:
+            v = float(row.get(c) or 0.0)
+        except (TypeError, ValueError):
+            return 0.0
+        return 0.0 if math.isnan(v) else v
+    return {"key": str(row["id"]), "name": str(row.get("name", "")), "role": str(row.get("role") or "other"),
+            "meal_types": lst("meal_types"), "cuisines": [str(c) for c in lst("cuisine")],
+            "allergens": [a.strip().lower() for a in lst("allergens") if a.strip()],
+            "protein": num("protein"), "carbs": num("carbs"), "fat": num("fat"), "kcal": num("kcal"),
+            "price": num("price_per_serving")}
+
+class CatalogStore:
+    """
+    Long-lived catalog state for server / worker use: the full catalog, the
+    pairing index and the per-(slot, allergen-set) pools (as built Catalogs, whose
+    lookup tables stay warm too). Planning functions accept a store wherever they
+    take the ingredient frame.
+
+    Single ingredients and pairings can be upserted / deleted in place: arrays
+    grow geometrically and deletes swap in the last row, so a change costs O(1)
+    plus the affected role index, and only the cached pools whose filter admits
+    the old or new version of the row are dropped.
+
+    bank: optional CandidateBank that sampling plans on this store draw from; its
+    banks follow the cached pools, so they go stale exactly when a pool is dropped.
+    """
+    def __init__(self, df: Any, validated_pairings: Any = None, bank: Optional["CandidateBank"] = None):
+        import threading
+        self._lock = threading.RLock()
+        self.version = 0; self.bank = bank
+        self.reload(df, validated_pairings)
+
+    def reload(self, df: Any, validated_pairings: Any = None) -> int:
+        src = _as_catalog(df)
+        with self._lock:
+            self._bufs = {f: np.array(getattr(src, f), dtype=np.int64 if f in ("ids", "meal_mask", "allergen_mask")
+                                      else np.float64) for f in _STORE_ARRAYS}
+            self.catalog = Catalog(keys=list(src.keys), names=list(src.names), roles=list(src.roles),
+                                   cuisines=list(src.cuisines), allergens=list(src.allergens),
+                                   allergen_bits=dict(src.allergen_bits),
+                                   by_role={r: ix.copy() for r, ix in src.by_role.items()},
+                                   **{f: b for f, b in self._bufs.items()})
+            self._rows = {str(k): i for i, k in enumerate(src.keys) if k is not None}
+            self._name_n: Dict[str,int] = {}  # normalized name -> rows carrying it
+            for nm in src.names: self._count_name(nm, 1)
+            self.pairings = as_pairing_index(validated_pairings) or PairingIndex()
+            self._pair_ids: Dict[str, set] = {}  # id adjacency of pairings added by id
+            self._pools: Dict[Tuple[str,int], Catalog] = {}
+            self.version += 1
+        return self.version
+
+    @property
+    def df(self) -> Catalog:
+        return self.catalog
+
+    def pool(self, slot: str, allergens: List[str]) -> Catalog:
+        with self._lock:
+            cat = self.catalog
+            key = (slot, allergen_query_mask(allergens, cat.allergen_bits))
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = filter_pool(cat, slot, allergens)
+        return pool
+
+    def content_hash(self) -> str:
+        """catalog_version() of the current catalog and pairings, recomputed once per version."""
+        with self._lock:
+            memo = getattr(self, "_hash", None)
+            if memo is None or memo[0] != self.version:
+                memo = self._hash = (self.version, catalog_version(self.catalog, self.pairings))
+            return memo[1]
+
+    def stats(self) -> Dict[str,Any]:
+        st = {"version": self.version, "rows": len(self.catalog), "pools": len(self._pools),
+              "pairings": len(self.pairings)}
+        if self.bank is not None: st["bank"] = self.bank.stats()
+        return st
+
+    # ---- incremental updates ----
+    def _sync_views(self, n: int) -> None:
+        for f, b in self._bufs.items(): setattr(self.catalog, f, b[:n])
+        self.catalog.cache.clear()
+
+    def _count_name(self, name: str, d: int) -> int:
+        """Adjust the row count of a (normalized) name; returns the new count."""
+        k = name.strip().lower(); n = self._name_n.get(k, 0) + d
+        if n: self._name_n[k] = n
+        else: self._name_n.pop(k, None)
+        return n
+
+    def _invalidate(self, meal_mask: int, allergen_mask: int) -> int:
+        """Drop cached pools whose filter admits a row with these masks."""
+        dead = [k for k in self._pools
+                if meal_mask & (MEAL_BITS.get(k[0], 0) | MEAL_BITS["universal"]) and not allergen_mask & k[1]]
+        for k in dead: del self._pools[k]
+        return len(dead)
+
+    def _set_role(self, i: int, old: Optional[str], new: Optional[str]) -> None:
+        br = self.catalog.by_role
+        if old is not None:
+            br[old] = br[old][br[old] != i]
+            if not len(br[old]): del br[old]
+        if new is not None:
+            br[new] = np.append(br.get(new, np.zeros(0, dtype=np.int64)), i)
+
+    def upsert_ingredient(self, row: Dict[str,Any]) -> int:
+        """Insert or replace one ingredient by id; returns the number of cached pools dropped."""
+        r = _ingredient_fields(row)
+        with self._lock:
+            cat = self.catalog; bits = cat.allergen_bits
+            for a in r["allergens"]:
+                if a not in bits:
+                    if len(bits) >= MAX_ALLERGEN_BITS:
+                        raise ValueError(f"Too many distinct allergens to encode (> {MAX_ALLERGEN_BITS})")
+                    bits[a] = 1 << len(bits)
+            mm = meal_type_mask(r["meal_types"]); am = allergen_query_mask(r["allergens"], bits)
+            i = self._rows.get(r["key"]); dropped = 0
+            if i is None:
+                i = n = len(cat)
+                if n == len(self._bufs["ids"]):  # grow geometrically
+                    for f, b in self._bufs.items():
+                        nb = np.zeros(max(16, 2*len(b)), dtype=b.dtype); nb[:n] = b; self._bufs[f] = nb
+                cat.keys.append(r["key"]); cat.names.append(r["name"]); cat.roles.append(r["role"])
+                cat.cuisines.append(r["cuisines"]); cat.allergens.append(r["allergens"])
+                self._rows[r["key"]] = i; self._bufs["ids"][i] = i
+                self._set_role(i, None, r["role"]); self._sync_views(n + 1)
+                self._count_name(r["name"], 1)
+                old_name = None
+            else:
+                dropped += self._invalidate(int(cat.meal_mask[i]), int(cat.allergen_mask[i]))
+                old_name = cat.names[i]
+                if cat.roles[i] != r["role"]: self._set_role(i, cat.roles[i], r["role"])
+                cat.names[i] = r["name"]; cat.roles[i] = r["role"]
+                cat.cuisines[i] = r["cuisines"]; cat.allergens[i] = r["allergens"]
+                cat.cache.clear()
+            b = self._bufs
+            b["protein"][i] = r["protein"]; b["carbs"][i] = r["carbs"]; b["fat"][i] = r["fat"]
+            b["kcal"][i] = r["kcal"]; b["price"][i] = r["price"]
+            b["meal_mask"][i] = mm; b["allergen_mask"][i] = am
+            dropped += self._invalidate(mm, am)
+            if old_name is not None and old_name.strip().lower() != r["name"].strip().lower():
+                self._count_name(r["name"], 1)
+                if self._count_name(old_name, -1):  # another row keeps the old name and its name pairings
+                    self._rename_pairs(r["key"], old_name, r["name"])
+                else:
+                    self.pairings.rename_name(old_name.strip().lower(), r["name"].strip().lower())
+            self.version += 1
+        return dropped
+
+    def delete_ingredient(self, ingredient_id: Any) -> bool:
+        """
+        Remove one ingredient by id with every pairing that mentions it, by id or
+        by name (name pairings stay while another row still carries the name).
+        Renames in upsert_ingredient move the name pairings the same way.
+        """
+        with self._lock:
+            i = self._rows.get(str(ingredient_id))
+            if i is None: return False
+            name = self._name_of(ingredient_id)
+            for other in list(self._pair_ids.get(str(ingredient_id), ())):
+                self.delete_pairing(ingredient_id, other)
+            del self._rows[str(ingredient_id)]
+            cat = self.catalog; last = len(cat) - 1
+            self._invalidate(int(cat.meal_mask[i]), int(cat.allergen_mask[i]))
+            self._set_role(i, cat.roles[i], None)
+            if i != last:  # swap the last row into the hole
+                self._set_role(last, cat.roles[last], None)
+                for lst in (cat.keys, cat.names, cat.roles, cat.cuisines, cat.allergens): lst[i] = lst[last]
+                for f, b in self._bufs.items():
+                    if f != "ids": b[i] = b[last]
+                self._rows[str(cat.keys[i])] = i
+                self._set_role(i, None, cat.roles[i])
+            for lst in (cat.keys, cat.names, cat.roles, cat.cuisines, cat.allergens): lst.pop()
+            self._sync_views(last)
+            if not self._count_name(name, -1):
+                self.pairings.remove_name(name)
+            self.version += 1
+        return True
+
+    def _name_of(self, ingredient_id: Any) -> Optional[str]:
+        i = self._rows.get(str(ingredient_id))
+        return None if i is None else self.catalog.names[i].strip().lower()
+
+    def upsert_pairing(self, ingredient_a: Any, ingredient_b: Any, pairing_score: Optional[int] = None,
+                       min_score: int = 5) -> bool:
+        """Add a pairing by ingredient ids; a score below min_score removes it instead."""
+        if pairing_score is not None and int(pairing_score) < min_score:
+            return self.delete_pairing(ingredient_a, ingredient_b)
+        a, b = str(ingredient_a), str(ingredient_b)
+        with self._lock:
+            na, nb = self._name_of(a), self._name_of(b)
+            if not (na and nb) or b in self._pair_ids.get(a, ()): return False
+            self._pair_ids.setdefault(a, set()).add(b); self._pair_ids.setdefault(b, set()).add(a)
+            self.pairings.add({na, nb}); self.version += 1
+        return True
+
+    def delete_pairing(self, ingredient_a: Any, ingredient_b: Any) -> bool:
+        a, b = str(ingredient_a), str(ingredient_b)
+        with self._lock:
+            na, nb = self._name_of(a), self._name_of(b)
+            self._pair_ids.get(a, set()).discard(b); self._pair_ids.get(b, set()).discard(a)
+            if not (na and nb) or not self.pairings.remove({na, nb}): return False
+            self.version += 1
+        return True
+
+    def _rename_pairs(self, key: str, old: str, new: str) -> None:
+        for other in self._pair_ids.get(key, ()):
+            on = self._name_of(other)
+            if on is None: continue
+            self.pairings.remove({old.strip().lower(), on if other != key else old.strip().lower()})
+            self.pairings.add({new.strip().lower(), on if other != key else new.strip().lower()})
+
+def slot_pool(df: Any, slot: str, allergens: List[str]) -> Any:
+    """Filtered pool for a slot, served from the warm cache when `df` is a CatalogStore."""
+    return df.pool(slot, allergens) if isinstance(df, CatalogStore) else filter_pool(df, slot, allergens)
+
+# --------------- candidate bank -------------
+class CandidateBank:
+    """
+    Pre-generated candidates per (slot, allergen profile). Generation depends only
+    on the filtered pool, never on the macro targets, so requests that share a
+    profile draw their per-day batches from one bank and only score them.
+      - A bank is bound to the pool it was drawn from: when a CatalogStore update
+        drops that pool (or a different frame is passed), it is rebuilt on next use.
+      - At most max_banks are kept, least recently used evicted first.
+      - A bank older than refresh_s keeps serving while a background thread draws
+        its replacement (refresh_s=None: never; background=False: inline).
+    Contents are seeded by (seed, slot, profile, generation), so a plan is
+    reproducible for a given bank generation; generation counts rebuilds.
+    """
+    def __init__(self, size: int = 4096, max_banks: int = 64, refresh_s: Optional[float] = 600.0,
+                 seed: Optional[int] = None, background: bool = True):
+        self.size = int(size); self.max_banks = int(max_banks); self.refresh_s = refresh_s
+        self.seed = DEFAULT_SEED if seed is None else int(seed); self.background = background
+        self._init_state()
+
+    def _init_state(self) -> None:
+        import threading
+        from collections import OrderedDict
+        self._lock = threading.Lock(); self._pool = None
+        self._banks: "OrderedDict[Tuple[str,Tuple[str,...]], Dict[str,Any]]" = OrderedDict()
+        self.hits = self.misses = self.stale = self.refreshes = self.evictions = self.errors = 0
+
+    def __getstate__(self) -> Dict[str,Any]:
+        return {k: getattr(self, k) for k in ("size", "max_banks", "refresh_s", "seed", "background")}
+
+    def __setstate__(self, state: Dict[str,Any]) -> None:
+        self.__dict__.update(state); self._init_state()
+
+    def _build(self, df: Any, slot: str, profile: Tuple[str,...], generation: int) -> CandBatch:
+        import zlib
+        pool = slot_pool(df, slot, list(profile))
+        ss = np.random.SeedSequence([self.seed, SLOTS.index(slot), zlib.crc32(",".join(profile).encode()), generation])
+        b = generate_batch_np(pool, slot, n=self.size, rng=np.random.default_rng(ss))
+        # compact: row indices and codes fit 32 bits, item counts 16
+        return CandBatch(cat=b.cat, idx=b.idx.astype(np.int32), count=b.count.astype(np.int16),
+                         cuisine=b.cuisine.astype(np.int32), P=b.P, C=b.C, F=b.F, kcal=b.kcal, price=b.price)
+
+    def _put(self, key: Tuple[str,Tuple[str,...]], src: Any, batch: CandBatch, generation: int) -> None:
+        """Called under the lock."""
+        import time
+        self._banks[key] = {"src": src, "batch": batch, "generation": generation,
+                            "built": time.monotonic(), "refreshing": False}
+        self._banks.move_to_end(key)
+        while len(self._banks) > self.max_banks:
+            self._banks.popitem(last=False); self.evictions += 1
+
+    def _refresh(self, df: Any, key: Tuple[str,Tuple[str,...]], src: Any, generation: int) -> None:
+        try:
+            batch = self._build(df, key[0], key[1], generation)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+                e = self._banks.get(key)
+                if e is not None: e["refreshing"] = False
+            return
+        with self._lock:
+            e = self._banks.get(key)
+            if e is not None and e["src"] is src:  # not rebuilt for a newer pool meanwhile
+                self._put(key, src, batch, generation); self.refreshes += 1
+
+    def get(self, df: Any, slot: str, allergens: List[str]) -> CandBatch:
+        """The bank for this slot and profile, (re)built first if missing or stale."""
+        import time
+        profile = tuple(sorted(set(_parse_allergens(allergens))))
+        key = (slot, profile)
+        src = slot_pool(df, slot, list(profile)) if isinstance(df, CatalogStore) else df
+        refresh = None
+        with self._lock:
+            e = self._banks.get(key)
+            if e is not None and e["src"] is src:
+                self._banks.move_to_end(key); self.hits += 1
+                if (self.refresh_s is not None and not e["refreshing"]
+                        and time.monotonic() - e["built"] > self.refresh_s):
+                    e["refreshing"] = True; refresh = (df, key, src, e["generation"] + 1)
+                batch = e["batch"]
+            else:
+                generation = 0 if e is None else e["generation"] + 1
+                self.misses += 1
+                if e is not None: self.stale += 1
+        if refresh is not None:
+            if self.background:
+                from concurrent.futures import ThreadPoolExecutor
+                with self._lock:
+                    if self._pool is None: self._pool = ThreadPoolExecutor(1, thread_name_prefix="candidate-bank")
+                    self._pool.submit(self._refresh, *refresh)
+            else:
+                self._refresh(*refresh)
+                with self._lock: batch = self._banks.get(key, e)["batch"]
+        if e is None or e["src"] is not src:
+            batch = self._build(df, slot, profile, generation)
+            with self._lock:
+                self._put(key, src, batch, generation)
+        return batch
+
+    def draw(self, df: Any, slot: str, allergens: List[str], n: int,
+             rng: Optional[np.random.Generator] = None) -> CandBatch:
+        """n distinct bank rows in random order: a stand-in for generate_batch_np(pool, slot, n)."""
+        bank = self.get(df, slot, allergens)
+        return bank.take(_rng(rng).permutation(len(bank))[:n])
+
+    def stats(self) -> Dict[str,Any]:
+        with self._lock:
+            nbytes = sum(sum(a.nbytes for a in (b.idx, b.count, b.cuisine, b.P, b.C, b.F, b.kcal, b.price))
+                         for b in (e["batch"] for e in self._banks.values()))
+            return {"banks": len(self._banks), "size": self.size, "bytes": nbytes, "hits": self.hits,
+                    "misses": self.misses, "stale": self.stale, "refreshes": self.refreshes,
+                    "evictions": self.evictions, "errors": self.errors}
+
+    def clear(self) -> None:
+        with self._lock: self._banks.clear()
+
+    def close(self) -> None:
+        if self._pool is not None: self._pool.shutdown(wait=False); self._pool = None
+
+# --------------- batch planning -----------
+DEFAULT_SEED = 12345
+
+def _parse_allergens(x: Any) -> List[str]:
+    items = x.split(",") if isinstance(x, str) else (x or [])
+    return [str(a).strip().lower() for a in items if str(a).strip()]
+
+def resolve_request(req:Dict[str,Any]) -> Dict[str,Any]:
+    """
+    Validate a plan request and resolve it to planner settings, the single place
+    plan_request, stream_plan and the CLI decide what a request means:
+      mode: "horizon" (days or state), "anytime" (budget_ms), "preset" (a preset,
+            batched or a non-sample solver) or "week" (build_week's settings)
+    plus the parsed targets, seed, preset, batch_size / top_k, solver, refine and
+    the "inputs" block of the plan. Raises ValueError for an invalid combination.
+    """
+    P, C, F = float(req["P"]), float(req["C"]), float(req["F"])
+    allergens = _parse_allergens(req.get("allergens"))
+    seed = int(req.get("seed", DEFAULT_SEED))
+    preset = req.get("preset") or None; batched = bool(req.get("batched", False))
+    refine = bool(req.get("refine", False)); solver = req.get("solver") or "sample"
+    budget = None if req.get("budget_ms") is None else float(req["budget_ms"])
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver: {solver}. Must be one of {list(SOLVERS)}")
+    inputs: Dict[str,Any] = {"daily_P":P,"daily_C":C,"daily_F":F,"allergens":allergens}
+    spec: Dict[str,Any] = {"P": P, "C": C, "F": F, "allergens": allergens, "seed": seed, "batched": batched,
+                           "refine": refine, "solver": solver, "budget_ms": budget, "inputs": inputs}
+    if req.get("days") is not None or req.get("state") is not None:
+        if budget is not None or refine:
+            raise ValueError("budget_ms and refine plan a single week and cannot be combined with days / state")
+        spec.update(mode="horizon", preset=preset or ("quality" if batched else None),
+                    state=_horizon_state(req, seed), days=int(req.get("days") or 7))
+    elif budget is not None:
+        if solver != "sample": raise ValueError("budget_ms plans by sampling and cannot be combined with a solver")
+        if refine: raise ValueError("budget_ms plans within a deadline and cannot be combined with refine")
+        spec.update(mode="anytime", preset=None)
+    elif preset or batched or solver != "sample":
+        spec.update(mode="preset", preset=preset or "quality")
+    else:
+        spec.update(mode="week", preset=None)
+    if spec["preset"] is not None and spec["preset"] not in PRESETS:
+        raise ValueError(f"Unknown preset: {spec['preset']}. Must be one of {list(PRESETS.keys())}")
+    spec["batch_size"], spec["top_k"] = PRESETS[spec["preset"]] if spec["preset"] else (360, 30)
+    if spec["mode"] == "horizon":
+        st = spec["state"]
+        inputs.update({"start_day": st.day+1, "days": spec["days"], "window": st.window,
+                       "repeat_window": st.repeat_window})
+    elif spec["mode"] == "anytime":
+        inputs["budget_ms"] = budget
+    if spec["preset"]: inputs["preset"] = spec["preset"]
+    if solver != "sample": inputs["solver"] = solver
+    return spec
+
+def plan_request(df:pd.DataFrame, req:Dict[str,Any], validated_pairings:Any = None, workers:int = 1,
+                 checkpoint:Optional[str] = None) -> Dict[str,Any]:
+    """
+    Plan one week from a request dict:
+      {"P":..,"C":..,"F":.., "allergens": [..] | "a,b", "preset": optional, "batched": bool, "seed": int,
+       "budget_ms": optional, "refine": bool, "diagnostics": bool, "solver": "sample" | "exact",
+       "days": optional, "state": optional, "window": 7, "repeat_window": 28}
+    The request is resolved by resolve_request and planned by the same records
+    stream_plan yields (collected here), so both give the same plan. refine then
+    runs refine_week over the collected week. The plan depends only on the request
+    (seed defaults to DEFAULT_SEED), never on what ran before it (with a store's
+    CandidateBank: on the bank generation). diagnostics adds the Profile report
+    of the run. workers / checkpoint as in build_week_with_presets / build_horizon.
+    """
+    if req.get("diagnostics"):
+        with profiling() as prof:
+            plan = plan_request(df, {k: v for k, v in req.items() if k != "diagnostics"}, validated_pairings,
+                                workers, checkpoint)
+        plan["diagnostics"] = prof.report()
+        return plan
+    spec = resolve_request(req)
+    top_lists: Optional[List[Dict[str,Any]]] = [] if spec["refine"] else None
+    days: List[Dict[str,Any]] = []; week: Dict[str,Any] = {}
+    for rec in _plan_records(df, spec, validated_pairings, workers, checkpoint, top_lists):
+        rec = dict(rec)
+        if rec.pop("type") == "day": days.append(rec)
+        else: week = rec
+    out = {"inputs": week.pop("inputs"), "days": days, **week}
+    if top_lists is not None:
+        out["refine"] = refine_week(days, top_lists, spec["P"], spec["C"], spec["F"],
+                                    _store_pairings(df, validated_pairings))
+        out["weekly_totals"] = week_totals(days)
+    return out
+
+def stream_plan(df:pd.DataFrame, req:Dict[str,Any], validated_pairings:Any = None, workers:int = 1,
+                checkpoint:Optional[str] = None) -> Iterator[Dict[str,Any]]:
+    """
+    plan_request as a stream of NDJSON-ready records, each yielded as soon as it exists:
+      {"type": "day", "day": n, "meals", "info", "totals"}   x 7
+      {"type": "week", "inputs", "weekly_totals"[, "search"]}  last
+    (a horizon request ends with its "totals" and "state" as well).
+    Same plan as plan_request for the same request. The request is validated
+    before the iterator is returned, so a bad request raises ValueError here
+    rather than mid-stream. refine rewrites earlier days, so it cannot be streamed.
+    """
+    spec = resolve_request(req)
+    if spec["refine"]: raise ValueError("refine needs the whole week and cannot be streamed")
+    return _plan_records(df, spec, validated_pairings, workers, checkpoint)
+
+def _store_pairings(df:Any, validated_pairings:Any) -> Optional[PairingIndex]:
+    if validated_pairings is None and isinstance(df, CatalogStore):
+        return df.pairings
+    return as_pairing_index(validated_pairings)
+
+def _plan_records(df:Any, spec:Dict[str,Any], validated_pairings:Any = None, workers:int = 1,
+                  checkpoint:Optional[str] = None,
+                  top_lists:Optional[List[Dict[str,Any]]] = None) -> Iterator[Dict[str,Any]]:
+    """The day / week records of a resolved request (see stream_plan)."""
+    import time
+    t0 = time.perf_counter()
+    pairings = _store_pairings(df, validated_pairings)
+    bank = df.bank if isinstance(df, CatalogStore) else None
+    P, C, F, allergens, mode = spec["P"], spec["C"], spec["F"], spec["allergens"], spec["mode"]
+    if mode == "horizon":
+        days = iter_horizon(df, P,C,F, allergens, spec["days"], spec["state"], batch_size=spec["batch_size"],
+                            top_k=spec["top_k"], validated_pairings=pairings, batched=spec["batched"],
+                            workers=workers, solver=spec["solver"], bank=bank, checkpoint=checkpoint)
+    elif mode == "anytime":
+        days = iter_days_anytime(df, P,C,F, allergens, budget_ms=spec["budget_ms"],
+                                 validated_pairings=pairings, seed=spec["seed"])
+    else:
+        days = iter_days(df, P,C,F, allergens, batch_size=spec["batch_size"], top_k=spec["top_k"],
+                         validated_pairings=pairings, batched=spec["batched"], seed=spec["seed"],
+                         workers=workers, top_lists=top_lists, solver=spec["solver"], bank=bank)
+    done = []
+    for d in days:
+        done.append(d)
+        yield {"type": "day", "day": d["day"], **d}
+    if mode == "horizon":
+        yield {"type": "week", "inputs": spec["inputs"], **horizon_totals(done), "state": spec["state"].to_json()}
+        return
+    week = {"type": "week", "inputs": spec["inputs"], "weekly_totals": week_totals(done)}
+    if mode == "anytime": week["search"] = anytime_search(done, spec["budget_ms"], (time.perf_counter()-t0)*1000)
+    yield week
+
+def _horizon_state(req:Dict[str,Any], seed:int) -> HorizonState:
+    if req.get("state") is not None: return HorizonState.from_json(req["state"])
+    return HorizonState(seed, int(req.get("window", 7)), int(req.get("repeat_window", 28)))
+
+def plan_records(plan:Dict[str,Any]) -> Iterator[Dict[str,Any]]:
+    """A finished plan as the records stream_plan would have produced."""
+    for d in plan["days"]: yield {"type": "day", "day": d["day"], **d}
+    yield {"type": "week", **{k: v for k, v in plan.items() if k != "days"}}
+
+# --------------- plan cache -----------
+def catalog_version(df: Any, validated_pairings: Any = None) -> str:
+    """Hash of everything a plan depends on besides the request: catalog content and pairings."""
+    import hashlib
+    if isinstance(df, CatalogStore) and validated_pairings is None:
+        return df.content_hash()
+    cat = df.catalog if isinstance(df, CatalogStore) else _as_catalog(df)
+    h = cat.cache.get("hash") or cat.cache.setdefault("hash", catalog_hash(cat))
+    idx = as_pairing_index(validated_pairings)
+    return hashlib.sha256(f"{h}:{idx.digest() if idx else ''}".encode("utf-8")).hexdigest()
+
+class PlanCache:
+    """
+    Plan results keyed by the normalized request plus catalog_version().
+    Memory tier: LRU of serialized plans (at most `max_entries`), each dropped
+    `ttl` seconds after it was planned (None = never). Optional disk tier: one
+    JSON file per key under disk_dir/<version>/, shared by batch workers and kept
+    across restarts. As soon as a lookup sees a new catalog version every entry
+    of the old one is discarded, memory and disk.
+
+    P/C/F are rounded to `macro_step` grams before planning, so requests that
+    normalize the same get the same plan whether or not it came from the cache.
+    Only fields plan_request reads are part of the key; the pairing threshold is
+    fixed when the pairings are loaded and reaches the key through the version.
+    """
+    def __init__(self, max_entries: int = 512, ttl: Optional[float] = 3600.0,
+                 disk_dir: Optional[str] = None, macro_step: float = 1.0):
+        self.max_entries = max_entries; self.ttl = ttl; self.macro_step = macro_step
+        self.disk = Path(disk_dir) if disk_dir else None
+        self._init_state()
+
+    def _init_state(self) -> None:
+        import threading
+        from collections import OrderedDict
+        self._lock = threading.Lock()
+        self._mem: "OrderedDict[str, Tuple[float,str]]" = OrderedDict()
+        self._version: Optional[str] = None
+        self.hits = self.misses = self.disk_hits = self.evictions = self.expired = self.invalidations = 0
+
+    def __getstate__(self) -> Dict[str,Any]:  # workers get the settings, not the entries
+        return {"max_entries": self.max_entries, "ttl": self.ttl, "macro_step": self.macro_step, "disk": self.disk}
+
+    def __setstate__(self, state: Dict[str,Any]) -> None:
+        self.__dict__.update(state); self._init_state()
+
+    def normalize(self, req: Dict[str,Any]) -> Dict[str,Any]:
+        step = self.macro_step
+        rnd = lambda x: round(round(float(x) / step) * step, 6) if step else float(x)
+        preset = req.get("preset") or None; batched = bool(req.get("batched", False))
+        return {"P": rnd(req["P"]), "C": rnd(req["C"]), "F": rnd(req["F"]),
+                "allergens": sorted(set(_parse_allergens(req.get("allergens")))),
+                "preset": preset or ("quality" if batched else None), "batched": batched,
+                "seed": int(req.get("seed", DEFAULT_SEED)),
+                "budget_ms": None if req.get("budget_ms") is None else float(req["budget_ms"]),
+                "refine": bool(req.get("refine", False)), "solver": req.get("solver") or "sample",
+                "days": None if req.get("days") is None else int(req["days"]),
+                "window": int(req.get("window", 7)), "repeat_window": int(req.get("repeat_window", 28))}
+
+    @staticmethod
+    def key(norm: Dict[str,Any], version: str) -> str:
+        import hashlib
+        blob = json.dumps(norm, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(f"{version}\n{blob}".encode("utf-8")).hexdigest()
+
+    def _dir(self, version: str) -> Path:
+        return self.disk / version[:16]
+
+    def _switch(self, version: str) -> None:
+        """Called under the lock: forget everything cached for another catalog version."""
+        if self._version == version: return
+        if self._version is not None:
+            self.invalidations += 1; self._mem.clear()
+        self._version = version
+        if self.disk is not None and self.disk.is_dir():
+            import shutil
+            for d in self.disk.iterdir():
+                if d.is_dir() and d.name != version[:16]: shutil.rmtree(d, ignore_errors=True)
+
+    def _live(self, stamp: float, now: float) -> bool:
+        return self.ttl is None or now - stamp < self.ttl
+
+    def get(self, key: str, version: str) -> Optional[Dict[str,Any]]:
+        import time
+        now = time.time()
+        with self._lock:
+            self._switch(version)
+            hit = self._mem.get(key)
+            if hit is not None:
+                if self._live(hit[0], now):
+                    self._mem.move_to_end(key); self.hits += 1
+                    return json.loads(hit[1])
+                del self._mem[key]; self.expired += 1
+            if self.disk is not None:
+                path = self._dir(version) / f"{key}.json"
+                try:
+                    stamp = path.stat().st_mtime
+                    if self._live(stamp, now):
+                        blob = path.read_text(encoding="utf-8")
+                        self._store(key, stamp, blob); self.hits += 1; self.disk_hits += 1
+                        return json.loads(blob)
+                    path.unlink(); self.expired += 1
+                except (OSError, ValueError):
+                    pass
+            self.misses += 1
+        return None
+
+    def _store(self, key: str, stamp: float, blob: str) -> None:
+        self._mem[key] = (stamp, blob); self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False); self.evictions += 1
+
+    def put(self, key: str, version: str, plan: Dict[str,Any]) -> None:
+        import time
+        blob = json.dumps(plan, ensure_ascii=False)
+        with self._lock:
+            if self._version not in (None, version): return  # planned against a catalog since replaced
+            self._switch(version)
+            if self.max_entries > 0: self._store(key, time.time(), blob)
+        if self.disk is not None:
+            d = self._dir(version); d.mkdir(parents=True, exist_ok=True)
+            tmp = d / f".{key}.{os.getpid()}.tmp"
+            tmp.write_text(blob, encoding="utf-8"); os.replace(tmp, d / f"{key}.json")
+
+    def get_or_plan(self, df: Any, req: Dict[str,Any], validated_pairings: Any = None) -> Dict[str,Any]:
+        """plan_request() on the normalized request, served from the cache when possible."""
+        if req.get("diagnostics") or req.get("state") is not None:  # run-specific: timings / carried state
+            return plan_request(df, req, validated_pairings)
+        norm = self.normalize(req)
+        version = catalog_version(df, validated_pairings)
+        key = self.key(norm, version)
+        plan = self.get(key, version)
+        if plan is None:
+            plan = plan_request(df, norm, validated_pairings)
+            self.put(key, version, plan)
+        return plan
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            if self.disk is not None and self.disk.is_dir():
+                import shutil
+                shutil.rmtree(self.disk, ignore_errors=True)
+
+    def stats(self) -> Dict[str,Any]:
+        with self._lock:
+            looked = self.hits + self.misses
+            return {"entries": len(self._mem), "max_entries": self.max_entries, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits,
+                    "hit_rate": round(self.hits / looked, 4) if looked else 0.0,
+                    "evictions": self.evictions, "expired": self.expired, "invalidations": self.invalidations}
+
+_WORKER: Dict[str, Any] = {}  # per-process catalog shared by batch workers
+
+def _init_worker(df: pd.DataFrame, validated_pairings: Any, cache: Optional[PlanCache] = None,
+                 bank: Optional[CandidateBank] = None) -> None:
+    if (cache is not None or bank is not None) and not isinstance(df, CatalogStore):  # hash the catalog once, not per job
+        df, validated_pairings = CatalogStore(df, validated_pairings, bank=bank), None
+    _WORKER["df"] = df; _WORKER["pairings"] = validated_pairings; _WORKER["cache"] = cache
+
+def _plan_job(job: Dict[str,Any]) -> Dict[str,Any]:
+    jid = job.get("id", job.get("client_id"))
+    try:
+        cache = _WORKER.get("cache")
+        plan = (cache.get_or_plan if cache is not None else plan_request)(_WORKER["df"], job, _WORKER["pairings"])
+        return {"id": jid, "plan": plan}
+    except Exception as e:
+        return {"id": jid, "error": f"{type(e).__name__}: {e}"}
+
+def plan_jobs(df:pd.DataFrame, jobs:Iterable[Dict[str,Any]], workers:int = 1,
+              validated_pairings:Any = None, cache:Optional[PlanCache] = None,
+              bank:Optional[CandidateBank] = None) -> Iterator[Dict[str,Any]]:
+    """
+    Plan many requests across a pool of worker processes, yielding results as they
+    finish (not in input order). The catalog is handed to each worker once at start-up;
+    with the fork start method it is inherited copy-on-write instead of pickled.
+    With a `cache`, each worker keeps its own memory tier; the disk tier is shared.
+    Likewise each worker fills its own copy of `bank`.
+    """
+    import multiprocessing as mp
+    validated_pairings = as_pairing_index(validated_pairings)
+    if workers <= 1:
+        _init_worker(df, validated_pairings, cache, bank)
+        for job in jobs: yield _plan_job(job)
+        return
+    method = "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+    with mp.get_context(method).Pool(workers, initializer=_init_worker, initargs=(df, validated_pairings, cache, bank)) as pool:
+        yield from pool.imap_unordered(_plan_job, jobs, chunksize=1)
+
+def _read_jobs(path: str) -> Iterator[Dict[str,Any]]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip(): yield json.loads(line)
+
+def run_batch(df:pd.DataFrame, jobs_path:str, out_path:str, workers:int = 1,
+              validated_pairings:Any = None, cache:Optional[PlanCache] = None,
+              stream:bool = False, bank:Optional[CandidateBank] = None) -> Tuple[int,int]:
+    """
+    Stream plans for a JSONL file of requests into a JSONL file; returns (ok, failed).
+    stream: write each plan as its plan_records (one line per day, then the week,
+    all tagged with the job id) instead of one line per plan.
+    """
+    outp=Path(out_path); outp.parent.mkdir(parents=True, exist_ok=True)
+    ok = failed = 0
+    with open(outp, "w", encoding="utf-8") as f:
+        for res in plan_jobs(df, _read_jobs(jobs_path), workers, validated_pairings, cache, bank):
+            if not stream:
+                f.write(json.dumps(res, ensure_ascii=False) + "\n")
+            elif "plan" in res:
+                for rec in plan_records(res["plan"]):
+                    f.write(json.dumps({"id": res["id"], **rec}, ensure_ascii=False) + "\n")
+            else:
+                f.write(json.dumps({"id": res["id"], "type": "error", "error": res["error"]}, ensure_ascii=False) + "\n")
+            f.flush()
+            if "error" in res: failed += 1
+            else: ok += 1
+    return ok, failed
+
+# --------------- server mode --------------
+_HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+async def _read_http(reader) -> Optional[Tuple[str, str, Dict[str,str], bytes]]:
+    line = await reader.readline()
+    if not line: return None
+    method, path, _ = line.decode("latin-1").split(" ", 2)
+    headers: Dict[str,str] = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""): break
+        k, _, v = h.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    n = int(headers.get("content-length", 0) or 0)
+    body = await reader.readexactly(n) if n else b""
+    return method.upper(), path.split("?", 1)[0], headers, body
+
+def _http_response(status: int, payload: Any, keep_alive: bool) -> bytes:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {_HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("latin-1") + body
+
+class PlanServer:
+    """
+    Small JSON-over-HTTP front end for a warm CatalogStore (stdlib asyncio only).
+      GET  /health  -> store stats (plus cache stats when a PlanCache is attached)
+      POST /plan    -> plan_request(store, body), through the cache if there is one
+      POST /plan/stream -> stream_plan(store, body) as chunked NDJSON, one line per day
+      POST /replan  -> replan_request(store, body): {"plan", "day", "slot"?} swaps one meal / day
+      POST /reload  -> re-run `loader` (or load body["csv"]) and swap the catalog
+      POST /ingredients/upsert, /ingredients/delete, /pairings/upsert, /pairings/delete
+                    -> incremental CatalogStore updates (body: ingredient row / {"id"} /
+                       {"ingredient_a","ingredient_b","pairing_score"}); answers {"changed", ...stats},
+                       plus "pools_invalidated" for an ingredient upsert
+    Planning runs in the default thread pool so the event loop stays responsive.
+    metrics_hook (metric, value, tags) receives the Profile metrics of every plan
+    computed for /plan; "diagnostics": true in the body also returns them.
+    """
+    def __init__(self, store: CatalogStore, loader: Optional[Any] = None, cache: Optional[PlanCache] = None,
+                 metrics_hook: Optional[Any] = None):
+        self.store = store; self.loader = loader; self.cache = cache; self.metrics_hook = metrics_hook
+
+    def _plan(self, req: Dict[str,Any]) -> Dict[str,Any]:
+        if self.metrics_hook is None: return self._plan_once(req)
+        with profiling([self.metrics_hook]):
+            return self._plan_once(req)
+
+    def _plan_once(self, req: Dict[str,Any]) -> Dict[str,Any]:
+        return self.cache.get_or_plan(self.store, req) if self.cache is not None else plan_request(self.store, req)
+
+    def health(self) -> Dict[str,Any]:
+        st = self.store.stats()
+        if self.cache is not None: st["cache"] = self.cache.stats()
+        return st
+
+    def _reload(self, req: Dict[str,Any]) -> Dict[str,Any]:
+        if req.get("csv"):
+            df, pairings = load_csv(req["csv"]), None
+        elif self.loader is not None:
+            df, pairings = self.loader()
+        else:
+            raise ValueError("no catalog source configured for reload")
+        self.store.reload(df, pairings)
+        return self.store.stats()
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, Any]:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        st = self.store
+        def update(fn):
+            return lambda r: {"changed": fn(r), **st.stats()}
+        def upsert_ingredient(r):
+            return {"changed": True, "pools_invalidated": st.upsert_ingredient(r), **st.stats()}
+        routes = {"/health": ("GET", None), "/plan": ("POST", self._plan),
+                  "/replan": ("POST", lambda r: replan_request(st, r)),
+                  "/reload": ("POST", self._reload),
+                  "/ingredients/upsert": ("POST", upsert_ingredient),
+                  "/ingredients/delete": ("POST", update(lambda r: st.delete_ingredient(r["id"]))),
+                  "/pairings/upsert": ("POST", update(lambda r: st.upsert_pairing(
+                      r["ingredient_a"], r["ingredient_b"], r.get("pairing_score")))),
+                  "/pairings/delete": ("POST", update(lambda r: st.delete_pairing(r["ingredient_a"], r["ingredient_b"])))}
+        if path not in routes: return 404, {"error": f"unknown path {path}"}
+        want, fn = routes[path]
+        if method != want: return 405, {"error": f"{path} expects {want}"}
+        if fn is None: return 200, self.health()
+        try:
+            req = json.loads(body or b"{}")
+            if not isinstance(req, dict): raise ValueError("request body must be a JSON object")
+        except ValueError as e:
+            return 400, {"error": f"bad request body: {e}"}
+        try:
+            return 200, await loop.run_in_executor(None, fn, req)
+        except (KeyError, ValueError, TypeError) as e:
+            return 400, {"error": f"{type(e).__name__}: {e}"}
+        except Exception as e:
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+    async def _stream(self, writer, body: bytes, keep_alive: bool) -> None:
+        """Chunked NDJSON: each record is sent as soon as the planner thread yields it."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            req = json.loads(body or b"{}")
+            if not isinstance(req, dict): raise ValueError("request body must be a JSON object")
+        except ValueError as e:
+            writer.write(_http_response(400, {"error": f"bad request body: {e}"}, keep_alive)); return
+        try:
+            it = stream_plan(self.store, req)  # validates the request before any header is sent
+        except (KeyError, ValueError, TypeError) as e:
+            writer.write(_http_response(400, {"error": f"{type(e).__name__}: {e}"}, keep_alive)); return
+        writer.write((f"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n"
+                      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1"))
+        while True:
+            try:
+                rec = await loop.run_in_executor(None, next, it, None)
+            except Exception as e:  # headers are gone; report the failure in-band
+                rec = {"type": "error", "error": f"{type(e).__name__}: {e}"}; it = iter(())
+            if rec is None: break
+            data = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+            writer.write(f"{len(data):X}\r\n".encode("latin-1") + data + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer) -> None:
+        try:
+            while True:
+                msg = await _read_http(reader)
+                if msg is None: break
+                method, path, headers, body = msg
+                keep = headers.get("connection", "").lower() != "close"
+                if path == "/plan/stream" and method == "POST":
+                    await self._stream(writer, body, keep)
+                    if not keep: break
+                    continue
+                status, payload = await self.dispatch(method, path, body)
+                writer.write(_http_response(status, payload, keep))
+                await writer.drain()
+                if not keep: break
+        except (ConnectionError, ValueError, EOFError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765, socket_path: Optional[str] = None) -> None:
+        import asyncio
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+            where = socket_path
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            where = f"http://{host}:{port}"
+        print(f"[OK] Serving meal planner on {where} ({self.store.stats()['rows']} ingredients)", flush=True)
+        async with server:
+            await server.serve_forever()
+
+def _print_timings(timings: Dict[str,float], t0: float) -> None:
+    timings["run"] = (time.perf_counter() - t0) * 1000.0 - timings["load"]
+    print("TIMINGS: " + " ".join(f"{k}={v:.1f}ms" for k, v in timings.items())
+          + f" total={sum(timings.values()):.1f}ms pandas={'pandas' in sys.modules}", file=sys.stderr)
 
 def main():
     ap=argparse.ArgumentParser(description="Weekly meal planner (7 days) from CSV")
     ap.add_argument("--csv", required=True)
-    ap.add_argument("--P", type=float, required=True, help="Daily protein target")
-    ap.add_argument("--C", type=float, required=True, help="Daily carb target")
-    ap.add_argument("--F", type=float, required=True, help="Daily fat target")
+    ap.add_argument("--P", type=float, help="Daily protein target")
+    ap.add_argument("--C", type=float, help="Daily carb target")
+    ap.add_argument("--F", type=float, help="Daily fat target")
     ap.add_argument("--allergens", type=str, default="", help="Comma-separated allergens to avoid")
     ap.add_argument("--out", type=str, default="runs/weekly_plan.json", help="Output JSON path")
+    ap.add_argument("--preset", type=str, default=None, choices=list(PRESETS.keys()),
+                    help="Generation preset (default: original n=360/top-30 search)")
+    ap.add_argument("--batched", action="store_true", help="Use the vectorized candidate generator")
+    ap.add_argument("--batch", type=str, default=None,
+                    help="JSONL file of per-client requests (P, C, F, allergens, preset, seed); "
+                         "plans are streamed to --out as JSONL")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes for --batch")
+    ap.add_argument("--seed", type=int, default=None,
+                    help="Seed independent per-day/per-slot streams (reproducible, parallel-safe)")
+    ap.add_argument("--budget-ms", type=float, default=None,
+                    help="Anytime mode: keep improving the week until this wall-clock budget is spent")
+    ap.add_argument("--replan", type=str, default=None,
+                    help="Plan JSON to edit: replace --slot of --day (or the whole day) and write it to --out")
+    ap.add_argument("--day", type=int, default=None, help="Day (1-7) for --replan")
+    ap.add_argument("--slot", type=str, default=None, choices=SLOTS, help="Meal for --replan (default: whole day)")
+    ap.add_argument("--stream", action="store_true",
+                    help="Write NDJSON: one line per day as soon as it is planned, weekly totals last "
+                         "(--out - for stdout); with --batch, per-day lines tagged with the job id")
+    ap.add_argument("--diagnostics", action="store_true",
+                    help="Add per-stage timers and counters (per day and slot) to the output as \"diagnostics\"")
+    ap.add_argument("--refine", action="store_true",
+                    help="Improve the greedy week with a local-search pass over the cached top-k candidates")
+    ap.add_argument("--solver", type=str, default="sample", choices=list(SOLVERS),
+                    help="Day selection: random candidate sampling, or per-slot DP over discretized macros (exact)")
+    ap.add_argument("--days", type=int, default=None,
+                    help="Rolling horizon: plan this many days (e.g. 28 or 90) with windowed fatigue")
+    ap.add_argument("--state", type=str, default=None,
+                    help="Horizon state file: continue from it if it exists, and save it after every day")
+    ap.add_argument("--window", type=int, default=7, help="Days the horizon fatigue penalties look back")
+    ap.add_argument("--repeat-window", type=int, default=28, help="Days an identical horizon meal stays blocked")
+    ap.add_argument("--threads", type=int, default=1, help="Generate the three slots concurrently (plans are seeded: --seed or the default seed)")
+    ap.add_argument("--serve", action="store_true", help="Run a long-lived JSON planning server with a warm catalog")
+    ap.add_argument("--host", type=str, default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--socket", type=str, default=None, help="Serve on this Unix socket instead of TCP")
+    ap.add_argument("--snapshot", type=str, default=None,
+                    help="Binary catalog snapshot dir; reused while the CSV is unchanged, rebuilt otherwise")
+    ap.add_argument("--cache-size", type=int, default=512,
+                    help="Plans kept in memory by --serve / --batch (0 disables the cache)")
+    ap.add_argument("--cache-ttl", type=float, default=3600.0, help="Seconds a cached plan stays valid (<=0: forever)")
+    ap.add_argument("--cache-dir", type=str, default=None, help="Also keep cached plans on disk here")
+    ap.add_argument("--bank-size", type=int, default=0,
+                    help="--serve / --batch: draw sampled candidates from per-(slot, allergen profile) banks "
+                         "of this many candidates (0 disables)")
+    ap.add_argument("--bank-refresh", type=float, default=600.0,
+                    help="Seconds before a candidate bank is redrawn in the background (<=0: never)")
+    ap.add_argument("--timings", action="store_true",
+                    help="Print import / catalog load / run times (ms) to stderr on exit")
     args=ap.parse_args()
 
-    allergens=[a.strip().lower() for a in args.allergens.split(",") if a.strip()] if args.allergens else []
-    df=load_csv(args.csv)
-    plan=build_week(df, args.P, args.C, args.F, allergens)
+    timings = {"import": (time.perf_counter() - _IMPORT_T0) * 1000.0}
+    if args.timings:
+        import atexit
+        atexit.register(_print_timings, timings, time.perf_counter())
+    load = (lambda: load_csv_cached(args.csv, args.snapshot)) if args.snapshot else (lambda: read_csv_catalog(args.csv))
+    t0 = time.perf_counter()
+    df=load()
+    timings["load"] = (time.perf_counter() - t0) * 1000.0
+    cache = (PlanCache(max(args.cache_size, 0), args.cache_ttl if args.cache_ttl > 0 else None, args.cache_dir)
+             if args.cache_size > 0 or args.cache_dir else None)
+    bank = (CandidateBank(args.bank_size, refresh_s=args.bank_refresh if args.bank_refresh > 0 else None)
+            if args.bank_size > 0 else None)
+    if args.serve:
+        import asyncio
+        server = PlanServer(CatalogStore(df, bank=bank), loader=lambda: (load(), None), cache=cache)
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.socket))
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.batch:
+        ok, failed = run_batch(df, args.batch, args.out, workers=args.workers, cache=cache, stream=args.stream,
+                               bank=bank)
+        print(f"[OK] Planned {ok} requests ({failed} failed) -> {args.out}")
+        return
+    if args.replan:
+        if args.day is None: ap.error("--replan needs --day")
+        with open(args.replan, encoding="utf-8") as f:
+            req={"plan": json.load(f), "day": args.day, "slot": args.slot, "seed": args.seed}
+        if args.diagnostics:
+            with profiling() as prof:
+                plan=replan_request(df, req)
+            plan["diagnostics"]=prof.report()
+        else:
+            plan=replan_request(df, req)
+    else:
+        if args.P is None or args.C is None or args.F is None:
+            ap.error("--P, --C and --F are required unless --batch or --replan is given")
+        req={"P": args.P, "C": args.C, "F": args.F, "allergens": args.allergens, "preset": args.preset,
+             "batched": args.batched, "budget_ms": args.budget_ms, "solver": args.solver, "refine": args.refine,
+             "diagnostics": args.diagnostics}
+        if args.seed is not None: req["seed"]=args.seed
+        if args.days is not None or args.state:
+            req.update({"days": args.days, "window": args.window, "repeat_window": args.repeat_window})
+            if args.state and os.path.exists(args.state): req["state"]=HorizonState.load(args.state).to_json()
+        try:  # same validation as /plan and /plan/stream
+            if args.stream: records = stream_plan(df, req, workers=args.threads, checkpoint=args.state)
+            else: resolve_request(req)
+        except ValueError as e:
+            ap.error(str(e))
+        if args.stream:
+            to_stdout = args.out == "-"
+            if not to_stdout: Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+            f = sys.stdout if to_stdout else open(args.out, "w", encoding="utf-8")
+            try:
+                for rec in records:
+                    f.write(json.dumps(rec, ensure_ascii=False) + "\n"); f.flush()
+                    if not to_stdout and rec["type"] == "day":
+                        print(f"DAY {rec['day']}: rel_err={rec['info']['rel_err']:.3f}", flush=True)
+            finally:
+                if not to_stdout: f.close()
+            if not to_stdout: print(f"[OK] Streamed: {args.out}")
+            return
+        plan=plan_request(df, req, workers=args.threads, checkpoint=args.state)
 
     outp=Path(args.out)
     outp.parent.mkdir(parents=True, exist_ok=True)
@@ -598,6 +3403,26 @@ def main():
         for sl in SLOTS:
             m=d["meals"][sl]; mac=m["macros"]
             print(f"  {sl.upper()}: {', '.join(m['names'])} | items={len(m['roles'])} | P={mac['P']:.1f} C={mac['C']:.1f} F={mac['F']:.1f}")
+    if "refine" in plan:
+        rf=plan["refine"]
+        print(f"REFINE: objective {rf['objective_before']:.3f} -> {rf['objective_after']:.3f} "
+              f"({rf['replaces']} replaces, {rf['swaps']} swaps, {rf['elapsed_ms']:.0f} ms)")
+    if "diagnostics" in plan:
+        dg=plan["diagnostics"]; st=dg["stages"]; ct=dg["counters"]
+        print(f"DIAGNOSTICS: total={dg['total_ms']:.0f} ms (pool={st['pool_ms']:.0f} generate={st['generate_ms']:.0f} "
+              f"score={st['score_ms']:.0f} combo={st['combo_ms']:.0f}) attempts={ct['attempts']} accepted={ct['accepted']} "
+              f"rejected={ct['rejected']} duplicates={ct['duplicates']} combos={ct['combos']}")
+    if "search" in plan:
+        sr=plan["search"]
+        print(f"SEARCH: {sr['elapsed_ms']:.0f}/{sr['budget_ms']:.0f} ms, candidates={sr['candidates_evaluated']} "
+              f"combos={sr['combos_searched']} rel_err={sr['rel_err']:.3f}")
+    if "totals" in plan:
+        for wt in plan["weekly_totals"]:
+            print(f"WEEK {wt['week']} ({wt['days']} days): P={wt['P']:.1f} C={wt['C']:.1f} F={wt['F']:.1f} "
+                  f"kcal={wt['kcal']:.0f} price={wt['price']:.2f}")
+        wt=plan["totals"]
+        print(f"TOTALS: P={wt['P']:.1f} C={wt['C']:.1f} F={wt['F']:.1f} kcal={wt['kcal']:.0f} price={wt['price']:.2f}")
+        return
     wt=plan["weekly_totals"]
     print(f"WEEK TOTALS: P={wt['P']:.1f} C={wt['C']:.1f} F={wt['F']:.1f} kcal={wt['kcal']:.0f} price={wt['price']:.2f}")
 